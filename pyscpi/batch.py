@@ -0,0 +1,106 @@
+class Batch:
+    """Collects SCPI commands and sends them as compound messages.
+
+    Commands written while the batch is active are joined with ';' into as
+    few messages as max_size allows. A query flushes the pending commands
+    together with the query itself. Use it through an instrument's batch()::
+
+        with inst.batch(opc=True):
+            inst.write(':WGEN:FUNCtion SINusoid')
+            inst.write(':WGEN:FREQuency 1000')
+
+    If the block raises, the pending commands are discarded.
+
+    :param inst: The instrument, either scpi.Instrument or usbtmc.Instrument
+    :param opc: Finish with a single *OPC? round trip
+    :param max_size: The maximum size of one compound message in bytes
+    """
+
+    def __init__(self, inst, opc: bool = False, max_size: int = 1024):
+        self.inst = inst
+        self.opc = opc
+        self.max_size = max_size
+        self.pending = []
+        self._size = 0
+        self._depth = 0
+
+    def __enter__(self):
+        if self._depth == 0:
+            self.inst._batch = self
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        try:
+            if exc_type is not None:
+                self.pending = []
+                self._size = 0
+            elif self.opc:
+                self.query('*OPC?')
+            else:
+                self.flush()
+        finally:
+            self.inst._batch = None
+
+    def write(self, cmd: str) -> None:
+        """Adds a command to the batch, sending the pending message if it would exceed max_size.
+
+        :param cmd: The SCPI command
+        """
+        cmd = _absolute(cmd)
+        if self.pending and self._size + len(cmd) + 1 > self.max_size:
+            self.flush()
+        self.pending.append(cmd)
+        self._size += len(cmd) + 1
+
+    def query(self, cmd: str) -> str:
+        """Sends the pending commands followed by a query and reads its response.
+
+        :param cmd: The SCPI query
+        :return: The response
+        """
+        self.write(cmd)
+        return self._transmit(query=True)
+
+    def flush(self) -> None:
+        """Sends the pending commands."""
+        if self.pending:
+            self._transmit(query=False)
+
+    def _transmit(self, query: bool):
+        messages = []
+        message = ''
+        for cmd in self.pending:
+            if message and len(message) + len(cmd) + 1 > self.max_size:
+                messages.append(message)
+                message = ''
+            message = f'{message};{cmd}' if message else cmd
+        messages.append(message)
+
+        self.pending = []
+        self._size = 0
+
+        # send through the instrument with the batch detached
+        active = self.inst._batch
+        self.inst._batch = None
+        try:
+            for message in messages[:-1]:
+                self.inst.write(message)
+            if query:
+                return self.inst.query(messages[-1])
+            self.inst.write(messages[-1])
+        finally:
+            self.inst._batch = active
+
+
+def _absolute(cmd: str) -> str:
+    # inside a compound message a header without a leading colon is relative
+    # to the previous command, so anchor every command at the root
+    cmd = cmd.strip()
+    if cmd.startswith((':', '*')):
+        return cmd
+    return ':' + cmd
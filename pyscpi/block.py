@@ -0,0 +1,69 @@
+"""Parsing of IEEE 488.2 definite-length blocks, #<n><length><data>.
+
+The read_block() of every backend reads the header with these helpers and
+fills the data straight from its transport. A block whose header is invalid,
+or which does not fit the buffer given, is read to the end of the response
+before the error is raised, so the next response can still be read.
+"""
+
+
+class BlockSizeError(ValueError):
+    """The buffer given to read_block() is smaller than the block.
+
+    :param length: The length of the block data in bytes
+    :param size: The size of the buffer in bytes
+    """
+
+    def __init__(self, length: int, size: int):
+        super().__init__(f'Buffer of {size} bytes is too small for a {length} byte block')
+        self.length = length
+        self.size = size
+
+
+def header_size(prefix) -> int:
+    """The size of a block header from its first two bytes.
+
+    Raises ValueError if the response is not a definite-length block.
+
+    :param prefix: The first two bytes of the response, eg. b'#8'
+    :return: The size of the header, '#' and the digit count included
+    """
+    prefix = bytes(prefix[:2])
+    if prefix[:1] != b'#' or not prefix[1:2].isdigit():
+        raise ValueError(f'Invalid block header {prefix!r}')
+    if prefix[1:2] == b'0':
+        raise ValueError('Indefinite-length blocks are not supported')
+    return 2 + int(prefix[1:2])
+
+
+def parse_header(data) -> tuple[int, int] | None:
+    """Parses the header at the start of a response.
+
+    Raises ValueError if the response is not a definite-length block.
+
+    :param data: The start of the response, as much of it as was received
+    :return: The size of the header and the length of the data, or None if the header is incomplete
+    """
+    if len(data) < 2:
+        return None
+    size = header_size(data)
+    if len(data) < size:
+        return None
+    return size, int(bytes(data[2:size]))
+
+
+def data_view(buffer, length: int) -> memoryview:
+    """A byte view of the destination of the block data.
+
+    Raises BlockSizeError if the buffer is too small.
+
+    :param buffer: A writable buffer to fill, or None to allocate one
+    :param length: The length of the block data in bytes
+    :return: A memoryview of exactly length bytes
+    """
+    if buffer is None:
+        buffer = bytearray(length)
+    view = memoryview(buffer).cast('B')
+    if len(view) < length:
+        raise BlockSizeError(length, len(view))
+    return view[:length]
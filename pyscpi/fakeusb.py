@@ -0,0 +1,471 @@
+"""An in-process fake USBTMC device for pyusb.
+
+The fake is a pyusb backend, so usbtmc.Instrument drives it through the
+real pyusb Device, Configuration and Endpoint objects. Program messages
+are handed to a responder, any object with a handle(message) method that
+returns the response bytes, such as pyscpi.keysight.sim.Oscilloscope::
+
+    from pyscpi import fakeusb, usbtmc
+    from pyscpi.keysight import sim
+
+    dev = fakeusb.device(sim.Oscilloscope())
+    inst = usbtmc.Instrument(device=dev)
+    print(inst.query('*IDN?'))
+
+Responder scripts the replies of a device without a simulator. The vendor
+and product IDs select the quirks usbtmc.Instrument applies, and the fake
+behaves accordingly, eg. idVendor=0x1ab1, idProduct=0x04ce for a Rigol that
+sends headerless continuation packets. Latency, short transfers and
+timeouts can be injected to exercise the error paths::
+
+    responder = fakeusb.Responder({'*IDN?': 'ACME,X1,0,1.0', re.compile(r':MEAS:VOLT\\?'): '1.25'})
+    dev = fakeusb.device(responder, latency=0.001, short_packet=64)
+    dev.fake.inject_timeout()
+"""
+
+import array
+import errno
+import re
+import struct
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import usb.backend
+import usb.core
+import usb.util
+
+from . import usbtmc
+
+
+_BULK_OUT = 0x02
+_BULK_IN = 0x81
+_INTERRUPT_IN = 0x83
+
+ADVANTEST_VID = 0x1334
+RIGOL_VID = 0x1ab1
+
+
+class Responder:
+    """A scriptable SCPI responder for FakeDevice.
+
+    Each command of a program message is looked up in the script, first as
+    an exact string and then against the compiled regular expressions. A
+    response is a str or bytes, which is sent with a newline terminator, or
+    a callable that takes the command and returns one. Commands that are
+    not in the script are only logged, unless they are queries and a
+    default is set.
+
+    :param script: A dict mapping commands or compiled patterns to responses
+    :param default: The response to queries that are not in the script
+    """
+
+    def __init__(self, script: dict = None, default=None):
+        self.script = dict(script or {})
+        self.default = default
+        self.log = []
+
+    def on(self, command, response) -> None:
+        """Adds or replaces the response to a command.
+
+        :param command: The command string, or a compiled regular expression
+        :param response: A str, bytes, or callable taking the command
+        """
+        self.script[command] = response
+
+    def handle(self, message: str) -> bytes:
+        responses = []
+        for cmd in message.split(';'):
+            cmd = cmd.strip()
+            if not cmd:
+                continue
+            self.log.append(cmd)
+
+            response = self._lookup(cmd)
+            if callable(response):
+                response = response(cmd)
+            if response is None:
+                continue
+            if isinstance(response, str):
+                response = response.encode('utf-8')
+            responses.append(response)
+
+        if not responses:
+            return b''
+        return b';'.join(responses) + b'\n'
+
+    def _lookup(self, cmd: str):
+        if cmd in self.script:
+            return self.script[cmd]
+        for key, response in self.script.items():
+            if isinstance(key, re.Pattern) and key.fullmatch(cmd):
+                return response
+        return self.default if cmd.endswith('?') else None
+
+
+class FakeDevice:
+    """The state of one fake USBTMC device.
+
+    The Rigol and Advantest behaviours that usbtmc.Instrument works around
+    are selected by the IDs: Rigol devices (idVendor 0x1ab1, idProduct in
+    usbtmc.RIGOL_QUIRK_PIDS) only put a header on the first packet of a
+    response, and 0x04ce also misreports the size of IEEE blocks. Advantest
+    devices (idVendor 0x1334) never set EOM.
+
+    :param responder: Object with a handle(message: str) -> bytes method
+    :param idVendor: The vendor ID
+    :param idProduct: The product ID
+    :param serial: The serial number string
+    :param max_packet_size: wMaxPacketSize of the bulk endpoints
+    :param latency: Seconds to wait before answering each bulk-IN transfer
+    :param short_packet: End each bulk-IN transfer after this many payload bytes, or None for whole transfers
+    :param interrupt: Provide the USB488 interrupt-IN endpoint
+    """
+
+    def __init__(self, responder, idVendor: int = 0x2a8d, idProduct: int = 0x0396,
+                 serial: str = 'SIM00000001', max_packet_size: int = 512, latency: float = 0.0,
+                 short_packet: int = None, interrupt: bool = True):
+        self.responder = responder
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.serial = serial
+        self.max_packet_size = max_packet_size
+        self.latency = latency
+        self.short_packet = short_packet
+        self.interrupt = interrupt
+        self.strings = {1: 'Keysight Technologies', 2: 'Simulated USBTMC device', 3: serial}
+
+        self.rigol = idVendor == RIGOL_VID and idProduct in usbtmc.RIGOL_QUIRK_PIDS
+        self.advantest = idVendor == ADVANTEST_VID
+
+        self.configuration = 0
+        self.message = bytearray()
+        self.output = bytearray()
+        self.requests = deque()
+        self.notifications = deque()
+        self.status_byte = 0
+        self.requesting = False
+        self.locked = False
+        self.myid = 1
+        self.timeouts = {'in': 0, 'out': 0}
+        self.streaming = False
+
+    def inject_timeout(self, count: int = 1, direction: str = 'in') -> None:
+        """Makes the next bulk transfers fail with a timeout.
+
+        :param count: The number of transfers to fail
+        :param direction: 'in' for bulk-IN or 'out' for bulk-OUT
+        """
+        self.timeouts[direction] += count
+
+    def service_request(self, status_byte: int = 0x40) -> None:
+        """Sends an SRQ notification on the interrupt-IN endpoint.
+
+        :param status_byte: The status byte, with the RQS bit 0x40 set
+        """
+        self.status_byte = status_byte
+        self.requesting = bool(status_byte & 0x40)
+        self.notifications.append(bytes([usbtmc.USB488_SRQ_NOTIFICATION, status_byte]))
+
+    def _timeout(self, direction: str) -> bool:
+        if self.timeouts[direction] > 0:
+            self.timeouts[direction] -= 1
+            return True
+        return False
+
+    def bulk_out(self, data) -> int:
+        if self._timeout('out'):
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        msgid, btag, btaginverse = struct.unpack_from('BBBx', data)
+        if btag != (~btaginverse & 0xFF):
+            raise usb.core.USBError('Invalid bTag', errno=errno.EPIPE)
+
+        if msgid == usbtmc.USBTMC_MSGID_DEV_DEP_MSG_OUT:
+            if self.streaming:
+                # a new command discards what the host left unread
+                self.output = bytearray()
+                self.streaming = False
+            transfer_size, attributes = struct.unpack_from('<LBxxx', data, 4)
+            self.message += data[usbtmc.USBTMC_HEADER_SIZE:usbtmc.USBTMC_HEADER_SIZE + transfer_size]
+            if attributes & 1:
+                self._dispatch()
+        elif msgid == usbtmc.USBTMC_MSGID_REQUEST_DEV_DEP_MSG_IN:
+            transfer_size, = struct.unpack_from('<L', data, 4)
+            self.requests.append((btag, transfer_size))
+        elif msgid == usbtmc.USB488_MSGID_TRIGGER:
+            pass
+        else:
+            raise usb.core.USBError('Unsupported MsgID', errno=errno.EPIPE)
+
+        return len(data)
+
+    def bulk_in(self, buff) -> int:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if self._timeout('in'):
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        if self.streaming:
+            # rigol continuation packets carry no header
+            size = min(len(buff), len(self.output), self.short_packet or len(buff))
+            buff[:size] = array.array('B', self.output[:size])
+            del self.output[:size]
+            self.streaming = len(self.output) > 0
+            return size
+
+        if not self.requests:
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        btag, transfer_size = self.requests.popleft()
+        space = len(buff) - usbtmc.USBTMC_HEADER_SIZE
+        size = min(transfer_size, len(self.output), space, self.short_packet or space)
+        eom = size == len(self.output) and not self.advantest
+
+        if size == 0 and not self.output:
+            raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+
+        reported = size
+        if self.rigol:
+            # rigol reports the whole response and sends the rest without headers
+            reported = len(self.output)
+            if self.idProduct == 0x04ce and self.output[:1] == b'#':
+                reported = size
+            eom = True
+            self.streaming = size < len(self.output)
+
+        header = struct.pack('<BBBxLBxxx', usbtmc.USBTMC_MSGID_DEV_DEP_MSG_IN,
+                             btag, ~btag & 0xFF, reported, 1 if eom else 0)
+        packet = header + bytes(self.output[:size])
+        del self.output[:size]
+
+        packet += b'\0' * (-len(packet) % 4)
+        n = min(len(packet), len(buff))
+        buff[:n] = array.array('B', packet[:n])
+        return n
+
+    def control(self, bmRequestType, bRequest, wValue, wIndex, buff) -> int:
+        rtype = bmRequestType & (3 << 5)
+
+        if rtype == usb.util.CTRL_TYPE_VENDOR:
+            if self.advantest and bRequest == 0xF5:
+                return _fill(buff, bytes([self.myid]))
+            return 0
+
+        if self.advantest and bRequest == 0xA0:
+            # advantest remote control lock
+            self.locked = bool(wValue)
+            return _fill(buff, bytes([usbtmc.USBTMC_STATUS_SUCCESS]))
+
+        if rtype == usb.util.CTRL_TYPE_STANDARD:
+            if bRequest == 0x06 and wValue >> 8 == usb.util.DESC_TYPE_STRING:
+                index = wValue & 0xFF
+                if index == 0:
+                    data = struct.pack('<BBH', 4, usb.util.DESC_TYPE_STRING, 0x0409)
+                else:
+                    text = self.strings.get(index, '').encode('utf-16-le')
+                    data = struct.pack('BB', len(text) + 2, usb.util.DESC_TYPE_STRING) + text
+                return _fill(buff, data)
+            return 0
+
+        status = usbtmc.USBTMC_STATUS_SUCCESS
+
+        if bRequest == usbtmc.USBTMC_REQUEST_GET_CAPABILITIES:
+            data = struct.pack('<BxHBB6xHBB8x', status, 0x0100, 0x04, 0x00, 0x0100, 0x06, 0x0F)
+        elif bRequest == usbtmc.USBTMC_REQUEST_INITIATE_CLEAR:
+            self.message = bytearray()
+            self.output = bytearray()
+            self.requests.clear()
+            self.streaming = False
+            data = bytes([status])
+        elif bRequest == usbtmc.USBTMC_REQUEST_CHECK_CLEAR_STATUS:
+            data = bytes([status, 0])
+        elif bRequest in (usbtmc.USBTMC_REQUEST_INITIATE_ABORT_BULK_OUT,
+                          usbtmc.USBTMC_REQUEST_INITIATE_ABORT_BULK_IN):
+            self.message = bytearray()
+            self.output = bytearray()
+            self.requests.clear()
+            self.streaming = False
+            data = bytes([status, wValue & 0xFF])
+        elif bRequest in (usbtmc.USBTMC_REQUEST_CHECK_ABORT_BULK_OUT_STATUS,
+                          usbtmc.USBTMC_REQUEST_CHECK_ABORT_BULK_IN_STATUS):
+            data = bytes([status, 0]) + b'\0' * 6
+        elif bRequest == usbtmc.USBTMC_REQUEST_INDICATOR_PULSE:
+            data = bytes([status])
+        elif bRequest == usbtmc.USB488_READ_STATUS_BYTE:
+            stb = self._status_byte()
+            if self.interrupt:
+                # the status byte follows on the interrupt endpoint
+                self.notifications.append(bytes([0x80 | (wValue & 0x7F), stb]))
+                data = bytes([status, wValue & 0xFF, 0])
+            else:
+                data = bytes([status, wValue & 0xFF, stb])
+        elif bRequest in (usbtmc.USB488_REN_CONTROL, usbtmc.USB488_GOTO_LOCAL,
+                          usbtmc.USB488_LOCAL_LOCKOUT):
+            data = bytes([status])
+        else:
+            data = bytes([usbtmc.USBTMC_STATUS_FAILED])
+
+        return _fill(buff, data)
+
+    def interrupt_in(self, buff, timeout: int = 0) -> int:
+        # like libusb, a timeout of 0 waits indefinitely
+        deadline = time.perf_counter() + timeout / 1000 if timeout else None
+        while True:
+            self._request_service()
+            if self.notifications:
+                return _fill(buff, self.notifications.popleft())
+            if deadline is not None and time.perf_counter() >= deadline:
+                raise usb.core.USBError('Operation timed out', errno=errno.ETIMEDOUT)
+            time.sleep(0.0005)
+
+    def _request_service(self) -> None:
+        # a responder that reports RQS in its status byte raises a request on the rising edge
+        if not callable(getattr(self.responder, 'status_byte', None)):
+            return
+        stb = self._status_byte()
+        requesting = bool(stb & 0x40)
+        if requesting and not self.requesting:
+            self.notifications.append(bytes([usbtmc.USB488_SRQ_NOTIFICATION, stb]))
+        self.requesting = requesting
+
+    def _status_byte(self) -> int:
+        status_byte = getattr(self.responder, 'status_byte', None)
+        stb = status_byte() if callable(status_byte) else self.status_byte
+        if self.output:
+            stb |= 0x10  # MAV
+        return stb
+
+    def _dispatch(self) -> None:
+        text = self.message.decode('utf-8', 'replace')
+        self.message = bytearray()
+        for line in text.splitlines():
+            line = line.strip()
+            if line:
+                self.output += self.responder.handle(line)
+
+
+def _fill(buff, data: bytes) -> int:
+    n = min(len(buff), len(data))
+    buff[:n] = array.array('B', data[:n])
+    return n
+
+
+class Backend(usb.backend.IBackend):
+    """A pyusb backend that enumerates FakeDevice objects.
+
+    :param devices: The FakeDevice objects on the fake bus
+    """
+
+    def __init__(self, *devices: FakeDevice):
+        self.devices = list(devices)
+
+    def enumerate_devices(self):
+        return iter(self.devices)
+
+    def get_parent(self, dev):
+        return None
+
+    def get_device_descriptor(self, dev):
+        return SimpleNamespace(
+            bLength=18, bDescriptorType=usb.util.DESC_TYPE_DEVICE, bcdUSB=0x0200,
+            bDeviceClass=0, bDeviceSubClass=0, bDeviceProtocol=0, bMaxPacketSize0=64,
+            idVendor=dev.idVendor, idProduct=dev.idProduct, bcdDevice=0x0100,
+            iManufacturer=1, iProduct=2, iSerialNumber=3, bNumConfigurations=1,
+            address=self.devices.index(dev) + 1, bus=1, port_number=None,
+            port_numbers=None, speed=usb.util.SPEED_HIGH)
+
+    def get_configuration_descriptor(self, dev, config):
+        if config != 0:
+            raise IndexError(config)
+        return SimpleNamespace(
+            bLength=9, bDescriptorType=usb.util.DESC_TYPE_CONFIG, wTotalLength=39,
+            bNumInterfaces=1, bConfigurationValue=1, iConfiguration=0,
+            bmAttributes=0x80, bMaxPower=50, extra_descriptors=[])
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if intf != 0 or alt != 0 or config != 0:
+            raise IndexError(intf)
+        return SimpleNamespace(
+            bLength=9, bDescriptorType=usb.util.DESC_TYPE_INTERFACE, bInterfaceNumber=0,
+            bAlternateSetting=0, bNumEndpoints=3 if dev.interrupt else 2,
+            bInterfaceClass=usbtmc.USBTMC_bInterfaceClass,
+            bInterfaceSubClass=usbtmc.USBTMC_bInterfaceSubClass,
+            bInterfaceProtocol=usbtmc.USB488_bInterfaceProtocol,
+            iInterface=0, extra_descriptors=[])
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        endpoints = [(_BULK_OUT, usb.util.ENDPOINT_TYPE_BULK, dev.max_packet_size),
+                     (_BULK_IN, usb.util.ENDPOINT_TYPE_BULK, dev.max_packet_size)]
+        if dev.interrupt:
+            endpoints.append((_INTERRUPT_IN, usb.util.ENDPOINT_TYPE_INTR, 8))
+        if ep >= len(endpoints):
+            raise IndexError(ep)
+        address, attributes, size = endpoints[ep]
+        return SimpleNamespace(
+            bLength=7, bDescriptorType=usb.util.DESC_TYPE_ENDPOINT,
+            bEndpointAddress=address, bmAttributes=attributes,
+            wMaxPacketSize=size, bInterval=1 if attributes == usb.util.ENDPOINT_TYPE_INTR else 0,
+            bRefresh=0, bSynchAddress=0, extra_descriptors=[])
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        dev_handle.configuration = config_value
+
+    def get_configuration(self, dev_handle):
+        return dev_handle.configuration
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        pass
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        return dev_handle.bulk_out(data.tobytes())
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        return dev_handle.bulk_in(buff)
+
+    def intr_read(self, dev_handle, ep, intf, buff, timeout):
+        return dev_handle.interrupt_in(buff, timeout)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue, wIndex, data, timeout):
+        return dev_handle.control(bmRequestType, bRequest, wValue, wIndex, data)
+
+    def clear_halt(self, dev_handle, ep):
+        pass
+
+    def reset_device(self, dev_handle):
+        pass
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass
+
+
+def device(responder, **kwargs) -> usb.core.Device:
+    """Creates a pyusb Device backed by a fake USBTMC device.
+
+    :param responder: Object with a handle(message: str) -> bytes method
+    :param kwargs: Passed on to FakeDevice
+    :return: A usb.core.Device to pass to usbtmc.Instrument(device=...), with the FakeDevice as its fake attribute
+    """
+    fake = FakeDevice(responder, **kwargs)
+    dev = usb.core.find(backend=Backend(fake))
+    dev.fake = fake
+    return dev
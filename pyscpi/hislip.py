@@ -0,0 +1,501 @@
+"""A HiSLIP (IVI-6.1) client.
+
+HiSLIP uses two TCP connections to port 4880. The synchronous channel carries
+program messages and responses framed as Data and DataEnd messages, so a
+response is read to its exact length instead of to a terminator. The
+asynchronous channel carries status queries, service requests and device
+clear next to the data, without waiting for it::
+
+    from pyscpi import hislip
+    from pyscpi.keysight import osc
+
+    inst = hislip.Instrument('192.168.1.10')
+    print(inst.query('*IDN?'))
+    t, y1 = osc.readSingleChannel(inst, 1)
+
+Instrument has the same methods as scpi.Instrument, so the osc and status
+helpers work on it unchanged. In overlapped mode, chosen by the server,
+several queries may be written before their responses are read.
+"""
+
+import select
+import socket
+import struct
+import time
+
+from .batch import Batch
+from .block import data_view, header_size
+from .trace import traced
+
+
+PORT = 4880
+PROTOCOL_VERSION = 0x0100
+VENDOR_ID = b'PY'
+FIRST_MESSAGE_ID = 0xFFFFFF00
+
+# message types
+INITIALIZE = 0
+INITIALIZE_RESPONSE = 1
+FATAL_ERROR = 2
+ERROR = 3
+ASYNC_LOCK = 4
+ASYNC_LOCK_RESPONSE = 5
+DATA = 6
+DATA_END = 7
+DEVICE_CLEAR_COMPLETE = 8
+DEVICE_CLEAR_ACKNOWLEDGE = 9
+ASYNC_REMOTE_LOCAL_CONTROL = 10
+ASYNC_REMOTE_LOCAL_RESPONSE = 11
+TRIGGER = 12
+INTERRUPTED = 13
+ASYNC_INTERRUPTED = 14
+ASYNC_MAXIMUM_MESSAGE_SIZE = 15
+ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE = 16
+ASYNC_INITIALIZE = 17
+ASYNC_INITIALIZE_RESPONSE = 18
+ASYNC_DEVICE_CLEAR = 19
+ASYNC_SERVICE_REQUEST = 20
+ASYNC_STATUS_QUERY = 21
+ASYNC_STATUS_RESPONSE = 22
+ASYNC_DEVICE_CLEAR_ACKNOWLEDGE = 23
+
+# prologue 'HS', message type, control code, message parameter, payload length
+HEADER = struct.Struct('>2sBBIQ')
+
+
+class HislipError(Exception):
+    """An Error or FatalError message from the server, or a protocol violation.
+
+    :param code: The error code
+    :param message: The error message
+    :param fatal: Whether the server closes the connection
+    """
+
+    def __init__(self, code: int, message: str, fatal: bool = False):
+        super().__init__(f'{"Fatal error" if fatal else "Error"} {code}: {message}')
+        self.code = code
+        self.message = message
+        self.fatal = fatal
+
+
+def send_message(sock: socket.socket, type: int, control: int = 0, param: int = 0, payload=b'') -> None:
+    """Sends one HiSLIP message.
+
+    :param sock: The connected socket
+    :param type: The message type, eg. DATA_END
+    :param control: The control code
+    :param param: The message parameter
+    :param payload: The payload
+    """
+    header = HEADER.pack(b'HS', type, control, param, len(payload))
+    if len(payload) > 65536:
+        # large payloads are sent from where they are instead of being joined to the header
+        sock.sendall(header)
+        sock.sendall(payload)
+    else:
+        sock.sendall(header + bytes(payload))
+
+
+def read_message(sock: socket.socket) -> tuple[int, int, int, bytes]:
+    """Reads one HiSLIP message.
+
+    :param sock: The connected socket
+    :return: The message type, control code, message parameter and payload
+    """
+    type, control, param, length = _unpack(_recv_exactly(sock, HEADER.size))
+    return type, control, param, _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('Connection closed by instrument')
+        received += n
+    return bytes(data)
+
+
+def _unpack(header: bytes) -> tuple[int, int, int, int]:
+    prologue, type, control, param, length = HEADER.unpack(header)
+    if prologue != b'HS':
+        raise HislipError(0, f'Invalid message prologue {prologue!r}', fatal=True)
+    return type, control, param, length
+
+
+class Instrument:
+    """A HiSLIP session with an instrument.
+
+    :param host: The host name or IP address
+    :param port: The TCP port
+    :param sub_address: The HiSLIP device name, eg. 'hislip0'
+    :param timeout: The socket timeout in seconds. If None, block indefinitely
+    :param max_message_size: The largest message payload the client accepts in bytes
+    :param chunk_size: The size of the socket reads that fill the receive buffer
+    :param tracer: A trace.Tracer to report commands to
+    """
+
+    def __init__(self, host, port: int = PORT, sub_address: str = 'hislip0', timeout: float = None,
+                 max_message_size: int = 2**20, chunk_size: int = 65536, tracer=None):
+        self.host = host
+        self.port = port
+        self.sub_address = sub_address
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.tracer = tracer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.transfers = 0
+
+        self.message_id = FIRST_MESSAGE_ID
+        self.response_id = None
+        self.srq_status = None
+        self._last_id = (FIRST_MESSAGE_ID - 2) & 0xFFFFFFFF
+        self._rmt = False
+        self._remaining = 0
+        self._end = True
+        self._buf = bytearray()
+        self._batch = None
+
+        self.s = self._connect()
+        vendor = int.from_bytes(VENDOR_ID, 'big')
+        send_message(self.s, INITIALIZE, 0, (PROTOCOL_VERSION << 16) | vendor, sub_address.encode('ascii'))
+        _, control, param, _ = self._expect(self._read_sync(), INITIALIZE_RESPONSE)
+        self.overlapped = bool(control & 1)
+        self.server_version = param >> 16
+        self.session_id = param & 0xFFFF
+
+        self.a = self._connect()
+        send_message(self.a, ASYNC_INITIALIZE, 0, self.session_id)
+        _, _, param, _ = self._read_async(ASYNC_INITIALIZE_RESPONSE)
+        self.server_vendor = param.to_bytes(4, 'big')[2:].decode('ascii', 'replace')
+
+        send_message(self.a, ASYNC_MAXIMUM_MESSAGE_SIZE, 0, 0, struct.pack('>Q', max_message_size))
+        _, _, _, payload = self._read_async(ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE)
+        self.max_message_size = struct.unpack('>Q', payload)[0]
+
+    def _connect(self) -> socket.socket:
+        s = socket.create_connection((self.host, self.port), self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s
+
+    @traced('write')
+    def write(self, cmd: str) -> None:
+        if self._batch is not None:
+            self._batch.write(cmd)
+            return
+        self.write_raw(str.encode(cmd + '\n'))
+
+    @traced('write')
+    def write_raw(self, data) -> None:
+        """Sends one program message, split into Data messages no larger than the server accepts.
+
+        :param data: The message bytes
+        """
+        view = memoryview(data).cast('B')
+        size = max(1, self.max_message_size)
+        offset = 0
+        while True:
+            chunk = view[offset:offset + size]
+            offset += len(chunk)
+            last = offset >= len(view)
+            # the first message after a complete response tells the server it was delivered
+            send_message(self.s, DATA_END if last else DATA, 1 if self._rmt else 0, self.message_id, chunk)
+            self._rmt = False
+            self.bytes_sent += len(chunk)
+            self.transfers += 1
+            if last:
+                break
+        self._next_id()
+
+    def batch(self, opc: bool = False, max_size: int = 1024) -> Batch:
+        """Returns a context that coalesces writes into compound messages.
+
+        If a batch is already active it is returned, so helpers can join an outer batch.
+
+        :param opc: Finish with a single *OPC? round trip
+        :param max_size: The maximum size of one compound message in bytes
+        :return: A Batch context manager
+        """
+        if self._batch is not None:
+            return self._batch
+        return Batch(self, opc, max_size)
+
+    @traced('read')
+    def read(self) -> str:
+        """Reads one response.
+
+        :return: The response without its terminator
+        """
+        return self.read_response().decode('utf-8').rstrip('\r\n')
+
+    @traced('read')
+    def read_response(self) -> bytes:
+        """Reads one complete response.
+
+        :return: The response bytes, terminator included
+        """
+        self._start()
+        parts = []
+        while True:
+            if self._remaining == 0:
+                if self._end:
+                    return b''.join(parts)
+                self._next_message()
+                continue
+            n = self._remaining
+            parts.append(self._read_exact(n))
+            self._consumed(n)
+
+    @traced('read')
+    def read_raw(self, chunk_size: int = None) -> bytes:
+        """Reads up to chunk_size bytes of the current response.
+
+        :param chunk_size: The maximum number of bytes to return. Defaults to the instrument's chunk_size
+        :return: The bytes read, empty at the end of the response
+        """
+        self._start()
+        buffer = bytearray(chunk_size or self.chunk_size)
+        with memoryview(buffer) as view:
+            n = self._read_payload(view)
+        return bytes(buffer[:n])
+
+    @traced('read')
+    def read_into(self, buffer) -> int:
+        """Reads one complete response into a writable buffer.
+
+        :param buffer: A writable buffer such as a bytearray, memoryview or NumPy array
+        :return: The number of bytes read
+        """
+        self._start()
+        view = memoryview(buffer).cast('B')
+        received = 0
+        while received < len(view):
+            n = self._read_payload(view[received:])
+            if n == 0:
+                return received
+            received += n
+        if self._remaining > 0 or not self._end:
+            self._discard()
+            raise ValueError(f'Buffer of {len(view)} bytes is too small for the response')
+        return received
+
+    @traced('read')
+    def read_block(self, buffer=None) -> memoryview:
+        """Reads an IEEE 488.2 definite-length block (#<n><length><data>).
+
+        The data is received straight from the socket into the destination,
+        and the rest of the response, its terminator, is discarded.
+
+        :param buffer: Optional writable buffer to fill. Allocated if not given
+        :return: A memoryview over the block data
+        """
+        self._start()
+        try:
+            size = header_size(self._read_payload_exactly(2))
+            digits = self._read_payload_exactly(size - 2)
+            try:
+                length = int(digits)
+            except ValueError as e:
+                raise ValueError(f'Invalid block length {digits!r}') from e
+            view = data_view(buffer, length)
+        except ValueError:
+            # an invalid header or a block too large for the buffer, the rest of
+            # the response is dropped so the next one can be read
+            self._discard()
+            raise
+
+        received = 0
+        while received < length:
+            n = self._read_payload(view[received:])
+            if n == 0:
+                raise HislipError(0, 'Response ended inside the block')
+            received += n
+
+        # the response ends with the last DataEnd message, drop its terminator
+        self._discard()
+
+        return view
+
+    @traced('query')
+    def query(self, cmd: str) -> str:
+        if self._batch is not None:
+            return self._batch.query(cmd)
+        self.write(cmd)
+        return self.read()
+
+    def trigger(self) -> None:
+        """Sends a Trigger message, the HiSLIP counterpart of a group execute trigger."""
+        send_message(self.s, TRIGGER, 1 if self._rmt else 0, self.message_id)
+        self._rmt = False
+        self._next_id()
+
+    def read_stb(self) -> int:
+        """Reads the status byte over the asynchronous channel, without waiting for pending responses.
+
+        :return: The status byte
+        """
+        send_message(self.a, ASYNC_STATUS_QUERY, 1 if self._rmt else 0, self._last_id)
+        _, control, _, _ = self._read_async(ASYNC_STATUS_RESPONSE)
+        return control
+
+    def wait_srq(self, timeout: float = None) -> int | None:
+        """Waits for a service request on the asynchronous channel.
+
+        A message that has started to arrive is read to its end within the
+        socket timeout of the instrument. If it stalls, the asynchronous channel
+        is closed, as it can no longer be kept in step.
+
+        :param timeout: The maximum time to wait in seconds. If None, wait indefinitely
+        :return: The status byte of the request, or None if none arrived in time
+        """
+        if self.srq_status is not None:
+            stb = self.srq_status
+            self.srq_status = None
+            return stb
+
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            # only the start of a message is waited for with the timeout given,
+            # the rest of it is read like any other, so a timeout never splits one
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            readable, _, _ = select.select([self.a], [], [], remaining)
+            if not readable:
+                return None
+            try:
+                type, control, _, _ = read_message(self.a)
+            except socket.timeout:
+                # the channel stopped inside a message and is out of step for good
+                self.a.close()
+                raise
+            if type == ASYNC_SERVICE_REQUEST:
+                return control
+
+    def clear(self) -> None:
+        """Clears the device, discarding pending messages and responses on both sides."""
+        send_message(self.a, ASYNC_DEVICE_CLEAR)
+        _, feature, _, _ = self._read_async(ASYNC_DEVICE_CLEAR_ACKNOWLEDGE)
+
+        send_message(self.s, DEVICE_CLEAR_COMPLETE, feature)
+        while True:
+            type, control, _, length = self._read_header()
+            self._read_exact(length)
+            if type == DEVICE_CLEAR_ACKNOWLEDGE:
+                break
+
+        self.overlapped = bool(control & 1)
+        self.message_id = FIRST_MESSAGE_ID
+        self._last_id = (FIRST_MESSAGE_ID - 2) & 0xFFFFFFFF
+        self._rmt = False
+        self._remaining = 0
+        self._end = True
+
+    def close(self) -> None:
+        self.a.close()
+        self.s.close()
+
+    def _next_id(self) -> None:
+        self._last_id = self.message_id
+        self.message_id = (self.message_id + 2) & 0xFFFFFFFF
+
+    def _start(self) -> None:
+        # the next read after a complete response starts the following one
+        if self._remaining == 0 and self._end:
+            self._end = False
+
+    def _next_message(self) -> None:
+        while True:
+            type, control, param, length = self._read_header()
+            if type in (DATA, DATA_END):
+                self.response_id = param
+                self._remaining = length
+                self._end = type == DATA_END
+                self._consumed(0)
+                return
+            payload = self._read_exact(length)
+            self._expect((type, control, param, payload), INTERRUPTED)
+            # the server dropped a response that was superseded, the next one follows
+
+    def _consumed(self, n: int) -> None:
+        self._remaining -= n
+        if self._remaining == 0 and self._end:
+            self._rmt = True
+
+    def _read_payload(self, view: memoryview) -> int:
+        # receives part of the response into view, returns 0 at its end
+        while self._remaining == 0:
+            if self._end:
+                return 0
+            self._next_message()
+
+        view = view[:self._remaining]
+        if self._buf:
+            n = min(len(self._buf), len(view))
+            view[:n] = self._buf[:n]
+            del self._buf[:n]
+        else:
+            n = self.s.recv_into(view)
+            if n == 0:
+                raise ConnectionError('Connection closed by instrument')
+            self.bytes_received += n
+            self.transfers += 1
+        self._consumed(n)
+        return n
+
+    def _read_payload_exactly(self, size: int) -> bytes:
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = self._read_payload(view[received:])
+            if n == 0:
+                raise HislipError(0, 'Response ended early')
+            received += n
+        return bytes(data)
+
+    def _discard(self) -> None:
+        while self._remaining > 0 or not self._end:
+            if self._remaining == 0:
+                self._next_message()
+                continue
+            n = self._remaining
+            self._read_exact(n)
+            self._consumed(n)
+
+    def _read_header(self) -> tuple[int, int, int, int]:
+        return _unpack(self._read_exact(HEADER.size))
+
+    def _read_sync(self) -> tuple[int, int, int, bytes]:
+        type, control, param, length = self._read_header()
+        return type, control, param, self._read_exact(length)
+
+    def _read_exact(self, size: int) -> bytes:
+        while len(self._buf) < size:
+            data = self.s.recv(max(self.chunk_size, size - len(self._buf)))
+            if not data:
+                raise ConnectionError('Connection closed by instrument')
+            self.bytes_received += len(data)
+            self.transfers += 1
+            self._buf += data
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def _read_async(self, expected: int) -> tuple[int, int, int, bytes]:
+        while True:
+            message = read_message(self.a)
+            if message[0] == ASYNC_SERVICE_REQUEST:
+                # not the reply, remember the status byte it carries for wait_srq
+                self.srq_status = message[1]
+                continue
+            return self._expect(message, expected)
+
+    def _expect(self, message: tuple, expected: int) -> tuple[int, int, int, bytes]:
+        type, control, param, payload = message
+        if type in (ERROR, FATAL_ERROR):
+            raise HislipError(control, payload.decode('utf-8', 'replace'), type == FATAL_ERROR)
+        if type != expected:
+            raise HislipError(0, f'Expected message type {expected}, received {type}')
+        return message
@@ -0,0 +1,317 @@
+"""An on-disk archive of raw oscilloscope waveforms.
+
+Frames are stored as the raw BYTE or WORD codes together with their
+preamble, so a frame takes one or two bytes per point instead of the eight
+of a float64 voltage. The reader maps the file with np.memmap and scales
+frames only when they are asked for, so archives larger than memory can be
+analysed::
+
+    from pyscpi.keysight import archive
+
+    archive.capture(inst, 'run.wfm', [1, 2], count=10000, points=62500)
+
+    with archive.Reader('run.wfm') as r:
+        print(len(r), r.codes.shape)
+        v = r.volts(slice(0, 100))
+        t = r.time(0)
+"""
+
+import json
+import os
+import time as _time
+
+import numpy as np
+
+from . import osc
+from ..block import BlockSizeError
+
+
+_MAGIC = b'PYSCPIWF'
+_VERSION = 1
+_ALIGN = 64
+
+
+def recordType(codes: np.dtype, points: int) -> np.dtype:
+    """The structured dtype of one archived frame.
+
+    :param codes: The dtype of the codes, eg. np.uint8 or '>u2'
+    :param points: The number of points per frame
+    :return: A NumPy structured dtype
+    """
+    return np.dtype([('timestamp', '<f8'), ('channel', '<i2'), ('type', '<i2'), ('points', '<i4'),
+                     ('xinc', '<f8'), ('xorg', '<f8'), ('xref', '<f8'),
+                     ('yinc', '<f8'), ('yorg', '<f8'), ('yref', '<f8'),
+                     ('codes', np.dtype(codes), (points,))])
+
+
+def _readHeader(f) -> tuple[dict, int]:
+    magic = f.read(len(_MAGIC))
+    if magic != _MAGIC:
+        raise ValueError('Not a pyscpi waveform archive')
+    size = int.from_bytes(f.read(4), 'little')
+    header = json.loads(f.read(size).decode('utf-8'))
+    if header['version'] != _VERSION:
+        raise ValueError(f"Unsupported archive version {header['version']}")
+    return header, len(_MAGIC) + 4 + size
+
+
+def _writeHeader(f, header: dict) -> None:
+    text = json.dumps(header).encode('utf-8')
+    text += b' ' * (-(len(_MAGIC) + 4 + len(text)) % _ALIGN)
+    f.write(_MAGIC + len(text).to_bytes(4, 'little') + text)
+
+
+class Writer:
+    """Appends raw waveform frames to an archive file.
+
+    An existing archive is appended to if its format and points match. A
+    frame left incomplete at its end, eg. by a crash while writing, is cut
+    off first, so the frames appended stay aligned.
+
+    :param path: The archive file
+    :param points: The maximum number of points per frame
+    :param codes: The dtype of the codes, eg. np.uint8 for BYTE or '<u2' for WORD
+    :param format: The waveform format the codes were read in
+    """
+
+    def __init__(self, path: str, points: int, codes=np.uint8, format: str = 'BYTE'):
+        self.path = path
+        header = {'version': _VERSION, 'format': format, 'codes': np.dtype(codes).str, 'points': points}
+
+        self.dtype = recordType(codes, points)
+
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size > 0:
+            with open(path, 'rb') as f:
+                existing, offset = _readHeader(f)
+            if existing != header:
+                raise ValueError(f'{path} holds {existing}, not {header}')
+            partial = (size - offset) % self.dtype.itemsize
+            if partial:
+                os.truncate(path, size - partial)
+
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            _writeHeader(self.f, header)
+
+        self.points = points
+        self.count = 0
+        # one record reused for every frame, the codes can be read straight into it
+        self.record = np.zeros(1, dtype=self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def codes(self) -> np.ndarray:
+        """The codes of the record buffer, to read the next frame into before commit()."""
+        return self.record['codes'][0]
+
+    def append(self, codes: np.ndarray, pream: osc.Preamble, channel: int = 0, timestamp: float = None) -> None:
+        """Appends one frame.
+
+        :param codes: The raw codes of the frame
+        :param pream: The preamble of the frame
+        :param channel: The channel the frame was read from
+        :param timestamp: The acquisition time in seconds since the epoch. If None, the current time
+        """
+        n = len(codes)
+        if n > self.points:
+            raise ValueError(f'Frame of {n} points does not fit {self.points}')
+        self.codes[:n] = codes
+        self.commit(pream, channel, timestamp, n)
+
+    def commit(self, pream: osc.Preamble, channel: int = 0, timestamp: float = None, points: int = None) -> None:
+        """Appends the frame held in the codes buffer.
+
+        :param pream: The preamble of the frame
+        :param channel: The channel the frame was read from
+        :param timestamp: The acquisition time in seconds since the epoch. If None, the current time
+        :param points: The number of valid points. If None, the preamble points
+        """
+        r = self.record[0]
+        r['timestamp'] = _time.time() if timestamp is None else timestamp
+        r['channel'] = channel
+        r['type'] = int(pream.type)
+        r['points'] = pream.points if points is None else points
+        r['xinc'], r['xorg'], r['xref'] = pream.xinc, pream.xorg, pream.xref
+        r['yinc'], r['yorg'], r['yref'] = pream.yinc, pream.yorg, pream.yref
+        self.f.write(self.record.data)
+        self.count += 1
+
+    def flush(self) -> None:
+        """Flushes the appended frames to the file, so a Reader can see them."""
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class Reader:
+    """Reads an archive through a memory map.
+
+    Only the frames that are accessed are paged in. A frame that was being
+    written when the file was opened is left out.
+
+    :param path: The archive file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, offset = _readHeader(f)
+
+        self.format = self.header['format']
+        self.dtype = recordType(self.header['codes'], self.header['points'])
+        count = (os.path.getsize(path) - offset) // self.dtype.itemsize
+
+        if count > 0:
+            self.records = np.memmap(path, dtype=self.dtype, mode='r', offset=offset, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def codes(self) -> np.ndarray:
+        """The raw codes of all frames, a (frames, points) memmap view."""
+        return self.records['codes']
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.records['timestamp']
+
+    @property
+    def channels(self) -> np.ndarray:
+        return self.records['channel']
+
+    def preamble(self, index: int) -> osc.Preamble:
+        """The preamble of one frame.
+
+        :param index: The frame index
+        :return: A Preamble object
+        """
+        r = self.records[index]
+        return osc.Preamble(self.format, str(r['type']), int(r['points']), float(r['xinc']), float(r['xorg']),
+                            float(r['xref']), float(r['yinc']), float(r['yorg']), float(r['yref']))
+
+    def time(self, index: int) -> osc.TimeBase:
+        """The time axis of one frame.
+
+        :param index: The frame index
+        :return: A TimeBase, use np.asarray to materialize it
+        """
+        return osc.TimeBase.fromPreamble(self.preamble(index))
+
+    def volts(self, index=slice(None), out: np.ndarray = None, dtype=np.float64) -> np.ndarray:
+        """Scales frames to volts.
+
+        Points beyond the length of a shorter frame are not meaningful.
+
+        :param index: A frame index, slice, or array of indices
+        :param out: An array to scale into. If None, a new array is returned
+        :param dtype: The dtype of the new array, eg. np.float32
+        :return: The voltages, shaped (points,) for one frame or (frames, points)
+        """
+        records = self.records[index]
+        codes = records['codes']
+        yref = records['yref'][..., np.newaxis]
+        yinc = records['yinc'][..., np.newaxis]
+        yorg = records['yorg'][..., np.newaxis]
+
+        if out is None:
+            out = np.empty(codes.shape, dtype=dtype)
+        np.subtract(codes, yref, out=out, dtype=out.dtype)
+        out *= yinc
+        out += yorg
+        return out
+
+    def close(self) -> None:
+        # the map is released once views handed out are gone as well
+        self.records = np.zeros(0, dtype=self.dtype)
+
+
+def capture(inst, path: str, channels: int | list[int], count: int, points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst') -> int:
+    """Acquires frames and appends their raw codes to an archive.
+
+    Each channel is downloaded straight into the record that is written to
+    the file, so no voltage arrays are created. The records are sized from
+    the first preambles. If the record length changes to more points than
+    that during the capture, the capture stops with ValueError and the frames
+    written so far are kept. A shorter record is archived with its own
+    preamble.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    :param path: The archive file, appended to if it exists
+    :param channels: The channel to read eg. 1, or a list of channels eg. [1, 2]
+    :param count: The number of acquisitions
+    :param points: The number of points to read. If 0, read all points
+    :param runAfter: Run the oscilloscope when done
+    :param debug: Print debug messages
+    :param format: The waveform format, 'BYTE' (8-bit) or 'WORD' (16-bit)
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :return: The number of frames written
+    """
+
+    format = osc._formatName(format)
+    if format == 'ASCii':
+        raise ValueError('The archive stores binary codes, use BYTE or WORD')
+
+    if isinstance(channels, int):
+        channels = [channels]
+
+    digitize = ':DIGitize ' + ', '.join(f'CHANnel{channel}' for channel in channels)
+
+    inst.write(':TIMebase:MODE MAIN')
+    osc._writeFormat(inst, format, byteOrder)
+    inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        inst.write(f':WAVeform:POINts {points}')
+    else:
+        inst.write(':WAVeform:POINts MAXimum')
+
+    inst.write(digitize)
+
+    preams = []
+    for channel in channels:
+        inst.write(f':WAVeform:SOURce CHANnel{channel}')
+        preams.append(osc._cachedPreamble(inst, channel, format, points, debug, False))
+
+    writer = Writer(path, max(p.points for p in preams), osc._codeType(format, byteOrder), format)
+    try:
+        for frame in range(count):
+            if frame > 0:
+                inst.write(digitize)
+            timestamp = _time.time()
+
+            for i, channel in enumerate(channels):
+                osc._log(f'Reading channel {channel}', debug)
+                inst.write(f':WAVeform:SOURce CHANnel{channel}')
+                inst.write(':WAVeform:DATA?')
+                try:
+                    data = osc._readWaveData(inst, format, byteOrder, debug, writer.codes)
+                except BlockSizeError as e:
+                    # the block was drained, the stale preamble must not be used again
+                    osc.clearPreambleCache(inst, channel)
+                    grown = e.length // writer.codes.itemsize
+                    raise ValueError(f'Channel {channel} now records {grown} points, the archive holds {writer.points}') from e
+                if len(data) != preams[i].points:
+                    preams[i] = osc._cachedPreamble(inst, channel, format, points, debug, True)
+                writer.commit(preams[i], channel, timestamp, len(data))
+    finally:
+        writer.close()
+        if runAfter:
+            inst.write(':RUN')
+
+    return writer.count
@@ -1,6 +1,15 @@
-import numpy as np
+import threading
+import time as _time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
 
+import numpy as np
+
+from .. import status
+from ..block import BlockSizeError, data_view, parse_header
+
 
 @dataclass
 class Preamble:
@@ -28,6 +37,130 @@ class Preamble:
     yref: float
 
 
+@dataclass(frozen=True)
+class TimeBase:
+    """A lazy time axis, fully defined by three preamble values.
+
+    It stands in for the time array returned by the readers. len(), indexing,
+    slicing and np.asarray() work as on the array, but values are only
+    computed for the samples requested.
+
+    :param points: The number of points
+    :param xinc: The x increment
+    :param xorg: The x origin
+    :param xref: The x reference
+    """
+
+    points: int
+    xinc: float
+    xorg: float
+    xref: float = 0.0
+
+    @classmethod
+    def fromPreamble(cls, pream: Preamble) -> 'TimeBase':
+        """Creates the time axis described by a preamble.
+
+        :param pream: A Preamble object
+        :return: A TimeBase object
+        """
+        return cls(pream.points, pream.xinc, pream.xorg, pream.xref)
+
+    def __len__(self) -> int:
+        return self.points
+
+    @property
+    def shape(self) -> tuple[int]:
+        return (self.points,)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return float(self.indexToTime(range(self.points)[key]))
+        if isinstance(key, slice):
+            r = range(self.points)[key]
+            return self.indexToTime(np.arange(r.start, r.stop, r.step))
+        return self.indexToTime(np.arange(self.points)[key])
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        t = self.indexToTime(np.arange(self.points))
+        return t if dtype is None else t.astype(dtype)
+
+    def indexToTime(self, index):
+        """Converts sample indices to times.
+
+        :param index: A sample index or an array of indices
+        :return: The time in seconds
+        """
+        return (index - self.xref) * self.xinc + self.xorg
+
+    def timeToIndex(self, time):
+        """Converts times to the nearest sample indices.
+
+        :param time: A time in seconds or an array of times
+        :return: The sample index, which may lie outside the record
+        """
+        index = np.rint((np.asarray(time) - self.xorg) / self.xinc + self.xref).astype(np.int64)
+        return int(index) if index.ndim == 0 else index
+
+
+@dataclass
+class WaveformFrame:
+    """The raw codes of one channel together with the preamble to scale them.
+
+    Returned by the read functions with raw=True. The codes stay 8 or 16-bit
+    integers and are only scaled to volts when volts() is called.
+
+    :param channel: The channel the frame was read from
+    :param codes: The raw BYTE or WORD codes
+    :param preamble: The preamble of the channel
+    """
+
+    channel: int
+    codes: np.ndarray
+    preamble: Preamble
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def volts(self, out: np.ndarray = None, dtype=np.float64) -> np.ndarray:
+        """Scales the codes to volts.
+
+        :param out: An array to scale into, shaped like codes, eg. a column of a larger array. If None, a new array is returned
+        :param dtype: The dtype of the new array, eg. np.float32
+        :return: The voltage array
+        """
+        if out is None:
+            out = np.empty(self.codes.shape, dtype=dtype)
+        np.subtract(self.codes, self.preamble.yref, out=out, dtype=out.dtype)
+        out *= self.preamble.yinc
+        out += self.preamble.yorg
+        return out
+
+    def time(self, lazyTime: bool = False) -> np.ndarray | TimeBase:
+        """The time axis of the frame.
+
+        :param lazyTime: Return a TimeBase instead of materializing the time array
+        :return: The time array, or a TimeBase
+        """
+        return _timeAxis(self.preamble, lazyTime)
+
+
+@dataclass
+class Segments(WaveformFrame):
+    """The raw codes of every segment of a segmented acquisition of one channel.
+
+    Returned by readSegments. All segments share the preamble, so volts()
+    scales them all at once and time() is the axis of each segment relative
+    to its own trigger.
+
+    :param channel: The channel the segments were read from
+    :param codes: The raw BYTE or WORD codes, shaped (segments, points)
+    :param preamble: The preamble of the channel
+    :param timestamps: The trigger time of each segment in seconds, relative to the first segment
+    """
+
+    timestamps: np.ndarray
+
+
 def getPreamble(inst, debug: bool = False) -> Preamble:
     """Reads the preamble from the oscilloscope.
 
@@ -37,7 +170,67 @@ def getPreamble(inst, debug: bool = False) -> Preamble:
 
     """
 
-    peram = inst.query(':WAVeform:PREamble?')
+    return _parsePreamble(inst.query(':WAVeform:PREamble?'), debug)
+
+
+async def getPreambleAsync(inst, debug: bool = False) -> Preamble:
+    """Reads the preamble from the oscilloscope using an async instrument.
+
+    :param inst: The scpi.AsyncInstrument object
+    :param debug: Print debug messages
+    :return: A Preamble object
+
+    """
+
+    return _parsePreamble(await inst.query(':WAVeform:PREamble?'), debug)
+
+
+# preambles per instrument, keyed by (channel, format, points)
+_preambles = weakref.WeakKeyDictionary()
+
+
+def clearPreambleCache(inst, channel: int = None) -> None:
+    """Forgets the cached preambles of the oscilloscope.
+
+    The setters in this module clear the cache themselves. Call this after
+    changing the timebase or a channel directly with inst.write.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    :param channel: Only forget the preambles of this channel. If None, forget all
+    """
+
+    cache = _preambles.get(inst)
+    if cache is None:
+        return
+
+    if channel is None:
+        cache.clear()
+    else:
+        for key in [key for key in cache if key[0] == channel]:
+            del cache[key]
+
+
+def _lookupPreamble(inst, key: tuple, refresh: bool) -> Preamble | None:
+    if refresh:
+        return None
+    return _preambles.get(inst, {}).get(key)
+
+
+def _storePreamble(inst, key: tuple, pream: Preamble) -> Preamble:
+    _preambles.setdefault(inst, {})[key] = pream
+    return pream
+
+
+def _cachedPreamble(inst, channel: int, format: str, points: int, debug: bool, refresh: bool) -> Preamble:
+    # the waveform source must already be set to the channel
+    key = (channel, format, points)
+    pream = _lookupPreamble(inst, key, refresh)
+    if pream is None:
+        pream = _storePreamble(inst, key, getPreamble(inst, debug))
+    return pream
+
+
+def _parsePreamble(peram: str, debug: bool) -> Preamble:
     peram = peram.split(',')
     _log(peram, debug)
 
@@ -61,62 +254,146 @@ def _read_large_raw_bytes(inst, debug) -> bytes:
     return data
 
 
-def _read_large_data_bytes_np(inst, debug) -> bytes:
+def _read_large_data_bytes_np(inst, debug, out: np.ndarray = None) -> np.ndarray:
+    if hasattr(inst, 'read_block'):
+        data = np.frombuffer(inst.read_block(out), dtype=np.uint8)
+        _log(len(data), debug)
+        return data
+
     chunk_size = 1024
     data = inst.read_raw(chunk_size)
-    np.frombuffer(data[10:], dtype=np.uint8)
-    header = data[2:10].decode('utf-8')
-    data = np.frombuffer(data[10:], dtype=np.uint8)
-    _log(header, debug)
+    header = parse_header(data)
+    while header is None:
+        data += inst.read_raw(chunk_size)
+        header = parse_header(data)
 
-    hpoints = int(header)
+    start, hpoints = header
+    _log(hpoints, debug)
 
-    while len(data) < hpoints:
-        data = np.append(data, np.frombuffer(
-            inst.read_raw(chunk_size), dtype=np.uint8))
+    # allocate once and copy each chunk into place
+    try:
+        block = np.asarray(data_view(out, hpoints))
+    except BlockSizeError:
+        remaining = start + hpoints + 1 - len(data)
+        while remaining > 0:
+            remaining -= len(inst.read_raw(max(chunk_size, remaining)))
+        raise
+    received = min(len(data) - start, hpoints)
+    block[:received] = memoryview(data)[start:start + received]
 
-    return data[:-1]
+    while received < hpoints:
+        # request one extra byte so the terminator is consumed with the data
+        data = inst.read_raw(max(chunk_size, hpoints - received + 1))
+        n = min(len(data), hpoints - received)
+        block[received:received + n] = memoryview(data)[:n]
+        received += n
 
+    return block
 
-def _readWaveDate(inst, channel: int, points: int, debug: bool = False) -> np.ndarray:
 
-    inst.query('*OPC?')
-    inst.write(f':WAVeform:SOURce CHANnel{channel}')
-    inst.query('*OPC?')
-    _log('Reading channel ' + str(channel), debug)
+def _formatName(format: str) -> str:
+    name = format.upper()
+    if name.startswith('ASC'):
+        return 'ASCii'
+    if name not in ('BYTE', 'WORD'):
+        raise ValueError(f'Unsupported waveform format {format}')
+    return name
 
-    inst.write(':WAVeform:FORMat BYTE')
-    inst.write(':WAVeform:POINts:MODE MAXimum')
 
-    _log('Reading points', debug)
+def _writeFormat(inst, format: str, byteOrder: str) -> None:
+    inst.write(f':WAVeform:FORMat {format}')
+    if format == 'WORD':
+        inst.write(f':WAVeform:BYTeorder {byteOrder}')
 
-    if points > 0:
-        inst.write(f':WAVeform:POINts {points}')
-    else:
-        inst.write(':WAVeform:POINts MAXimum')
 
-    inst.query('*OPC?')
+def _codeType(format: str, byteOrder: str) -> np.dtype:
+    if format == 'WORD':
+        return np.dtype('<u2' if byteOrder.upper().startswith('LSB') else '>u2')
+    return np.dtype(np.uint8)
 
-    _log('Reading data', debug)
 
-    inst.write(':WAVeform:DATA?')
-    data = _read_large_data_bytes_np(inst, debug)
+def _checkRaw(format: str, raw: bool) -> None:
+    if raw and format == 'ASCii':
+        raise ValueError('raw needs the binary BYTE or WORD format')
 
-    return data
 
+def _decode(block, format: str, byteOrder: str) -> np.ndarray:
+    # binary formats are viewed in place, ASCii is parsed in one vectorized pass
+    if format == 'ASCii':
+        return np.fromstring(bytes(block), dtype=np.float64, sep=',')
+    return np.frombuffer(block, dtype=_codeType(format, byteOrder))
 
-def readChannels(inst, channels: list[int], points: int = 0, runAfter: bool = True, debug: bool = False) -> tuple[np.ndarray, np.ndarray]:
+
+def _readWaveData(inst, format: str, byteOrder: str, debug: bool, out: np.ndarray = None) -> np.ndarray:
+    # returns the raw codes for BYTE and WORD, and volts for ASCii
+    if out is not None:
+        out = out.view(np.uint8)
+    return _decode(_read_large_data_bytes_np(inst, debug, out), format, byteOrder)
+
+
+def _readFrame(inst, channel: int, format: str, byteOrder: str, points: int, debug: bool, pream: Preamble, out: np.ndarray = None) -> tuple[np.ndarray, Preamble]:
+    # reads the waveform of the current source. A record that no longer matches
+    # the cached preamble, eg. after a direct inst.write, gets its preamble again
+    inst.write(':WAVeform:DATA?')
+    try:
+        data = _readWaveData(inst, format, byteOrder, debug, out)
+    except BlockSizeError:
+        inst.write(':WAVeform:DATA?')
+        data = _readWaveData(inst, format, byteOrder, debug)
+    if len(data) != pream.points:
+        _log(f'Channel {channel} has {len(data)} points, not {pream.points}, reading the preamble again', debug)
+        pream = _cachedPreamble(inst, channel, format, points, debug, True)
+    return data, pream
+
+
+def _toVolts(data: np.ndarray, pream: Preamble, format: str) -> np.ndarray:
+    if format == 'ASCii':
+        return data
+    return (data-pream.yref) * pream.yinc + pream.yorg
+
+
+def _timeAxis(pream: Preamble, lazyTime: bool):
+    if lazyTime:
+        return TimeBase.fromPreamble(pream)
+    return (np.arange(0, pream.points, 1)-pream.xref) * pream.xinc + pream.xorg
+
+
+def _toVoltsInto(data: np.ndarray, pream: Preamble, format: str, out: np.ndarray) -> None:
+    # scale straight into a preallocated (possibly strided) output in its own dtype
+    if len(data) != len(out):
+        raise ValueError(f'Waveform of {len(data)} points does not match the {len(out)} points of the output')
+    if format == 'ASCii':
+        out[...] = data
+        return
+    np.subtract(data, pream.yref, out=out, dtype=out.dtype)
+    out *= pream.yinc
+    out += pream.yorg
+
+
+def readChannels(inst, channels: list[int], points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', dtype=np.float64, lazyTime: bool = False, refreshPreamble: bool = False, raw: bool = False) -> tuple[np.ndarray, np.ndarray]:
     """Reads multiple channels from the oscilloscope.
 
+    The format and points are configured once for all channels. Each channel
+    is scaled with its own preamble straight into the output array.
+
     :param inst: The instrument object from pyscpi or pyvisa
     :param channels: A list of channels to read eg. [1, 2]
     :param points: The number of points to read. If 0, read all points
     :param runAfter: Run the oscilloscope after reading
     :param debug: Print debug messages
-    :return: A NumPy tuple of time and voltage arrays
+    :param format: The waveform format, 'BYTE' (8-bit), 'WORD' (16-bit) or 'ASCii'
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param dtype: The dtype of the voltage array, eg. np.float32 to halve its size
+    :param lazyTime: Return a TimeBase instead of materializing the time array
+    :param refreshPreamble: Query the preamble even if it is cached
+    :param raw: Return WaveformFrame objects holding the raw codes instead of volts
+    :return: A NumPy tuple of time and voltage arrays, or a list of WaveformFrame objects if raw
 
     """
 
+    format = _formatName(format)
+    _checkRaw(format, raw)
+
     inst.write(':TIMebase:MODE MAIN')
 
     channelCommand = ''
@@ -129,30 +406,49 @@ def readChannels(inst, channels: list[int], points: int = 0, runAfter: bool = Tr
 
     inst.write(f':DIGitize {channelCommand}')
 
-    inst.write(f':WAVeform:SOURce CHANnel{channels[0]}')
+    _writeFormat(inst, format, byteOrder)
+    inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        inst.write(f':WAVeform:POINts {points}')
+    else:
+        inst.write(':WAVeform:POINts MAXimum')
 
-    pream = getPreamble(inst, debug)
+    status.complete(inst)
 
-    allData = np.empty([pream.points, len(channels)])
+    voltCH = None
+    frames = []
 
-    for i in range(len(channels)):
-        _log(f'Reading channel {channels[i]}', debug)
-        data = _readWaveDate(inst, channels[i], points)
-        if len(data) != (pream.points):
-            print('ERROR: points mismatch, please investigate')
-        allData[:, i] = data
+    for i, channel in enumerate(channels):
+        _log(f'Reading channel {channel}', debug)
+        inst.write(f':WAVeform:SOURce CHANnel{channel}')
+        pream = _cachedPreamble(inst, channel, format, points, debug, refreshPreamble)
 
-    voltCH = (allData-pream.yref) * pream.yinc + pream.yorg
+        if raw:
+            if voltCH is None:
+                voltCH = np.empty([len(channels), pream.points], dtype=_codeType(format, byteOrder))
+            data, pream = _readFrame(inst, channel, format, byteOrder, points, debug, pream, voltCH[i])
+            frames.append(WaveformFrame(channel, data, pream))
+            continue
 
-    time = (np.arange(0, pream.points, 1)-pream.xref) * pream.xinc + pream.xorg
+        data, pream = _readFrame(inst, channel, format, byteOrder, points, debug, pream)
+
+        if voltCH is None:
+            voltCH = np.empty([pream.points, len(channels)], dtype=dtype)
+            time = _timeAxis(pream, lazyTime)
+
+        _toVoltsInto(data, pream, format, voltCH[:, i])
 
     if runAfter:
         inst.write(':RUN')
 
+    if raw:
+        return frames
+
     return time, voltCH
 
 
-def readSingleChannel(inst, channel: int, points: int = 0, runAfter: bool = True, debug: bool = False) -> tuple[np.ndarray, np.ndarray]:
+def readSingleChannel(inst, channel: int, points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', lazyTime: bool = False, refreshPreamble: bool = False, raw: bool = False) -> tuple[np.ndarray, np.ndarray]:
     """Reads a single channel from the oscilloscope.
 
     :param inst: The instrument object from pyscpi or pyvisa
@@ -160,15 +456,23 @@ def readSingleChannel(inst, channel: int, points: int = 0, runAfter: bool = True
     :param points: The number of points to read. If 0, read all points
     :param runAfter: Run the oscilloscope after reading
     :param debug: Print debug messages
-    :return: A NumPy tuple of time and voltage arrays
+    :param format: The waveform format, 'BYTE' (8-bit), 'WORD' (16-bit) or 'ASCii'
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param lazyTime: Return a TimeBase instead of materializing the time array
+    :param refreshPreamble: Query the preamble even if it is cached
+    :param raw: Return a WaveformFrame holding the raw codes instead of volts
+    :return: A NumPy tuple of time and voltage arrays, or a WaveformFrame if raw
 
     """
 
+    format = _formatName(format)
+    _checkRaw(format, raw)
+
     inst.write(':TIMebase:MODE MAIN')
 
     inst.write(f':DIGitize CHANnel{channel}')
     inst.write(f':WAVeform:SOURce CHANnel{channel}')
-    inst.write(':WAVeform:FORMat BYTE')
+    _writeFormat(inst, format, byteOrder)
     inst.write(':WAVeform:POINts:MODE MAXimum')
 
     if points > 0:
@@ -176,22 +480,22 @@ def readSingleChannel(inst, channel: int, points: int = 0, runAfter: bool = True
     else:
         inst.write(':WAVeform:POINts MAXimum')
 
-    inst.query('*OPC?')
+    status.complete(inst)
 
-    pream = getPreamble(inst, debug)
+    pream = _cachedPreamble(inst, channel, format, points, debug, refreshPreamble)
 
     _log('Reading data', debug)
 
-    inst.write(':WAVeform:DATA?')
-
-    data = _read_large_data_bytes_np(inst, debug)
+    data, pream = _readFrame(inst, channel, format, byteOrder, points, debug, pream)
 
-    if len(data) != (pream.points):
-        print('ERROR: points mismatch, please investigate')
+    if raw:
+        if runAfter:
+            inst.write(':RUN')
+        return WaveformFrame(channel, data, pream)
 
-    voltCH = (data-pream.yref) * pream.yinc + pream.yorg
+    voltCH = _toVolts(data, pream, format)
 
-    time = (np.arange(0, pream.points, 1)-pream.xref) * pream.xinc + pream.xorg
+    time = _timeAxis(pream, lazyTime)
 
     if runAfter:
         inst.write(':RUN')
@@ -199,14 +503,456 @@ def readSingleChannel(inst, channel: int, points: int = 0, runAfter: bool = True
     return time, voltCH
 
 
+def stream(inst, channels: int | list[int], points: int = 0, count: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', dtype=np.float64, lazyTime: bool = False, refreshPreamble: bool = False, raw: bool = False):
+    """Yields waveform frames continuously.
+
+    The oscilloscope is configured and the preamble read once. After a frame
+    has been downloaded the next acquisition is armed straight away, so the
+    oscilloscope digitizes while the frame is scaled and consumed. With
+    several channels the next acquisition is armed only once every channel
+    of the frame has been downloaded, as :DIGitize would discard the channels
+    not read yet. Arming therefore overlaps the scaling and the consumer, but
+    not the download of the channels.
+
+    Frames are written into two alternating slots that are reused, so the
+    arrays of a frame, or the codes of its WaveformFrame objects, are
+    overwritten two frames later, when the frame after next is downloaded.
+    Copy a frame to keep it longer.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    :param channels: The channel to read eg. 1, or a list of channels eg. [1, 2]
+    :param points: The number of points to read. If 0, read all points
+    :param count: The number of frames to yield. If 0, stream until the generator is closed
+    :param runAfter: Run the oscilloscope when the stream ends
+    :param debug: Print debug messages
+    :param format: The waveform format, 'BYTE' (8-bit), 'WORD' (16-bit) or 'ASCii'
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param dtype: The dtype of the voltage arrays, eg. np.float32
+    :param lazyTime: Return a TimeBase instead of materializing the time array
+    :param refreshPreamble: Query the preamble even if it is cached
+    :param raw: Return WaveformFrame objects holding the raw codes instead of volts
+    :return: A generator of NumPy tuples of time and voltage arrays, shaped as readSingleChannel or readChannels, or of WaveformFrame objects if raw
+
+    """
+
+    format = _formatName(format)
+    _checkRaw(format, raw)
+
+    single = isinstance(channels, int)
+    if single:
+        channels = [channels]
+
+    digitize = ':DIGitize ' + ', '.join(f'CHANnel{channel}' for channel in channels)
+
+    inst.write(':TIMebase:MODE MAIN')
+    _writeFormat(inst, format, byteOrder)
+    inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        inst.write(f':WAVeform:POINts {points}')
+    else:
+        inst.write(':WAVeform:POINts MAXimum')
+
+    inst.write(digitize)
+
+    preams = []
+    for channel in channels:
+        inst.write(f':WAVeform:SOURce CHANnel{channel}')
+        preams.append(_cachedPreamble(inst, channel, format, points, debug, refreshPreamble))
+
+    pream = preams[0]
+
+    time = _timeAxis(pream, lazyTime)
+
+    codes = np.empty([2, len(channels), pream.points], dtype=_codeType(format, byteOrder))
+    volt = None if raw else np.empty([2, pream.points, len(channels)], dtype=dtype)
+
+    frame = 0
+    try:
+        while count <= 0 or frame < count:
+            slot = frame % 2
+
+            data = []
+            for i, channel in enumerate(channels):
+                _log(f'Reading channel {channel}', debug)
+                inst.write(f':WAVeform:SOURce CHANnel{channel}')
+                buffer = None if format == 'ASCii' else codes[slot, i]
+                block, preams[i] = _readFrame(inst, channel, format, byteOrder, points, debug, preams[i], buffer)
+                data.append(block)
+
+            if preams[0] is not pream:
+                # the record length changed, the buffers follow it from this frame on
+                pream = preams[0]
+                time = _timeAxis(pream, lazyTime)
+                codes = np.empty([2, len(channels), pream.points], dtype=codes.dtype)
+                volt = None if raw else np.empty([2, pream.points, len(channels)], dtype=dtype)
+
+            frame += 1
+            if count <= 0 or frame < count:
+                # arm the next frame before this one is scaled and consumed
+                inst.write(digitize)
+
+            if raw:
+                frames = [WaveformFrame(channel, data[i], preams[i]) for i, channel in enumerate(channels)]
+                yield frames[0] if single else frames
+                continue
+
+            out = volt[slot]
+            for i in range(len(channels)):
+                _toVoltsInto(data[i], preams[i], format, out[:, i])
+
+            yield time, (out[:, 0] if single else out)
+    finally:
+        if runAfter:
+            inst.write(':RUN')
+
+
+def readSegments(inst, channels: int | list[int], segments: int, points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', timeout: float = None) -> Segments | list[Segments]:
+    """Captures a burst of triggers in segmented memory and downloads every segment.
+
+    The oscilloscope is armed once and fills the segments on its own, one per
+    trigger, so no trigger is missed to a host round trip. The segments are
+    then downloaded into one preallocated array per channel. The acquisition
+    mode is restored afterwards.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    :param channels: The channel to read eg. 1, or a list of channels eg. [1, 2]
+    :param segments: The number of segments to capture
+    :param points: The number of points per segment. If 0, read all points
+    :param runAfter: Run the oscilloscope after reading
+    :param debug: Print debug messages
+    :param format: The waveform format, 'BYTE' (8-bit) or 'WORD' (16-bit)
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param timeout: The maximum time to wait for the segments in seconds, when status.enable was called
+    :return: A Segments object, or a list of them if channels is a list
+
+    """
+
+    format = _formatName(format)
+    if format == 'ASCii':
+        raise ValueError('Segments are read as raw codes, use BYTE or WORD')
+
+    single = isinstance(channels, int)
+    if single:
+        channels = [channels]
+
+    mode = inst.query(':ACQuire:MODE?').strip()
+
+    # the segment length differs from a normal acquisition
+    clearPreambleCache(inst)
+
+    inst.write(':TIMebase:MODE MAIN')
+    inst.write(':ACQuire:MODE SEGMented')
+    inst.write(f':ACQuire:SEGMented:COUNt {segments}')
+    _writeFormat(inst, format, byteOrder)
+    inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        inst.write(f':WAVeform:POINts {points}')
+    else:
+        inst.write(':WAVeform:POINts MAXimum')
+
+    try:
+        inst.write(':DIGitize ' + ', '.join(f'CHANnel{channel}' for channel in channels))
+        status.complete(inst, timeout)
+
+        count = int(inst.query(':WAVeform:SEGMented:COUNt?'))
+        _log(f'{count} segments acquired', debug)
+
+        inst.write(':ACQuire:SEGMented:INDex 1')
+        preams = []
+        for channel in channels:
+            inst.write(f':WAVeform:SOURce CHANnel{channel}')
+            preams.append(getPreamble(inst, debug))
+
+        codeType = _codeType(format, byteOrder)
+        codes = [np.empty([count, pream.points], dtype=codeType) for pream in preams]
+        timestamps = np.empty(count)
+
+        for index in range(count):
+            _log(f'Reading segment {index + 1}', debug)
+            inst.write(f':ACQuire:SEGMented:INDex {index + 1}')
+            timestamps[index] = float(inst.query(':WAVeform:SEGMented:TTAG?'))
+
+            for i, channel in enumerate(channels):
+                if len(channels) > 1:
+                    inst.write(f':WAVeform:SOURce CHANnel{channel}')
+                inst.write(':WAVeform:DATA?')
+                data = _readWaveData(inst, format, byteOrder, debug, codes[i][index])
+                if len(data) != preams[i].points:
+                    raise ValueError(f'Segment {index + 1} has {len(data)} points, not {preams[i].points}')
+    finally:
+        inst.write(f':ACQuire:MODE {mode}')
+        clearPreambleCache(inst)
+        if runAfter:
+            inst.write(':RUN')
+
+    result = [Segments(channel, codes[i], preams[i], timestamps) for i, channel in enumerate(channels)]
+    return result[0] if single else result
+
+
+@dataclass
+class Acquisition:
+    """The result of one instrument in a concurrent acquisition.
+
+    :param inst: The instrument object
+    :param channels: The channels read from this instrument
+    :param time: The time array, or a TimeBase
+    :param volt: The voltage array, as returned by readSingleChannel or readChannels
+    :param armed: When :DIGitize was sent, in seconds relative to the earliest instrument
+    :param elapsed: The time taken to digitize and download, in seconds
+    """
+
+    inst: object
+    channels: list[int]
+    time: np.ndarray | TimeBase
+    volt: np.ndarray
+    armed: float
+    elapsed: float
+
+
+def readInstruments(insts: list, channels: list, points: int = 0, runAfter: bool = True, debug: bool = False, lazyTime: bool = False) -> list[Acquisition]:
+    """Digitizes and reads several oscilloscopes concurrently.
+
+    Each instrument is driven from its own thread. All threads are released
+    together, so the acquisitions are armed within a few milliseconds of each
+    other and the downloads overlap.
+
+    :param insts: A list of instrument objects from pyscpi or pyvisa
+    :param channels: The channels to read, either one list for all instruments eg. [1, 2] or one list per instrument eg. [[1], [1, 2]]
+    :param points: The number of points to read. If 0, read all points
+    :param runAfter: Run the oscilloscopes after reading
+    :param debug: Print debug messages
+    :param lazyTime: Return a TimeBase instead of materializing the time arrays
+    :return: A list of Acquisition objects in the order of insts
+
+    """
+
+    if not insts:
+        return []
+
+    if len(channels) > 0 and not isinstance(channels[0], (list, tuple)):
+        channels = [channels] * len(insts)
+
+    if len(channels) != len(insts):
+        raise ValueError('channels must be a list per instrument')
+
+    barrier = threading.Barrier(len(insts))
+
+    def acquire(inst, chans):
+        barrier.wait()
+        armed = _time.perf_counter()
+        if len(chans) == 1:
+            t, v = readSingleChannel(inst, chans[0], points, runAfter, debug, lazyTime=lazyTime)
+        else:
+            t, v = readChannels(inst, chans, points, runAfter, debug, lazyTime=lazyTime)
+        return armed, _time.perf_counter(), t, v
+
+    with ThreadPoolExecutor(max_workers=len(insts)) as pool:
+        futures = [pool.submit(acquire, inst, list(chans)) for inst, chans in zip(insts, channels)]
+        results = [f.result() for f in futures]
+
+    start = min(r[0] for r in results)
+
+    return [Acquisition(inst, list(chans), t, v, armed - start, done - armed)
+            for inst, chans, (armed, done, t, v) in zip(insts, channels, results)]
+
+
+async def readChannelsAsync(inst, channels: list[int], points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', dtype=np.float64, lazyTime: bool = False, refreshPreamble: bool = False, raw: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """Reads multiple channels from the oscilloscope using an async instrument.
+
+    The waveform queries of all channels are pipelined on the connection.
+
+    :param inst: The scpi.AsyncInstrument object
+    :param channels: A list of channels to read eg. [1, 2]
+    :param points: The number of points to read. If 0, read all points
+    :param runAfter: Run the oscilloscope after reading
+    :param debug: Print debug messages
+    :param format: The waveform format, 'BYTE' (8-bit), 'WORD' (16-bit) or 'ASCii'
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param dtype: The dtype of the voltage array, eg. np.float32 to halve its size
+    :param lazyTime: Return a TimeBase instead of materializing the time array
+    :param refreshPreamble: Query the preamble even if it is cached
+    :param raw: Return WaveformFrame objects holding the raw codes instead of volts
+    :return: A NumPy tuple of time and voltage arrays, or a list of WaveformFrame objects if raw
+
+    """
+
+    format = _formatName(format)
+    _checkRaw(format, raw)
+
+    channelCommand = ', '.join(f'CHANnel{channel}' for channel in channels)
+    _log(channelCommand, debug)
+
+    await inst.write(':TIMebase:MODE MAIN')
+    await inst.write(f':DIGitize {channelCommand}')
+    await inst.write(f':WAVeform:FORMat {format}')
+    if format == 'WORD':
+        await inst.write(f':WAVeform:BYTeorder {byteOrder}')
+    await inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        await inst.write(f':WAVeform:POINts {points}')
+    else:
+        await inst.write(':WAVeform:POINts MAXimum')
+
+    replies = []
+    for channel in channels:
+        await inst.write(f':WAVeform:SOURce CHANnel{channel}')
+        pream = _lookupPreamble(inst, (channel, format, points), refreshPreamble)
+        preamble = inst.query(':WAVeform:PREamble?') if pream is None else None
+        replies.append((pream, preamble, inst.query_block(':WAVeform:DATA?')))
+
+    voltCH = None
+    frames = []
+
+    for i, (pream, preamble, block) in enumerate(replies):
+        channel = channels[i]
+        _log(f'Reading channel {channel}', debug)
+        if pream is None:
+            pream = _storePreamble(inst, (channel, format, points), _parsePreamble(await preamble, debug))
+
+        data = _decode(await block, format, byteOrder)
+        if len(data) != pream.points:
+            # the record changed behind the cached preamble, the source moved on since
+            await inst.write(f':WAVeform:SOURce CHANnel{channel}')
+            pream = _storePreamble(inst, (channel, format, points), await getPreambleAsync(inst, debug))
+
+        if raw:
+            frames.append(WaveformFrame(channel, data, pream))
+            continue
+
+        if voltCH is None:
+            voltCH = np.empty([pream.points, len(channels)], dtype=dtype)
+            time = _timeAxis(pream, lazyTime)
+
+        _toVoltsInto(data, pream, format, voltCH[:, i])
+
+    if runAfter:
+        await inst.write(':RUN')
+
+    if raw:
+        return frames
+
+    return time, voltCH
+
+
+async def readSingleChannelAsync(inst, channel: int, points: int = 0, runAfter: bool = True, debug: bool = False, format: str = 'BYTE', byteOrder: str = 'LSBFirst', lazyTime: bool = False, refreshPreamble: bool = False, raw: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    """Reads a single channel from the oscilloscope using an async instrument.
+
+    :param inst: The scpi.AsyncInstrument object
+    :param channel: The channel to read
+    :param points: The number of points to read. If 0, read all points
+    :param runAfter: Run the oscilloscope after reading
+    :param debug: Print debug messages
+    :param format: The waveform format, 'BYTE' (8-bit), 'WORD' (16-bit) or 'ASCii'
+    :param byteOrder: The byte order of WORD data, 'LSBFirst' or 'MSBFirst'
+    :param lazyTime: Return a TimeBase instead of materializing the time array
+    :param refreshPreamble: Query the preamble even if it is cached
+    :param raw: Return a WaveformFrame holding the raw codes instead of volts
+    :return: A NumPy tuple of time and voltage arrays, or a WaveformFrame if raw
+
+    """
+
+    format = _formatName(format)
+    _checkRaw(format, raw)
+
+    await inst.write(':TIMebase:MODE MAIN')
+
+    await inst.write(f':DIGitize CHANnel{channel}')
+    await inst.write(f':WAVeform:SOURce CHANnel{channel}')
+    await inst.write(f':WAVeform:FORMat {format}')
+    if format == 'WORD':
+        await inst.write(f':WAVeform:BYTeorder {byteOrder}')
+    await inst.write(':WAVeform:POINts:MODE MAXimum')
+
+    if points > 0:
+        await inst.write(f':WAVeform:POINts {points}')
+    else:
+        await inst.write(':WAVeform:POINts MAXimum')
+
+    opc = inst.query('*OPC?')
+    key = (channel, format, points)
+    pream = _lookupPreamble(inst, key, refreshPreamble)
+    preamble = inst.query(':WAVeform:PREamble?') if pream is None else None
+
+    _log('Reading data', debug)
+
+    block = inst.query_block(':WAVeform:DATA?')
+
+    await opc
+    if pream is None:
+        pream = _storePreamble(inst, key, _parsePreamble(await preamble, debug))
+    data = _decode(await block, format, byteOrder)
+
+    if len(data) != pream.points:
+        # the record changed behind the cached preamble
+        pream = _storePreamble(inst, key, await getPreambleAsync(inst, debug))
+
+    if raw:
+        if runAfter:
+            await inst.write(':RUN')
+        return WaveformFrame(channel, data, pream)
+
+    voltCH = _toVolts(data, pream, format)
+
+    time = _timeAxis(pream, lazyTime)
+
+    if runAfter:
+        await inst.write(':RUN')
+
+    return time, voltCH
+
+
+async def autoScaleAsync(inst) -> None:
+    """Autoscales the oscilloscope using an async instrument.
+
+    :param inst: The scpi.AsyncInstrument object
+    """
+
+    clearPreambleCache(inst)
+    await inst.write(':AUToscale')
+    await inst.query('*OPC?')
+
+
+async def setTimeAxisAsync(inst, scale: float, position: float) -> None:
+    """Sets the time axis of the oscilloscope using an async instrument.
+
+    :param inst: The scpi.AsyncInstrument object
+    :param scale: The scale of the time axis in seconds
+    :param position: The position of the time axis from the trigger in seconds
+    """
+
+    clearPreambleCache(inst)
+    await inst.write(f':TIMebase:SCALe {scale}')
+    await inst.write(f':TIMebase:POSition {position}')
+    await inst.query('*OPC?')
+
+
+async def setChannelAxisAsync(inst, channel: int, scale: float, offset: float) -> None:
+    """Sets the channel axis (y-axis) of the oscilloscope using an async instrument.
+
+    :param inst: The scpi.AsyncInstrument object
+    :param channel: The channel to set
+    :param scale: The scale of the channel axis in volts
+    :param offset: The offset of the channel axis in volts
+    """
+
+    clearPreambleCache(inst, channel)
+    await inst.write(f':CHANnel{channel}:SCALe {scale}')
+    await inst.write(f':CHANnel{channel}:OFFSet {offset}')
+    await inst.query('*OPC?')
+
+
 def autoScale(inst) -> None:
     """Autoscales the oscilloscope.
 
     :param inst: The instrument object from pyscpi or pyvisa
     """
 
-    inst.write(f':AUToscale')
-    inst.query('*OPC?')
+    clearPreambleCache(inst)
+    with _batch(inst):
+        inst.write(f':AUToscale')
 
 
 def setTimeAxis(inst, scale: float, position: float) -> None:
@@ -217,9 +963,10 @@ def setTimeAxis(inst, scale: float, position: float) -> None:
     :param position: The position of the time axis from the trigger in seconds
     """
 
-    inst.write(f':TIMebase:SCALe {scale}')
-    inst.write(f':TIMebase:POSition {position}')
-    inst.query('*OPC?')
+    clearPreambleCache(inst)
+    with _batch(inst):
+        inst.write(f':TIMebase:SCALe {scale}')
+        inst.write(f':TIMebase:POSition {position}')
 
 
 def setChannelAxis(inst, channel: int, scale: float, offset: float) -> None:
@@ -230,9 +977,11 @@ def setChannelAxis(inst, channel: int, scale: float, offset: float) -> None:
     :param scale: The scale of the channel axis in volts
     :param offset: The offset of the channel axis in volts
     """
-    inst.write(f':CHANnel{channel}:SCALe {scale}')
-    inst.write(f':CHANnel{channel}:OFFSet {offset}')
-    inst.query('*OPC?')
+
+    clearPreambleCache(inst, channel)
+    with _batch(inst):
+        inst.write(f':CHANnel{channel}:SCALe {scale}')
+        inst.write(f':CHANnel{channel}:OFFSet {offset}')
 
 
 def setWGenOutput(inst, state: int | str) -> None:
@@ -242,8 +991,8 @@ def setWGenOutput(inst, state: int | str) -> None:
     :param state: The state to set the output to (0 or 1) or ('OFF' or 'ON')
     """
 
-    inst.write(f':WGEN:OUTPut {state}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write(f':WGEN:OUTPut {state}')
 
 
 def setWGenSin(inst, amp: float, offset: float, freq: float) -> None:
@@ -255,11 +1004,11 @@ def setWGenSin(inst, amp: float, offset: float, freq: float) -> None:
     :param freq: The frequency of the sine wave in Hz. The frequency can be adjusted from 100 mHz to 20 MHz.
     """
 
-    inst.write('WGEN:FUNCtion SINusoid')
-    inst.write(f':WGEN:VOLTage {amp}')
-    inst.write(f':WGEN:VOLTage:OFFSet {offset}')
-    inst.write(f':WGEN:FREQuency {freq}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion SINusoid')
+        inst.write(f':WGEN:VOLTage {amp}')
+        inst.write(f':WGEN:VOLTage:OFFSet {offset}')
+        inst.write(f':WGEN:FREQuency {freq}')
 
 
 def setWGenSquare(inst, v0: float, v1: float, freq: float, dutyCycle: int) -> None:
@@ -272,12 +1021,12 @@ def setWGenSquare(inst, v0: float, v1: float, freq: float, dutyCycle: int) -> No
     :param dutyCycle: The duty cycle can be adjusted from 1% to 99% up to 500 kHz. At higher frequencies, the adjustment range narrows so as not to allow pulse widths less than 20 ns.
     """
 
-    inst.write('WGEN:FUNCtion SQUare')
-    inst.write(f':WGEN:VOLTage:LOW {v0}')
-    inst.write(f':WGEN:VOLTage:HIGH {v1}')
-    inst.write(f':WGEN:FREQuency {freq}')
-    inst.write(f':WGEN:FUNCtion:SQUare:DCYCle {dutyCycle}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion SQUare')
+        inst.write(f':WGEN:VOLTage:LOW {v0}')
+        inst.write(f':WGEN:VOLTage:HIGH {v1}')
+        inst.write(f':WGEN:FREQuency {freq}')
+        inst.write(f':WGEN:FUNCtion:SQUare:DCYCle {dutyCycle}')
 
 
 def setWGenRamp(inst, v0: float, v1: float, freq: float, symmetry: int) -> None:
@@ -290,12 +1039,12 @@ def setWGenRamp(inst, v0: float, v1: float, freq: float, symmetry: int) -> None:
     :param symmetry: Symmetry represents the amount of time per cycle that the ramp waveform is rising and can be adjusted from 0% to 100%.
     """
 
-    inst.write('WGEN:FUNCtion RAMP')
-    inst.write(f':WGEN:VOLTage:LOW {v0}')
-    inst.write(f':WGEN:VOLTage:HIGH {v1}')
-    inst.write(f':WGEN:FREQuency {freq}')
-    inst.write(f':WGEN:FUNCtion:RAMP:SYMMetry {symmetry}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion RAMP')
+        inst.write(f':WGEN:VOLTage:LOW {v0}')
+        inst.write(f':WGEN:VOLTage:HIGH {v1}')
+        inst.write(f':WGEN:FREQuency {freq}')
+        inst.write(f':WGEN:FUNCtion:RAMP:SYMMetry {symmetry}')
 
 
 def setWGenPulse(inst, v0: float, v1: float, period: float, pulseWidth: float) -> None:
@@ -308,12 +1057,12 @@ def setWGenPulse(inst, v0: float, v1: float, period: float, pulseWidth: float) -
     :param pulseWidth: The pulse width can be adjusted from 20 ns to the period minus 20 ns.
     """
 
-    inst.write('WGEN:FUNCtion PULSe')
-    inst.write(f':WGEN:VOLTage:LOW {v0}')
-    inst.write(f':WGEN:VOLTage:HIGH {v1}')
-    inst.write(f':WGEN:PERiod {period}')
-    inst.write(f':WGEN:FUNCtion:PULSe:WIDTh {pulseWidth}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion PULSe')
+        inst.write(f':WGEN:VOLTage:LOW {v0}')
+        inst.write(f':WGEN:VOLTage:HIGH {v1}')
+        inst.write(f':WGEN:PERiod {period}')
+        inst.write(f':WGEN:FUNCtion:PULSe:WIDTh {pulseWidth}')
 
 
 def setWGenDC(inst, offset: float) -> None:
@@ -323,9 +1072,9 @@ def setWGenDC(inst, offset: float) -> None:
     :param offset: The offset of the DC wave in volts
     """
 
-    inst.write('WGEN:FUNCtion DC')
-    inst.write(f':WGEN:VOLTage:OFFSet {offset}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion DC')
+        inst.write(f':WGEN:VOLTage:OFFSet {offset}')
 
 
 def setWGenNoise(inst, v0: float, v1: float, offset: float) -> None:
@@ -337,10 +1086,27 @@ def setWGenNoise(inst, v0: float, v1: float, offset: float) -> None:
     :param offset: The offset of the noise wave in volts
     """
 
-    inst.write('WGEN:FUNCtion NOISe')
-    inst.write(f':WGEN:VOLTage:LOW {v0}')
-    inst.write(f':WGEN:VOLTage:HIGH {v1}')
-    inst.query('*OPC?')
+    with _batch(inst):
+        inst.write('WGEN:FUNCtion NOISe')
+        inst.write(f':WGEN:VOLTage:LOW {v0}')
+        inst.write(f':WGEN:VOLTage:HIGH {v1}')
+
+
+@contextmanager
+def _batch(inst):
+    # coalesce the writes and the closing *OPC? into one message where the
+    # backend supports it, and fall back to separate writes otherwise. With
+    # status.enable() the batch ends with '*OPC' and waits for the request
+    if hasattr(inst, 'batch'):
+        enabled = status.enabled(inst)
+        with inst.batch(opc=not enabled):
+            yield
+        # a batch joined from outside completes when the outer one does
+        if enabled and inst._batch is None:
+            status.complete(inst)
+    else:
+        yield
+        status.complete(inst)
 
 
 def _log(msg, EnableLog: bool) -> None:
@@ -0,0 +1,717 @@
+"""A local SCPI simulator of a Keysight oscilloscope.
+
+The simulator answers the commands issued by pyscpi.keysight.osc with
+synthetic waveforms, so the helpers can be exercised and benchmarked
+without hardware::
+
+    from pyscpi import scpi
+    from pyscpi.keysight import osc, sim
+
+    with sim.Server(points=62500, latency=0.001) as server:
+        inst = scpi.Instrument(*server.address)
+        t, y1 = osc.readSingleChannel(inst, 1)
+
+HislipServer serves the same simulator over HiSLIP for hislip.Instrument.
+It can also be run standalone with ``python -m pyscpi.keysight.sim --port 5025``.
+"""
+
+import argparse
+import re
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .. import hislip
+from ..block import data_view, parse_header
+from ..scpi_parse import short_header, split_message
+
+
+_FORMAT_CODES = {'BYTE': 0, 'WORD': 1, 'ASC': 4}
+
+
+class Oscilloscope:
+    """The command processor of the simulated oscilloscope.
+
+    :param points: The record length, ie. the maximum number of waveform points
+    :param channels: The number of analog channels
+    :param noise: The RMS noise added to the synthetic waveforms in volts
+    :param seed: Seed of the noise generator
+    :param digitize_time: Seconds a :DIGitize takes to complete. Other commands are processed meanwhile,
+        while *OPC? and waveform queries wait for it
+    """
+
+    def __init__(self, points: int = 62500, channels: int = 4, noise: float = 0.01, seed: int = None,
+                 digitize_time: float = 0.0):
+        self.max_points = points
+        self.num_channels = channels
+        self.noise = noise
+        self.digitize_time = digitize_time
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+        # the status enable registers survive *RST
+        self.ese = 0
+        self.sre = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """Restores the power-on state."""
+        self.timebase = {'MODE': 'MAIN', 'SCAL': 1e-3, 'POS': 0.0}
+        self.chan = {n: {'SCAL': 1.0, 'OFFS': 0.0, 'DISP': 1}
+                     for n in range(1, self.num_channels + 1)}
+        self.wgen = {'FUNC': 'SIN', 'VOLT': 1.0, 'VOLT:OFFS': 0.0, 'FREQ': 1e3,
+                     'FUNC:SQU:DCYC': 50.0, 'FUNC:RAMP:SYMM': 50.0,
+                     'FUNC:PULS:WIDT': 500e-6, 'OUTP': 1}
+        self.waveform = {'SOUR': 1, 'FORM': 'BYTE', 'POIN:MODE': 'NORM',
+                         'POIN': self.max_points, 'BYT': 'MSBF', 'UNS': 1}
+        self.acquisition = {'MODE': 'RTIM', 'SEGM:COUN': 2, 'SEGM:IND': 1}
+        self.acquired = {}
+        self.ttags = np.zeros(1)
+        self.running = True
+        self.errors = []
+        self.esr = 0
+        self.opc = False
+        self.busy_until = 0.0
+
+    def status_byte(self) -> int:
+        """The IEEE 488.2 status byte, without MAV which depends on the transport."""
+        with self.lock:
+            stb = 0x04 if self.errors else 0
+            if self._events() & self.ese:
+                stb |= 0x20
+            if stb & self.sre:
+                stb |= 0x40
+            return stb
+
+    def _events(self) -> int:
+        # *OPC sets the operation complete bit once the pending digitize has finished
+        if self.opc and time.perf_counter() >= self.busy_until:
+            self.esr |= 0x01
+            self.opc = False
+        return self.esr
+
+    def _settle(self) -> None:
+        delay = self.busy_until - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, message: str) -> bytes:
+        """Processes one program message, which may hold several ';' separated commands.
+
+        :param message: The program message without its terminator
+        :return: The response message including its terminator, or b'' if there is none
+        """
+        responses = []
+        path = ''
+        with self.lock:
+            for cmd in split_message(message):
+                header, _, args = cmd.partition(' ')
+                if not header.startswith((':', '*')) and path:
+                    header = path + ':' + header
+                if not header.startswith('*'):
+                    path = header.lstrip(':').rsplit(':', 1)[0] if ':' in header.lstrip(':') else ''
+
+                response = self._execute(short_header(header), args.strip())
+                if response is not None:
+                    responses.append(response)
+
+        if not responses:
+            return b''
+        return b';'.join(responses) + b'\n'
+
+    def _execute(self, header: str, args: str):
+        query = header.endswith('?')
+        key = header.rstrip('?')
+
+        if key == '*IDN':
+            return b'KEYSIGHT TECHNOLOGIES,DSOX1204G,SIM00000001,2.12.2019050901'
+        if key == '*RST':
+            self.reset()
+            return None
+        if key == '*OPC':
+            if query:
+                self._settle()
+                return b'1'
+            self.opc = True
+            return None
+        if key == '*WAI':
+            self._settle()
+            return None
+        if key == '*CLS':
+            self.errors = []
+            self.esr = 0
+            self.opc = False
+            return None
+        if key == '*ESR' and query:
+            esr = self._events()
+            self.esr = 0
+            return str(esr).encode()
+        if key == '*STB' and query:
+            return str(self.status_byte()).encode()
+        if key in ('*ESE', '*SRE'):
+            name = key[1:].lower()
+            if query:
+                return str(getattr(self, name)).encode()
+            setattr(self, name, int(float(args)) & 0xFF)
+            return None
+        if key == 'SYST:ERR':
+            if self.errors:
+                code, text = self.errors.pop(0)
+                return f'{code:+d},"{text}"'.encode()
+            return b'+0,"No error"'
+
+        if key in ('DIG', 'SING'):
+            sources = [int(s) for s in re.findall(r'(\d+)', args)] if args else \
+                [n for n, c in self.chan.items() if c['DISP']]
+            self._acquire(sources)
+            self.running = False
+            if self.digitize_time > 0:
+                self.busy_until = time.perf_counter() + self.digitize_time
+            return None
+        if key == 'RUN':
+            self.running = True
+            return None
+        if key == 'STOP':
+            self.running = False
+            return None
+        if key == 'AUT':
+            for c in self.chan.values():
+                c['SCAL'] = max(self._amplitude() / 4.0, 1e-3)
+                c['OFFS'] = self._offset()
+            self.timebase['SCAL'] = 1.0 / max(self.wgen['FREQ'], 1e-3) / 5.0
+            self.timebase['POS'] = 0.0
+            self.acquired = {}
+            return None
+
+        if key.startswith('ACQ:'):
+            return self._acquisitionSetting(key[4:], args, query)
+        if key == 'WAV:SEGM:COUN' and query:
+            return str(len(self.ttags) if self._segmented() and self.acquired else 0).encode()
+        if key == 'WAV:SEGM:TTAG' and query:
+            index = min(self.acquisition['SEGM:IND'], len(self.ttags)) - 1
+            return f'{self.ttags[index]:+.9E}'.encode()
+
+        if key.startswith('TIM:'):
+            return self._setting(self.timebase, key[4:], args, query)
+
+        m = re.match(r'^CHAN(\d+):(.+)$', key)
+        if m is not None:
+            n = int(m.group(1))
+            if n not in self.chan:
+                return self._error(-114, 'Header suffix out of range')
+            return self._setting(self.chan[n], m.group(2), args, query)
+
+        if key.startswith('WGEN:'):
+            return self._setting(self.wgen, key[5:], args, query)
+
+        if key == 'WAV:PRE' and query:
+            return self._preamble().encode()
+        if key == 'WAV:DATA' and query:
+            self._settle()
+            return self._data()
+        if key == 'WAV:SOUR':
+            if query:
+                return f'CHAN{self.waveform["SOUR"]}'.encode()
+            m = re.search(r'(\d+)', args)
+            if m is None or int(m.group(1)) not in self.chan:
+                return self._error(-224, 'Illegal parameter value')
+            self.waveform['SOUR'] = int(m.group(1))
+            return None
+        if key == 'WAV:POIN':
+            if query:
+                return str(self._points()).encode()
+            if short_header(args) in ('MAX', 'MAXIMUM'):
+                self.waveform['POIN'] = self.max_points
+            else:
+                self.waveform['POIN'] = int(float(args))
+            return None
+        if key.startswith('WAV:'):
+            if key == 'WAV:FORM' and not query:
+                args = short_header(args)
+                if args not in _FORMAT_CODES:
+                    return self._error(-224, 'Illegal parameter value')
+            return self._setting(self.waveform, key[4:], args, query)
+
+        return self._error(-113, 'Undefined header')
+
+    def _acquisitionSetting(self, key: str, args: str, query: bool):
+        if key not in self.acquisition:
+            return self._error(-113, 'Undefined header')
+        if query:
+            return str(self.acquisition[key]).encode()
+
+        if key == 'MODE':
+            value = short_header(args)
+            if value not in ('RTIM', 'SEGM', 'HRES', 'AVER', 'PEAK', 'ETIM'):
+                return self._error(-224, 'Illegal parameter value')
+        else:
+            value = int(float(args))
+            top = self.acquisition['SEGM:COUN'] if key == 'SEGM:IND' else self.max_points
+            if not 1 <= value <= top:
+                return self._error(-222, 'Data out of range')
+
+        self.acquisition[key] = value
+        if key != 'SEGM:IND':
+            self.acquired = {}
+            self.acquisition['SEGM:IND'] = 1
+        return None
+
+    def _setting(self, settings: dict, key: str, args: str, query: bool):
+        if query:
+            if key not in settings:
+                return self._error(-113, 'Undefined header')
+            value = settings[key]
+            return (f'{value:+.6E}' if isinstance(value, float) else str(value)).encode()
+
+        if key in ('VOLT:LOW', 'VOLT:HIGH') and settings is self.wgen:
+            low, high = self._offset() - self._amplitude() / 2, self._offset() + self._amplitude() / 2
+            if key == 'VOLT:LOW':
+                low = float(args)
+            else:
+                high = float(args)
+            settings['VOLT'] = high - low
+            settings['VOLT:OFFS'] = (high + low) / 2
+            return None
+        if key == 'PER' and settings is self.wgen:
+            settings['FREQ'] = 1.0 / float(args)
+            return None
+
+        if key not in settings:
+            return self._error(-113, 'Undefined header')
+
+        if isinstance(settings[key], float):
+            settings[key] = float(args)
+        elif isinstance(settings[key], int):
+            settings[key] = 1 if short_header(args) in ('ON', '1') else 0
+        else:
+            settings[key] = short_header(args)
+
+        if settings is not self.waveform:
+            self.acquired = {}
+        return None
+
+    def _error(self, code: int, text: str):
+        self.errors.append((code, text))
+        # command errors set CME, the others EXE
+        self.esr |= 0x20 if code > -200 else 0x10
+        return None
+
+    def _amplitude(self) -> float:
+        return self.wgen['VOLT']
+
+    def _offset(self) -> float:
+        return self.wgen['VOLT:OFFS']
+
+    def _segmented(self) -> bool:
+        return self.acquisition['MODE'] == 'SEGM'
+
+    def _record(self) -> int:
+        # segmented memory shares the record between the segments
+        if self._segmented():
+            return max(1, self.max_points // self.acquisition['SEGM:COUN'])
+        return self.max_points
+
+    def _decimation(self) -> int:
+        record = self._record()
+        requested = max(1, min(self.waveform['POIN'], record))
+        return -(-record // requested)
+
+    def _points(self) -> int:
+        return -(-self._record() // self._decimation())
+
+    def _xaxis(self, step: int = 1) -> tuple[float, float]:
+        span = 10.0 * self.timebase['SCAL']
+        xinc = span / self._record() * step
+        xorg = self.timebase['POS'] - span / 2
+        return xinc, xorg
+
+    def _yaxis(self, channel: int) -> tuple[float, float, float]:
+        c = self.chan[channel]
+        if self.waveform['FORM'] == 'WORD':
+            return 8.0 * c['SCAL'] / 65536, c['OFFS'], 32768.0
+        return 8.0 * c['SCAL'] / 256, c['OFFS'], 128.0
+
+    def _signal(self, t: np.ndarray, channel: int) -> np.ndarray:
+        if not self.wgen['OUTP']:
+            v = np.zeros_like(t)
+        else:
+            f = self.wgen['FREQ']
+            phase = (t * f + (channel - 1) / 8.0) % 1.0
+            amp = self._amplitude()
+            function = self.wgen['FUNC']
+            if function == 'SQU':
+                v = np.where(phase < self.wgen['FUNC:SQU:DCYC'] / 100.0, 0.5, -0.5) * amp
+            elif function == 'RAMP':
+                sym = min(max(self.wgen['FUNC:RAMP:SYMM'] / 100.0, 1e-9), 1 - 1e-9)
+                v = np.where(phase < sym, phase / sym, (1 - phase) / (1 - sym)) * amp - amp / 2
+            elif function == 'PULS':
+                v = np.where(phase < self.wgen['FUNC:PULS:WIDT'] * f, 0.5, -0.5) * amp
+            elif function == 'DC':
+                v = np.zeros_like(t)
+            elif function == 'NOIS':
+                v = self.rng.uniform(-0.5, 0.5, len(t)) * amp
+            else:
+                v = 0.5 * amp * np.sin(2 * np.pi * phase)
+            v = v + self._offset()
+
+        if self.noise > 0:
+            v = v + self.rng.normal(0.0, self.noise, len(t))
+        return v
+
+    def _acquire(self, channels: list[int]) -> None:
+        xinc, xorg = self._xaxis()
+        t = np.arange(self._record()) * xinc + xorg
+        channels = [n for n in channels if n in self.chan]
+
+        if not self._segmented():
+            self.acquired = {n: self._signal(t, n) for n in channels}
+            self.ttags = np.zeros(1)
+            return
+
+        # one segment per trigger, the triggers a few generator periods apart
+        count = self.acquisition['SEGM:COUN']
+        self.acquired = {n: np.stack([self._signal(t, n) for _ in range(count)]) for n in channels}
+        interval = max(10.0 * self.timebase['SCAL'], 1.0 / max(self.wgen['FREQ'], 1e-3))
+        self.ttags = np.concatenate([[0.0], np.cumsum(interval * self.rng.integers(1, 4, count - 1))])
+
+    def _samples(self, channel: int) -> np.ndarray:
+        if channel not in self.acquired:
+            self._acquire([channel])
+        samples = self.acquired[channel]
+        if samples.ndim == 2:
+            samples = samples[min(self.acquisition['SEGM:IND'], len(samples)) - 1]
+        return samples[::self._decimation()]
+
+    def _preamble(self) -> str:
+        points = self._points()
+        xinc, xorg = self._xaxis(self._decimation())
+        yinc, yorg, yref = self._yaxis(self.waveform['SOUR'])
+        form = _FORMAT_CODES[self.waveform['FORM']]
+        return (f'{form:+d},+0,{points:+d},+1,{xinc:+.6E},{xorg:+.6E},+0,'
+                f'{yinc:+.6E},{yorg:+.6E},{yref:+.0f}')
+
+    def _data(self) -> bytes:
+        channel = self.waveform['SOUR']
+        volts = self._samples(channel)
+        yinc, yorg, yref = self._yaxis(channel)
+        form = self.waveform['FORM']
+
+        if form == 'ASC':
+            payload = ','.join(f'{v:+.6E}' for v in volts).encode()
+        else:
+            top = 255 if form == 'BYTE' else 65535
+            codes = np.clip(np.rint((volts - yorg) / yinc + yref), 0, top)
+            if form == 'BYTE':
+                payload = codes.astype(np.uint8).tobytes()
+            else:
+                order = '<' if self.waveform['BYT'] == 'LSBF' else '>'
+                payload = codes.astype(order + 'u2').tobytes()
+
+        length = str(len(payload)).encode()
+        return b'#' + str(len(length)).encode() + length + payload
+
+
+class Instrument:
+    """An in-process instrument wired directly to an Oscilloscope, without any transport.
+
+    Useful to measure the cost of the osc helpers themselves.
+
+    :param sim: The Oscilloscope to talk to. Created from points if not given
+    :param points: The record length of the simulated oscilloscope
+    """
+
+    def __init__(self, sim: Oscilloscope = None, points: int = 62500):
+        self.sim = sim if sim is not None else Oscilloscope(points)
+        self._buf = bytearray()
+
+    def write(self, cmd: str) -> None:
+        self._buf += self.sim.handle(cmd)
+
+    def read(self) -> str:
+        end = self._buf.index(b'\n')
+        line = bytes(self._buf[:end])
+        del self._buf[:end + 1]
+        return line.decode('utf-8')
+
+    def read_raw(self, chunk_size: int = 65536) -> bytes:
+        data = bytes(self._buf[:chunk_size])
+        del self._buf[:chunk_size]
+        return data
+
+    def read_block(self, buffer=None) -> memoryview:
+        start, length = parse_header(self._buf)
+        try:
+            view = data_view(buffer, length)
+            view[:] = self._buf[start:start + length]
+        finally:
+            del self._buf[:start + length + 1]
+        return view
+
+    def query(self, cmd: str) -> str:
+        self.write(cmd)
+        return self.read()
+
+    def close(self) -> None:
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for line in self.rfile:
+            message = line.decode('utf-8', 'replace').strip()
+            if not message:
+                continue
+            response = server.sim.handle(message)
+            if response:
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                self._send(response, server.bandwidth)
+
+    def _send(self, data: bytes, bandwidth):
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+
+        view = memoryview(data)
+        chunk = 65536
+        start = time.perf_counter()
+        for offset in range(0, len(view), chunk):
+            self.wfile.write(view[offset:offset + chunk])
+            delay = (offset + chunk) / bandwidth - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Server:
+    """A TCP SCPI server around a simulated oscilloscope.
+
+    :param host: The address to bind to
+    :param port: The TCP port. If 0, a free port is chosen
+    :param points: The record length of the simulated oscilloscope
+    :param latency: Delay in seconds before each response is sent
+    :param bandwidth: Throttle responses to this many bytes per second. If None, unthrottled
+    :param sim: An Oscilloscope to serve. Created from points if not given
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, points: int = 62500,
+                 latency: float = 0.0, bandwidth: float = None, sim: Oscilloscope = None):
+        self.sim = sim if sim is not None else Oscilloscope(points)
+        self._server = _TCPServer((host, port), _Handler, bind_and_activate=True)
+        self._server.sim = self.sim
+        self._server.latency = latency
+        self._server.bandwidth = bandwidth
+        self._thread = None
+
+    @property
+    def address(self) -> tuple[str, int]:
+        """The (host, port) the server listens on."""
+        return self._server.server_address[:2]
+
+    def start(self) -> 'Server':
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Serves in the calling thread until interrupted."""
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        """Stops the server and closes its socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _HislipSession:
+
+    def __init__(self, session_id: int, overlapped: bool):
+        self.id = session_id
+        self.overlapped = overlapped
+        self.max_message_size = 2**20
+        # a response was sent and the client has not reported it delivered yet
+        self.undelivered = False
+        self.requesting = False
+
+
+class _HislipHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            type, control, param, payload = hislip.read_message(sock)
+            if type == hislip.INITIALIZE:
+                self._synchronous(sock)
+            elif type == hislip.ASYNC_INITIALIZE:
+                self._asynchronous(sock, param)
+            else:
+                hislip.send_message(sock, hislip.FATAL_ERROR, 1, 0, b'Expected an initialize message')
+        except (ConnectionError, OSError):
+            pass
+
+    def _synchronous(self, sock):
+        server = self.server
+        with server.lock:
+            server.last_session += 1
+            session = _HislipSession(server.last_session, server.overlapped)
+            server.sessions[session.id] = session
+        hislip.send_message(sock, hislip.INITIALIZE_RESPONSE, int(session.overlapped),
+                            (hislip.PROTOCOL_VERSION << 16) | session.id)
+
+        message = bytearray()
+        try:
+            while True:
+                type, control, param, payload = hislip.read_message(sock)
+                if type in (hislip.DATA, hislip.DATA_END):
+                    if control & 1:
+                        session.undelivered = False
+                    message += payload
+                    if type == hislip.DATA_END:
+                        text = message.decode('utf-8', 'replace')
+                        message = bytearray()
+                        self._respond(sock, session, text, param)
+                elif type == hislip.DEVICE_CLEAR_COMPLETE:
+                    message = bytearray()
+                    session.overlapped = bool(control & 1)
+                    session.undelivered = False
+                    hislip.send_message(sock, hislip.DEVICE_CLEAR_ACKNOWLEDGE, int(session.overlapped))
+                elif type != hislip.TRIGGER:
+                    hislip.send_message(sock, hislip.ERROR, 0, 0, b'Unrecognized message type')
+        finally:
+            with server.lock:
+                server.sessions.pop(session.id, None)
+
+    def _respond(self, sock, session, text: str, message_id: int):
+        server = self.server
+        response = b''.join(server.sim.handle(line.strip()) for line in text.splitlines() if line.strip())
+        if not response:
+            return
+        if server.latency > 0:
+            time.sleep(server.latency)
+
+        view = memoryview(response)
+        size = max(1, session.max_message_size)
+        for offset in range(0, len(view), size):
+            last = offset + size >= len(view)
+            hislip.send_message(sock, hislip.DATA_END if last else hislip.DATA, 0, message_id,
+                                view[offset:offset + size])
+        session.undelivered = True
+
+    def _asynchronous(self, sock, session_id: int):
+        server = self.server
+        session = server.sessions.get(session_id)
+        if session is None:
+            hislip.send_message(sock, hislip.FATAL_ERROR, 2, 0, b'Unknown session')
+            return
+        hislip.send_message(sock, hislip.ASYNC_INITIALIZE_RESPONSE, 0, int.from_bytes(b'KS', 'big'))
+
+        while True:
+            # a service request is raised on the rising edge of RQS
+            stb = self._statusByte(session)
+            requesting = bool(stb & 0x40)
+            if requesting and not session.requesting:
+                hislip.send_message(sock, hislip.ASYNC_SERVICE_REQUEST, stb)
+            session.requesting = requesting
+
+            readable, _, _ = select.select([sock], [], [], 0.002)
+            if not readable:
+                continue
+
+            type, control, param, payload = hislip.read_message(sock)
+            if type == hislip.ASYNC_MAXIMUM_MESSAGE_SIZE:
+                session.max_message_size = struct.unpack('>Q', payload)[0]
+                hislip.send_message(sock, hislip.ASYNC_MAXIMUM_MESSAGE_SIZE_RESPONSE, 0, 0,
+                                    struct.pack('>Q', server.max_message_size))
+            elif type == hislip.ASYNC_STATUS_QUERY:
+                if control & 1:
+                    session.undelivered = False
+                hislip.send_message(sock, hislip.ASYNC_STATUS_RESPONSE, self._statusByte(session))
+            elif type == hislip.ASYNC_DEVICE_CLEAR:
+                hislip.send_message(sock, hislip.ASYNC_DEVICE_CLEAR_ACKNOWLEDGE, int(server.overlapped))
+            elif type == hislip.ASYNC_LOCK:
+                hislip.send_message(sock, hislip.ASYNC_LOCK_RESPONSE, 1)
+            elif type == hislip.ASYNC_REMOTE_LOCAL_CONTROL:
+                hislip.send_message(sock, hislip.ASYNC_REMOTE_LOCAL_RESPONSE)
+            else:
+                hislip.send_message(sock, hislip.ERROR, 0, 0, b'Unrecognized message type')
+
+    def _statusByte(self, session) -> int:
+        stb = self.server.sim.status_byte()
+        if session.undelivered:
+            stb |= 0x10  # MAV
+        return stb
+
+
+class HislipServer(Server):
+    """A HiSLIP server around a simulated oscilloscope.
+
+    Each session gets a synchronous connection for the program messages and an
+    asynchronous one for status queries, device clear and service requests.
+
+    :param host: The address to bind to
+    :param port: The TCP port. If 0, a free port is chosen
+    :param points: The record length of the simulated oscilloscope
+    :param latency: Delay in seconds before each response is sent
+    :param overlapped: Offer overlapped mode instead of synchronized mode
+    :param max_message_size: The largest message payload the server accepts in bytes
+    :param sim: An Oscilloscope to serve. Created from points if not given
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, points: int = 62500,
+                 latency: float = 0.0, overlapped: bool = False, max_message_size: int = 2**20,
+                 sim: Oscilloscope = None):
+        self.sim = sim if sim is not None else Oscilloscope(points)
+        self._server = _TCPServer((host, port), _HislipHandler, bind_and_activate=True)
+        self._server.sim = self.sim
+        self._server.latency = latency
+        self._server.overlapped = overlapped
+        self._server.max_message_size = max_message_size
+        self._server.sessions = {}
+        self._server.last_session = 0
+        self._server.lock = threading.Lock()
+        self._thread = None
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Simulated Keysight oscilloscope SCPI server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5025)
+    parser.add_argument('--points', type=int, default=62500, help='record length')
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second')
+    args = parser.parse_args(argv)
+
+    server = Server(args.host, args.port, args.points, args.latency, args.bandwidth)
+    print(f'Serving on {server.address[0]}:{server.address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Opens instruments from VISA-style resource strings and keeps them open.
+
+ResourceManager picks the backend from the resource string and pools the
+connections, so opening the same resource again returns the connection
+that is already open instead of paying for another TCP handshake or USB
+scan, claim and capability query::
+
+    from pyscpi import ResourceManager
+
+    rm = ResourceManager()
+    inst = rm.open_resource('TCPIP::192.168.1.10::5025::SOCKET')
+    scope = rm.open_resource('USB::0x2A8D::0x0396::CN60000000::INSTR')
+    assert rm.open_resource('TCPIP::192.168.1.10::5025::SOCKET') is inst
+    rm.close()
+
+Resources:
+    TCPIP[board]::host::port::SOCKET    scpi.Instrument
+    TCPIP[board]::host::hislipN[,port]::INSTR    hislip.Instrument
+    USB[board]::vid::pid[::serial]::INSTR    usbtmc.Instrument (needs pyusb)
+    anything else    pyvisa (needs pyvisa and a VISA library)
+"""
+
+import re
+import threading
+
+from . import hislip, scpi
+
+
+_SOCKET = re.compile(r'^TCPIP\d*::(?P<host>[^\s:]+)::(?P<port>\d+)::SOCKET$', re.I)
+_HISLIP = re.compile(r'^TCPIP\d*::(?P<host>[^\s:]+)::(?P<name>hislip\d+)(?:,(?P<port>\d+))?::INSTR$', re.I)
+
+
+class ResourceManager:
+    """Opens instruments from resource strings and pools them by resource.
+
+    :param visa_library: The library passed to pyvisa.ResourceManager for VISA resources, eg. '@py'
+    """
+
+    def __init__(self, visa_library: str = ''):
+        self.visa_library = visa_library
+        self.pool = {}
+        self.names = {}
+        self.options = {}
+        self._visa = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open_resource(self, resource: str, **kwargs):
+        """Returns the pooled instrument for a resource, opening it if needed.
+
+        The options of a pooled instrument are those it was opened with.
+        Raises ValueError if options are given that differ from them, close()
+        the resource first to open it with other options. Without options the
+        pooled instrument is returned whatever it was opened with.
+
+        :param resource: The resource string, eg. 'TCPIP::192.168.1.10::5025::SOCKET'
+        :param kwargs: Passed on to the instrument when it is opened, eg. chunk_size
+        :return: A scpi.Instrument, hislip.Instrument, usbtmc.Instrument or pyvisa resource
+        """
+        key = self._key(resource)
+
+        with self._lock:
+            inst = self.pool.get(key)
+            if inst is not None and _isOpen(inst):
+                if kwargs and kwargs != self.options[key]:
+                    raise ValueError(f'{resource} is already open with {self.options[key]}, not {kwargs}')
+                return inst
+
+            inst = self._open(key, resource, kwargs)
+            self.pool[key] = inst
+            self.names[key] = resource
+            self.options[key] = kwargs
+            return inst
+
+    def list_resources(self) -> list[str]:
+        """Lists the USBTMC devices on the bus and the resources in the pool.
+
+        :return: A list of resource strings
+        """
+        resources = []
+        try:
+            from . import usbtmc
+            resources += usbtmc.list_resources()
+        except Exception:
+            # pyusb or a libusb backend is not available
+            pass
+
+        resources += [name for name in self.names.values() if name not in resources]
+        return resources
+
+    def close(self, resource: str = None) -> None:
+        """Closes pooled instruments.
+
+        :param resource: The resource to close. If None, close all of them
+        """
+        with self._lock:
+            if resource is None:
+                keys = list(self.pool)
+            else:
+                keys = [self._key(resource)]
+
+            for key in keys:
+                inst = self.pool.pop(key, None)
+                self.names.pop(key, None)
+                self.options.pop(key, None)
+                if inst is not None:
+                    inst.close()
+
+    def _key(self, resource: str) -> tuple:
+        # resources that name the same instrument share one pool entry
+        m = _SOCKET.match(resource)
+        if m is not None:
+            return ('SOCKET', m.group('host').lower(), int(m.group('port')))
+
+        m = _HISLIP.match(resource)
+        if m is not None:
+            port = int(m.group('port')) if m.group('port') else hislip.PORT
+            return ('HISLIP', m.group('host').lower(), port, m.group('name').lower())
+
+        if resource.upper().startswith('USB'):
+            from . import usbtmc
+            res = usbtmc.parse_visa_resource_string(resource)
+            if res is not None and res['arg1'] is not None and res['arg2'] is not None:
+                return ('USB', int(res['arg1'], 0), int(res['arg2'], 0), res['arg3'])
+
+        return ('VISA', resource)
+
+    def _open(self, key: tuple, resource: str, kwargs: dict):
+        if key[0] == 'SOCKET':
+            return scpi.Instrument(key[1], key[2], **kwargs)
+
+        if key[0] == 'HISLIP':
+            return hislip.Instrument(key[1], key[2], key[3], **kwargs)
+
+        if key[0] == 'USB':
+            from . import usbtmc
+            inst = usbtmc.Instrument(key[1], key[2], key[3], **kwargs)
+            # open now, so the pool sees it connected
+            inst.open()
+            return inst
+
+        if self._visa is None:
+            try:
+                import pyvisa
+            except ImportError:
+                raise ValueError(f'{resource} needs pyvisa, or use a TCPIP SOCKET, TCPIP hislip or USB INSTR resource')
+            self._visa = pyvisa.ResourceManager(self.visa_library)
+        return self._visa.open_resource(resource, **kwargs)
+
+
+def _isOpen(inst) -> bool:
+    if isinstance(inst, scpi.Instrument):
+        return inst.s.fileno() != -1
+    if isinstance(inst, hislip.Instrument):
+        return inst.s.fileno() != -1 and inst.a.fileno() != -1
+    try:
+        # usbtmc clears connected on close(), pyvisa raises once the session is closed
+        connected = getattr(inst, 'connected', None)
+        if connected is not None:
+            return connected
+        getattr(inst, 'session', None)
+    except Exception:
+        return False
+    return True
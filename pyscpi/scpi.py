@@ -1,26 +1,347 @@
+import asyncio
 import socket
 
+from .batch import Batch
+from .block import BlockSizeError, data_view, header_size
+from .trace import traced
+
 
 class Instrument:
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, chunk_size: int = 65536, tracer=None):
         self.host = host
         self.port = port
+        self.chunk_size = chunk_size
+        self.tracer = tracer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.transfers = 0
+        self._buf = bytearray()
+        self._batch = None
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # send each command at once instead of holding it back for the ACK of the previous one
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.s.connect((self.host, self.port))
 
+    @traced('write')
     def write(self, cmd: str) -> None:
-        self.s.sendall(str.encode(cmd + '\n'))
+        if self._batch is not None:
+            self._batch.write(cmd)
+            return
+        data = str.encode(cmd + '\n')
+        self.s.sendall(data)
+        self.bytes_sent += len(data)
+        self.transfers += 1
+
+    def batch(self, opc: bool = False, max_size: int = 1024) -> Batch:
+        """Returns a context that coalesces writes into compound messages.
+
+        If a batch is already active it is returned, so helpers can join an outer batch.
+
+        :param opc: Finish with a single *OPC? round trip
+        :param max_size: The maximum size of one compound message in bytes
+        :return: A Batch context manager
+        """
+        if self._batch is not None:
+            return self._batch
+        return Batch(self, opc, max_size)
 
+    @traced('read')
     def read(self) -> str:
-        return self.s.recv(1024).decode('utf-8')
+        """Reads one newline terminated response.
+
+        :return: The response without its terminator
+        """
+        return self.read_line().decode('utf-8').rstrip('\r')
+
+    @traced('read')
+    def read_line(self) -> bytes:
+        """Reads up to the next newline from the receive buffer.
+
+        :return: The line without its terminator
+        """
+        start = 0
+        while True:
+            end = self._buf.find(b'\n', start)
+            if end >= 0:
+                line = bytes(self._buf[:end])
+                del self._buf[:end + 1]
+                return line
+            start = len(self._buf)
+            self._fill()
+
+    @traced('read')
+    def read_bytes(self, size: int) -> bytes:
+        """Reads exactly size bytes, ignoring any terminators.
+
+        :param size: The number of bytes to read
+        :return: The bytes read
+        """
+        while len(self._buf) < size:
+            self._fill()
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    @traced('read')
+    def read_raw(self, chunk_size: int = None) -> bytes:
+        """Reads whatever is available, up to chunk_size bytes.
+
+        :param chunk_size: The maximum number of bytes to return. Defaults to the instrument's chunk_size
+        :return: The bytes read
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if not self._buf:
+            self._fill(chunk_size)
+        data = bytes(self._buf[:chunk_size])
+        del self._buf[:chunk_size]
+        return data
+
+    @traced('read')
+    def read_into(self, buffer) -> int:
+        """Receives directly into a writable buffer, draining buffered data first.
+
+        :param buffer: A writable buffer such as a bytearray, memoryview or NumPy array
+        :return: The number of bytes received
+        """
+        view = memoryview(buffer).cast('B')
+        if self._buf:
+            n = min(len(self._buf), len(view))
+            view[:n] = self._buf[:n]
+            del self._buf[:n]
+            return n
+        n = self.s.recv_into(view)
+        self.bytes_received += n
+        self.transfers += 1
+        return n
+
+    @traced('read')
+    def read_block(self, buffer=None) -> memoryview:
+        """Reads an IEEE 488.2 definite-length block (#<n><length><data>).
 
-    def read_raw(self, chunk_size) -> bytes:
-        return self.s.recv(1024)
+        The destination is allocated once from the block header and filled
+        straight from the socket. The trailing terminator is consumed and discarded.
+
+        :param buffer: Optional writable buffer to fill. Allocated if not given
+        :return: A memoryview over the block data
+        """
+        prefix = self.read_bytes(2)
+        try:
+            size = header_size(prefix)
+        except ValueError:
+            if not prefix.endswith(b'\n'):
+                self.read_line()
+            raise
+
+        length = int(self.read_bytes(size - 2))
+
+        try:
+            view = data_view(buffer, length)
+        except BlockSizeError:
+            self.read_bytes(length + 1)
+            raise
+
+        received = 0
+        while received < length:
+            n = self.read_into(view[received:])
+            if n == 0:
+                raise ConnectionError('Connection closed while reading block')
+            received += n
+
+        # discard the terminator
+        self.read_bytes(1)
+
+        return view
+
+    def _fill(self, size: int = None) -> None:
+        data = self.s.recv(size or self.chunk_size)
+        if not data:
+            raise ConnectionError('Connection closed by instrument')
+        self.bytes_received += len(data)
+        self.transfers += 1
+        self._buf += data
+
+    def read_stb(self) -> int:
+        """Reads the status byte with '*STB?'.
+
+        :return: The status byte
+        """
+        return int(self.query('*STB?'))
 
     def close(self) -> None:
         self.s.close()
 
+    @traced('query')
     def query(self, cmd: str) -> str:
+        if self._batch is not None:
+            return self._batch.query(cmd)
         self.write(cmd)
         return self.read()
+
+
+class AsyncInstrument:
+    """An asyncio counterpart of Instrument.
+
+    Queries are sent as soon as query() or query_block() is called and their
+    responses are matched in FIFO order, so several queries can be in flight
+    on one connection::
+
+        inst = await AsyncInstrument.connect(host, 5025)
+        idn = inst.query('*IDN?')
+        opc = inst.query('*OPC?')
+        print(await opc, await idn)
+
+    Each response is read by a task of its own, so the futures can be awaited
+    in any order, or not at all. Cancelling a query, eg. by asyncio.wait_for(),
+    only cancels the wait, the response is still read and discarded.
+    """
+
+    def __init__(self, host, port, chunk_size: int = 65536, limit: int = 2**24):
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self._reader = None
+        self._writer = None
+        self._tail = None
+
+    @classmethod
+    async def connect(cls, host, port, **kwargs) -> 'AsyncInstrument':
+        """Creates and opens an instrument.
+
+        :param host: The host name or IP address
+        :param port: The TCP port, usually 5025
+        :return: A connected AsyncInstrument
+        """
+        inst = cls(host, port, **kwargs)
+        await inst.open()
+        return inst
+
+    async def open(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, limit=self.limit)
+
+    async def __aenter__(self):
+        if self._writer is None:
+            await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def write(self, cmd: str) -> None:
+        """Sends a command and drains the transport.
+
+        :param cmd: The SCPI command
+        """
+        self._writer.write(str.encode(cmd + '\n'))
+        await self._writer.drain()
+
+    async def read(self) -> str:
+        """Reads one newline terminated response. Not ordered against queries in flight.
+
+        :return: The response without its terminator
+        """
+        try:
+            line = await self._reader.readuntil(b'\n')
+        except asyncio.LimitOverrunError:
+            await self._skip_line()
+            raise
+        return line[:-1].decode('utf-8').rstrip('\r')
+
+    async def read_block(self, buffer=None) -> memoryview:
+        """Reads an IEEE 488.2 definite-length block. Not ordered against queries in flight.
+
+        :param buffer: Optional writable buffer to fill. Allocated if not given
+        :return: A memoryview over the block data
+        """
+        prefix = await self._reader.readexactly(2)
+        try:
+            size = header_size(prefix)
+        except ValueError:
+            # not a definite-length block, eg. an error message, skip the rest of it
+            if not prefix.endswith(b'\n'):
+                await self._skip_line()
+            raise
+
+        length = int(await self._reader.readexactly(size - 2))
+
+        try:
+            view = data_view(buffer, length)
+        except BlockSizeError:
+            await self._reader.readexactly(length + 1)
+            raise
+
+        received = 0
+        while received < length:
+            data = await self._reader.read(min(length - received, self.chunk_size))
+            if not data:
+                raise ConnectionError('Connection closed while reading block')
+            view[received:received + len(data)] = data
+            received += len(data)
+
+        # discard the terminator
+        await self._reader.readexactly(1)
+
+        return view
+
+    def query(self, cmd: str):
+        """Sends a query now and returns an awaitable for its response.
+
+        :param cmd: The SCPI query
+        :return: An awaitable resolving to the response string
+        """
+        previous, done = self._enqueue(cmd)
+        return self._respond(previous, done, self.read)
+
+    def query_block(self, cmd: str, buffer=None):
+        """Sends a query now and returns an awaitable for its IEEE 488.2 block response.
+
+        :param cmd: The SCPI query, eg. ':WAVeform:DATA?'
+        :param buffer: Optional writable buffer to fill
+        :return: An awaitable resolving to a memoryview over the block data
+        """
+        previous, done = self._enqueue(cmd)
+        return self._respond(previous, done, lambda: self.read_block(buffer))
+
+    def _enqueue(self, cmd: str):
+        # the command is written and its turn reserved without yielding,
+        # which keeps the response order identical to the send order
+        self._writer.write(str.encode(cmd + '\n'))
+        previous = self._tail
+        done = asyncio.get_running_loop().create_future()
+        self._tail = done
+        return previous, done
+
+    def _respond(self, previous, done, read):
+        # the read runs as a task right away, shielded so that cancelling the
+        # caller's wait does not abandon a response halfway through the stream
+        task = asyncio.ensure_future(self._read_in_turn(previous, done, read))
+        return asyncio.shield(task)
+
+    async def _read_in_turn(self, previous, done, read):
+        try:
+            await self._writer.drain()
+            if previous is not None:
+                await previous
+            return await read()
+        finally:
+            done.set_result(None)
+            if self._tail is done:
+                self._tail = None
+
+    async def _skip_line(self) -> None:
+        while True:
+            try:
+                await self._reader.readuntil(b'\n')
+                return
+            except asyncio.LimitOverrunError as e:
+                await self._reader.readexactly(e.consumed)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+            self._reader = None
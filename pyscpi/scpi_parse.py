@@ -0,0 +1,59 @@
+"""Parsing of SCPI program messages into commands and short form headers.
+
+Shared by the state shadow, the tracer and the simulator, which all compare
+headers regardless of their case and long or short spelling.
+"""
+
+import re
+
+
+def short_header(header: str) -> str:
+    """Normalizes a SCPI header to its upper case short form.
+
+    :param header: A header such as ':WAVeform:POINts:MODE' or 'TIMEBASE:SCALE?'
+    :return: The short form, eg. 'WAV:POIN:MODE'
+    """
+    query = header.endswith('?')
+    header = header.rstrip('?').lstrip(':')
+    if header.startswith('*'):
+        return header.upper() + ('?' if query else '')
+
+    parts = []
+    for mnemonic in header.split(':'):
+        m = re.match(r'^([A-Za-z_]+)(\d*)$', mnemonic)
+        if m is None:
+            parts.append(mnemonic.upper())
+            continue
+        name, suffix = m.groups()
+        # the case of a header carries no meaning, 'wav:form' and 'WAVeform:FORMat' are the same
+        name = name.upper()
+        if len(name) > 4:
+            name = name[:3] if name[3] in 'AEIOU' else name[:4]
+        parts.append(name + suffix)
+
+    return ':'.join(parts) + ('?' if query else '')
+
+
+def split_message(message: str) -> list[str]:
+    """Splits a program message into its ';' separated commands.
+
+    :param message: The program message, eg. ':TIMebase:SCALe 1e-3;POSition 0'
+    :return: The commands, with ';' inside quoted strings left alone
+    """
+    parts = []
+    current = ''
+    quote = None
+    for c in message:
+        if quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == ';':
+            parts.append(current.strip())
+            current = ''
+            continue
+        current += c
+    if current.strip():
+        parts.append(current.strip())
+    return [p for p in parts if p]
@@ -0,0 +1,184 @@
+"""A state shadow that suppresses SCPI writes which would not change anything.
+
+Shadow wraps an instrument and remembers the last value written to each
+SCPI header. A setting written again with the same value is not sent::
+
+    from pyscpi import scpi, shadow
+    from pyscpi.keysight import osc
+
+    inst = shadow.Shadow(scpi.Instrument('192.168.1.10', 5025))
+    for freq in [1e3, 2e3, 5e3]:
+        osc.setWGenSin(inst, 1.0, 0.0, freq)  # only :WGEN:FREQuency is sent after the first step
+        t, v = osc.readSingleChannel(inst, 1)
+
+Headers and arguments are compared in their short form, so ':WAVeform:FORMat BYTE'
+and 'WAV:FORM BYTE' are the same setting. Action commands such as :DIGitize are
+always sent. *RST and :AUToscale forget everything, and so should you with
+resync() after changing the instrument from its front panel.
+"""
+
+from .scpi_parse import short_header, split_message
+
+
+# commands that act rather than set a value, they are always sent
+ACTIONS = {'DIG', 'RUN', 'STOP', 'SING', 'AUT', 'TRIG:FORC'}
+
+# commands after which the instrument state is unknown
+RESETS = {'*RST', '*RCL', 'AUT', 'SYST:PRES'}
+
+# settings under the same node that change each other, '' stands for the node
+# itself, eg. :WGEN:VOLTage next to :WGEN:VOLTage:HIGH
+COUPLED = [{'SCAL', 'RANG'}, {'POS', 'DEL'}, {'FREQ', 'PER'},
+           {'', 'HIGH', 'LOW'}, {'OFFS', 'HIGH', 'LOW'}]
+
+# settings that may change every other setting under the same node
+MODES = {'FUNC', 'MODE', 'TYPE'}
+
+
+class Shadow:
+    """Wraps an instrument and skips writes that do not change its state.
+
+    Everything except write, query and batch is passed on to the wrapped
+    instrument, so the osc helpers work unchanged.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    """
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.state = {}
+        self.skipped = 0
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def write(self, cmd: str) -> None:
+        """Writes a command unless every setting in it already has its value.
+
+        :param cmd: The program message
+        """
+        send, changes = self._compare(cmd)
+        if not send:
+            self.skipped += 1
+            return
+        self.inst.write(cmd)
+        self._apply(changes)
+
+    def query(self, cmd: str) -> str:
+        """Queries the instrument. Settings in the message are recorded.
+
+        :param cmd: The program message
+        :return: The response
+        """
+        _, changes = self._compare(cmd)
+        response = self.inst.query(cmd)
+        self._apply(changes)
+        return response
+
+    @property
+    def batch(self):
+        """The batch() of the wrapped instrument, forgetting the settings of a batch that raised.
+
+        A batch that raises discards its pending commands, so the settings
+        recorded since it was entered were never sent. They are restored to
+        what they were before. Instruments without batch(), such as pyvisa,
+        raise AttributeError like before.
+        """
+        batch = self.inst.batch
+
+        def wrapper(*args, **kwargs):
+            return _Batch(self, batch(*args, **kwargs))
+        return wrapper
+
+    def resync(self) -> None:
+        """Forgets all remembered settings, so the next write of each is sent."""
+        self.state.clear()
+
+    def _compare(self, message: str) -> tuple[bool, list]:
+        send = False
+        changes = []
+        path = ''
+        for cmd in split_message(message):
+            header, _, args = cmd.partition(' ')
+            if not header.startswith((':', '*')) and path:
+                header = path + ':' + header
+            if not header.startswith('*'):
+                path = header.lstrip(':').rsplit(':', 1)[0] if ':' in header.lstrip(':') else ''
+
+            key = short_header(header)
+            if key in RESETS:
+                changes.append((key, None))
+                send = True
+            elif key.endswith('?') or key.startswith('*') or key in ACTIONS or not args.strip():
+                send = True
+            else:
+                value = _normalize(args)
+                if self.state.get(key) != value:
+                    changes.append((key, value))
+                    send = True
+
+        return send, changes
+
+    def _apply(self, changes: list) -> None:
+        for key, value in changes:
+            if value is None:
+                self.state.clear()
+                continue
+            for other in [other for other in self.state if _coupled(key, other)]:
+                del self.state[other]
+            self.state[key] = value
+
+
+class _Batch:
+    # restores the shadow state when the outermost batch discards its commands
+
+    def __init__(self, shadow: Shadow, batch):
+        self.shadow = shadow
+        self.batch = batch
+        self.saved = None
+
+    def __enter__(self):
+        if self.batch._depth == 0:
+            self.saved = dict(self.shadow.state)
+        return self.batch.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self.batch.__exit__(exc_type, exc, tb)
+        finally:
+            if exc_type is not None and self.saved is not None:
+                self.shadow.state = self.saved
+
+
+def _coupled(key: str, other: str) -> bool:
+    parent, _, leaf = key.rpartition(':')
+    otherParent, _, otherLeaf = other.rpartition(':')
+
+    if other == key:
+        return True
+    if leaf in MODES:
+        return not parent or other == parent or other.startswith(parent + ':')
+
+    if parent == otherParent:
+        names = {leaf, otherLeaf}
+    elif other == parent:
+        names = {leaf, ''}
+    elif key == otherParent:
+        names = {'', otherLeaf}
+    else:
+        return False
+    return any(names <= group for group in COUPLED)
+
+
+def _normalize(args: str) -> tuple:
+    values = []
+    for arg in args.split(','):
+        arg = arg.strip()
+        if arg and arg[0] in '"\'':
+            values.append(arg)
+            continue
+        try:
+            values.append(float(arg))
+        except ValueError:
+            values.append(short_header(arg))
+    return tuple(values)
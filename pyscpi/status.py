@@ -0,0 +1,145 @@
+"""Waits for operations to complete through the IEEE 488.2 status registers.
+
+Instead of blocking the connection on '*OPC?' until an operation is done,
+an operation is followed by '*OPC', which sets the OPC bit of the event
+status register once everything pending has finished. With '*ESE 1' and
+'*SRE 32' that bit raises a service request::
+
+    from pyscpi import status
+
+    status.enable(inst)
+    op = status.start(inst, ':DIGitize CHANnel1')
+    ...  # the connection is free while the oscilloscope digitizes
+    op.wait(timeout=10)
+
+USBTMC instruments with an interrupt-IN endpoint are woken by the SRQ
+notification. Other instruments are serial polled, '*STB?' on sockets, at
+an interval that backs off from POLL_START to POLL_MAX.
+
+Once enable() was called for an instrument, the osc helpers wait this way
+instead of querying '*OPC?'.
+"""
+
+import time
+import weakref
+
+
+# event status register
+OPC = 0x01
+
+# status byte
+MAV = 0x10
+ESB = 0x20
+RQS = 0x40
+
+# serial poll interval in seconds, doubled after every poll
+POLL_START = 0.001
+POLL_MAX = 0.1
+
+_enabled = weakref.WeakKeyDictionary()
+
+
+def enable(inst) -> None:
+    """Clears the status registers and enables a service request on operation complete.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    """
+    inst.write('*CLS;*ESE 1;*SRE 32')
+    _enabled[inst] = True
+
+
+def disable(inst) -> None:
+    """Disables the service request and returns the instrument to '*OPC?' queries.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    """
+    inst.write('*SRE 0;*ESE 0')
+    _enabled.pop(inst, None)
+
+
+def enabled(inst) -> bool:
+    """Whether enable() was called for an instrument.
+
+    :param inst: The instrument object
+    """
+    return _enabled.get(inst, False)
+
+
+class Operation:
+    """An operation that was started with '*OPC' and has not been waited for yet.
+
+    :param inst: The instrument object
+    """
+
+    def __init__(self, inst):
+        self.inst = inst
+        self.complete = False
+
+    def done(self) -> bool:
+        """Checks once whether the operation has completed, without blocking.
+
+        :return: True if it completed
+        """
+        if not self.complete and read_stb(self.inst) & ESB:
+            self._check()
+        return self.complete
+
+    def wait(self, timeout: float = None) -> None:
+        """Waits for the operation to complete.
+
+        :param timeout: The maximum time to wait in seconds. If None, wait indefinitely
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        wait_srq = getattr(self.inst, 'wait_srq', None)
+        delay = POLL_START
+
+        while not self.done():
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError('Operation did not complete in time')
+
+            if wait_srq is not None:
+                # the request only wakes us up, done() confirms it on the next pass
+                wait_srq(remaining)
+                continue
+
+            time.sleep(delay if remaining is None else min(delay, remaining))
+            delay = min(delay * 2, POLL_MAX)
+
+    def _check(self) -> None:
+        # reading the event status register clears it, and with it ESB and the request
+        self.complete = bool(int(self.inst.query('*ESR?')) & OPC)
+
+
+def start(inst, cmd: str = None) -> Operation:
+    """Sends a command followed by '*OPC' without waiting for it.
+
+    :param inst: The instrument object from pyscpi or pyvisa, after enable()
+    :param cmd: The command, eg. ':DIGitize CHANnel1'. If None, wait for all pending operations
+    :return: An Operation to wait for
+    """
+    inst.write('*OPC' if cmd is None else f'{cmd};*OPC')
+    return Operation(inst)
+
+
+def complete(inst, timeout: float = None) -> None:
+    """Waits for all pending operations, through the status registers if enabled, or '*OPC?' otherwise.
+
+    :param inst: The instrument object from pyscpi or pyvisa
+    :param timeout: The maximum time to wait in seconds, when enabled. If None, wait indefinitely
+    """
+    if enabled(inst):
+        start(inst).wait(timeout)
+    else:
+        inst.query('*OPC?')
+
+
+def read_stb(inst) -> int:
+    """Reads the status byte, by serial poll where the instrument supports it.
+
+    :param inst: The instrument object
+    :return: The status byte
+    """
+    if hasattr(inst, 'read_stb'):
+        return int(inst.read_stb())
+    return int(inst.query('*STB?'))
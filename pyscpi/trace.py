@@ -0,0 +1,293 @@
+"""Per-command latency and throughput tracing for instruments.
+
+scpi.Instrument and usbtmc.Instrument report every write, read and query to
+a Tracer, which calls its hooks with an Event before and after the command.
+The Aggregator hook collects a latency histogram per SCPI header::
+
+    from pyscpi import scpi, trace
+    from pyscpi.keysight import osc
+
+    stats = trace.Aggregator()
+    inst = scpi.Instrument('192.168.1.10', 5025)
+    inst.tracer = trace.Tracer(stats)
+
+    t, v = osc.readSingleChannel(inst, 1)
+
+    print(stats.report())
+    stats.dump('trace.json')
+
+A read is reported under the header of the command written before it, so the
+block read after ':WAVeform:DATA?' shows up as a read of 'WAV:DATA?'. Calls
+made inside a traced call, such as the write and read of a query, are not
+reported separately. Without a tracer the instruments only count bytes and
+transfers.
+"""
+
+import functools
+import json
+import math
+import time
+from dataclasses import dataclass, field
+
+from .scpi_parse import short_header, split_message
+
+
+@dataclass
+class Event:
+    """One traced command.
+
+    :param op: 'write', 'read' or 'query'
+    :param header: The short form SCPI header, eg. 'WAV:DATA?'. Compound messages join their headers with ';'
+    :param start: The time.perf_counter() value when the command started
+    :param elapsed: The wall time in seconds, 0 in a pre hook
+    :param sent: The bytes sent to the instrument
+    :param received: The bytes received from the instrument
+    :param transfers: The number of socket receives and sends, or USB bulk transfers
+    :param error: The name of the exception raised by the command, or None
+    """
+    op: str
+    header: str
+    start: float
+    elapsed: float = 0.0
+    sent: int = 0
+    received: int = 0
+    transfers: int = 0
+    error: str = None
+
+
+class Tracer:
+    """Calls hooks around the commands of the instruments it is attached to.
+
+    A tracer can be shared by several instruments.
+
+    :param post: Hooks called with the finished Event of each command, eg. an Aggregator
+    :param pre: Hooks called with the Event before each command starts
+    """
+
+    def __init__(self, *post, pre=()):
+        self.post = list(post)
+        self.pre = list(pre)
+        self._headers = {}
+        self._active = set()
+
+    def add(self, post=None, pre=None) -> None:
+        """Adds hooks.
+
+        :param post: A hook called with each finished Event
+        :param pre: A hook called with each Event before the command starts
+        """
+        if post is not None:
+            self.post.append(post)
+        if pre is not None:
+            self.pre.append(pre)
+
+    def call(self, inst, op: str, func, args: tuple, kwargs: dict):
+        """Runs one instrument method and reports it.
+
+        :param inst: The instrument
+        :param op: 'write', 'read' or 'query'
+        :param func: The untraced method
+        :param args: The positional arguments, the message first for writes and queries
+        :param kwargs: The keyword arguments
+        :return: The result of the method
+        """
+        key = id(inst)
+        if key in self._active:
+            return func(inst, *args, **kwargs)
+
+        if op == 'read':
+            name = self._headers.get(key, '')
+        else:
+            name = header(args[0] if args else kwargs.get('message', kwargs.get('cmd', '')))
+            self._headers[key] = name
+
+        event = Event(op, name, time.perf_counter())
+        for hook in self.pre:
+            hook(event)
+
+        sent, received, transfers = inst.bytes_sent, inst.bytes_received, inst.transfers
+        self._active.add(key)
+        try:
+            return func(inst, *args, **kwargs)
+        except BaseException as exc:
+            event.error = type(exc).__name__
+            raise
+        finally:
+            self._active.discard(key)
+            event.elapsed = time.perf_counter() - event.start
+            event.sent = inst.bytes_sent - sent
+            event.received = inst.bytes_received - received
+            event.transfers = inst.transfers - transfers
+            for hook in self.post:
+                hook(event)
+
+
+def traced(op: str):
+    """Decorates an instrument method so it is reported to the instrument's tracer.
+
+    Writes and queries made while a batch is collecting are not reported,
+    the batch reports the compound messages it sends.
+
+    :param op: 'write', 'read' or 'query'
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer is None or (op != 'read' and self._batch is not None):
+                return func(self, *args, **kwargs)
+            return tracer.call(self, op, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def header(message) -> str:
+    """The short form headers of a program message.
+
+    :param message: A str or bytes message, or a list of them
+    :return: The headers joined with ';', eg. 'WGEN:FUNC;WGEN:FREQ'
+    """
+    if isinstance(message, (list, tuple)):
+        return ';'.join(header(m) for m in message)
+    if not isinstance(message, str):
+        # only the start of binary messages, they may carry block data
+        message = bytes(message[:256]).decode('utf-8', 'replace')
+    headers = []
+    for cmd in split_message(message[:256]):
+        headers.append(short_header(cmd.split(None, 1)[0]))
+    return ';'.join(headers)
+
+
+# histogram bins per decade of seconds
+BINS_PER_DECADE = 10
+
+
+@dataclass
+class CommandStats:
+    """The aggregated events of one op and header.
+
+    :param op: 'write', 'read' or 'query'
+    :param header: The short form SCPI header
+    """
+    op: str
+    header: str
+    count: int = 0
+    errors: int = 0
+    sent: int = 0
+    received: int = 0
+    transfers: int = 0
+    total: float = 0.0
+    min: float = math.inf
+    max: float = 0.0
+    bins: dict = field(default_factory=dict)
+
+    def add(self, event: Event) -> None:
+        self.count += 1
+        self.errors += event.error is not None
+        self.sent += event.sent
+        self.received += event.received
+        self.transfers += event.transfers
+        self.total += event.elapsed
+        self.min = min(self.min, event.elapsed)
+        self.max = max(self.max, event.elapsed)
+        b = _bin(event.elapsed)
+        self.bins[b] = self.bins.get(b, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        """Estimates a latency percentile from the histogram.
+
+        :param q: The percentile, 0 to 100
+        :return: The upper edge of the bin holding the percentile in seconds, clipped to min and max
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen >= rank:
+                return min(max(_edge(b + 1), self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """The statistics as a JSON serializable dict, times in seconds."""
+        edges = sorted(self.bins)
+        return {
+            'op': self.op,
+            'header': self.header,
+            'count': self.count,
+            'errors': self.errors,
+            'sent': self.sent,
+            'received': self.received,
+            'transfers': self.transfers,
+            'total_s': self.total,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'min_s': self.min if self.count else 0.0,
+            'max_s': self.max,
+            'p50_s': self.percentile(50),
+            'p90_s': self.percentile(90),
+            'p99_s': self.percentile(99),
+            'mb_per_s': (self.sent + self.received) / self.total / 1e6 if self.total > 0 else 0.0,
+            'histogram': {
+                'edges_s': [_edge(b) for b in edges] + ([_edge(edges[-1] + 1)] if edges else []),
+                'counts': [self.bins[b] for b in edges],
+            },
+        }
+
+
+class Aggregator:
+    """A post hook that collects latency histograms per op and SCPI header.
+
+    Histogram bins are spaced logarithmically, BINS_PER_DECADE to a decade.
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def __call__(self, event: Event) -> None:
+        stats = self.commands.get((event.op, event.header))
+        if stats is None:
+            stats = self.commands[(event.op, event.header)] = CommandStats(event.op, event.header)
+        stats.add(event)
+
+    def clear(self) -> None:
+        self.commands.clear()
+
+    def summary(self) -> list[dict]:
+        """The statistics of every command, the largest total time first.
+
+        :return: A list of CommandStats.summary() dicts
+        """
+        stats = sorted(self.commands.values(), key=lambda s: s.total, reverse=True)
+        return [s.summary() for s in stats]
+
+    def report(self) -> str:
+        """Formats the statistics as a table, the largest total time first.
+
+        :return: The table
+        """
+        lines = [f"{'op':6s} {'header':24s} {'count':>7s} {'total ms':>10s} {'p50 ms':>9s} "
+                 f"{'p99 ms':>9s} {'max ms':>9s} {'bytes':>11s} {'xfers':>7s} {'MB/s':>8s}"]
+        for s in self.summary():
+            lines.append(f"{s['op']:6s} {s['header'][:24]:24s} {s['count']:7d} {s['total_s'] * 1e3:10.2f} "
+                         f"{s['p50_s'] * 1e3:9.3f} {s['p99_s'] * 1e3:9.3f} {s['max_s'] * 1e3:9.3f} "
+                         f"{s['sent'] + s['received']:11d} {s['transfers']:7d} {s['mb_per_s']:8.2f}")
+        return '\n'.join(lines)
+
+    def dump(self, path: str) -> None:
+        """Writes the statistics to a JSON file.
+
+        :param path: The file to write
+        """
+        with open(path, 'w') as f:
+            json.dump({'bins_per_decade': BINS_PER_DECADE, 'commands': self.summary()}, f, indent=2)
+
+
+def _bin(seconds: float) -> int:
+    if seconds <= 0:
+        return -10 * BINS_PER_DECADE
+    return math.floor(math.log10(seconds) * BINS_PER_DECADE)
+
+
+def _edge(b: int) -> float:
+    return 10 ** (b / BINS_PER_DECADE)
@@ -26,12 +26,19 @@ THE SOFTWARE.
 
 import usb.core
 import usb.util
+import array
+import queue
 import struct
+import threading
 import time
 import os
 import re
 import sys
 
+from .batch import Batch
+from .block import data_view, parse_header
+from .trace import traced
+
 # constants
 USBTMC_bInterfaceClass    = 0xFE
 USBTMC_bInterfaceSubClass = 3
@@ -68,10 +75,20 @@ USB488_REN_CONTROL      = 160
 USB488_GOTO_LOCAL       = 161
 USB488_LOCAL_LOCKOUT    = 162
 
+USB488_SRQ_NOTIFICATION = 0x81
+
 USBTMC_HEADER_SIZE = 12
 
 RIGOL_QUIRK_PIDS = [0x04ce, 0x0588]
 
+# transfer sizes tried by Instrument.tune, rounded to whole packets
+TUNE_TRANSFER_SIZES = [2**k for k in range(12, 23)]
+
+# tuned max_transfer_size per (idVendor, idProduct, serial), kept for the
+# lifetime of the process only
+_transfer_sizes = {}
+_transfer_sizes_lock = threading.Lock()
+
 
 def parse_visa_resource_string(resource_string):
     # valid resource strings:
@@ -120,7 +137,20 @@ class UsbtmcException(Exception):
         return self.msg
 
 
-def list_devices():
+# product IDs of Agilent U27xx modular devices in firmware update mode
+_FIRMWARE_UPDATE_PIDS = {
+    0x2918: 0x2818, # U2701A/U2702A
+    0x4118: 0x4218, # U2722A
+    0x4318: 0x4418, # U2723A
+}
+
+# discovery index of (idVendor, idProduct, serial) -> [devices], built on first use
+_device_index = None
+_device_backend = None
+_device_lock = threading.Lock()
+
+
+def list_devices(backend=None):
     "List all connected USBTMC devices"
 
     def is_usbtmc_device(dev):
@@ -145,17 +175,61 @@ def list_devices():
 
         return False
 
-    return list(usb.core.find(find_all=True, custom_match=is_usbtmc_device))
+    return list(usb.core.find(find_all=True, custom_match=is_usbtmc_device, backend=backend))
+
+
+def refresh_devices(backend=None):
+    "Rescan the bus and rebuild the device index used by find_device and list_resources, a backend given is kept for later rescans"
+    global _device_index, _device_backend
+
+    if backend is not None:
+        _device_backend = backend
+
+    index = {}
+
+    for dev in list_devices(_device_backend):
+        # attempt to read serial number
+        iSerial = None
+        try:
+            iSerial = dev.serial_number
+        except:
+            pass
 
+        index.setdefault((dev.idVendor, dev.idProduct, iSerial), []).append(dev)
 
-def list_resources():
+    with _device_lock:
+        _device_index = index
+
+    return index
+
+
+def invalidate_devices():
+    "Forget the device index, so the next lookup rescans the bus"
+    global _device_index
+
+    with _device_lock:
+        _device_index = None
+
+
+def _devices(refresh=False):
+    # returns the index and whether the bus was scanned to build it
+    with _device_lock:
+        index = _device_index
+
+    if index is None or refresh:
+        return refresh_devices(), True
+
+    return index, False
+
+
+def list_resources(refresh=False):
     "List resource strings for all connected USBTMC devices"
 
     res = []
 
-    for dev in list_devices():
-        idVendor = dev.idVendor
-        idProduct = dev.idProduct
+    index, _ = _devices(refresh)
+
+    for (idVendor, idProduct, iSerial), devs in index.items():
 
         # "fix" IDs for devices in firmware update mode
         if idVendor == 0x0957 and idProduct == 0x2818:
@@ -170,65 +244,39 @@ def list_resources():
             # Agilent U2723A firmware update mode
             idProduct = 0x4318
 
-        # attempt to read serial number
-        iSerial = None
-        try:
-            iSerial = dev.serial_number
-        except:
-            pass
-
         # append formatted resource string to list
-        if iSerial is None:
-            res.append("USB::%d::%d::INSTR" % (idVendor, idProduct))
-        else:
-            res.append("USB::%d::%d::%s::INSTR" % (idVendor, idProduct, iSerial))
+        for dev in devs:
+            if iSerial is None:
+                res.append("USB::%d::%d::INSTR" % (idVendor, idProduct))
+            else:
+                res.append("USB::%d::%d::%s::INSTR" % (idVendor, idProduct, iSerial))
 
     return res
 
 
-def find_device(idVendor=None, idProduct=None, iSerial=None):
+def find_device(idVendor=None, idProduct=None, iSerial=None, refresh=False):
     "Find USBTMC instrument"
 
-    devs = list_devices()
+    index, scanned = _devices(refresh)
+    dev = _lookup_device(index, idVendor, idProduct, iSerial)
 
-    if len(devs) == 0:
-        return None
+    if dev is None and not scanned:
+        # the device may have been plugged in since the last scan
+        dev = _lookup_device(refresh_devices(), idVendor, idProduct, iSerial)
 
-    for dev in devs:
-        # match VID and PID
-        found = dev.idVendor == idVendor and dev.idProduct == idProduct
+    return dev
 
-        if idVendor == 0x0957 and idProduct == 0x2918:
-            # Agilent U2701A/U2702A firmware update mode
-            if dev.idVendor == idVendor and dev.idProduct == 0x2818:
-                found = True
-        
-        if idVendor == 0x0957 and idProduct == 0x4118:
-            # Agilent U2722A firmware update mode
-            if dev.idVendor == idVendor and dev.idProduct == 0x4218:
-                found = True
 
-        if idVendor == 0x0957 and idProduct == 0x4318:
-            # Agilent U2723A firmware update mode
-            if dev.idVendor == idVendor and dev.idProduct == 0x4418:
-                found = True
+def _lookup_device(index, idVendor, idProduct, iSerial):
+    pids = [idProduct]
 
-        if not found:
-            continue
+    if idVendor == 0x0957 and idProduct in _FIRMWARE_UPDATE_PIDS:
+        # Agilent U27xx modular device in firmware update mode
+        pids.append(_FIRMWARE_UPDATE_PIDS[idProduct])
 
-        if iSerial is None:
-            return dev
-        else:
-            s = ''
-
-            # try reading serial number
-            try:
-                s = dev.serial_number
-            except:
-                pass
-
-            if iSerial == s:
-                return dev
+    for (vid, pid, s), devs in index.items():
+        if vid == idVendor and pid in pids and (iSerial is None or iSerial == s):
+            return devs[0]
 
     return None
 
@@ -261,6 +309,9 @@ class Instrument(object):
         self.support_DT = False
 
         self.max_transfer_size = 1024*1024
+        self.tune_message = None
+        self.transfer_rates = {}
+        self.read_ahead = 0
 
         self.timeout = 5.0
 
@@ -270,6 +321,7 @@ class Instrument(object):
 
         self.last_btag = 0
         self.last_rstb_btag = 0
+        self.srq_status = None
 
         self.connected = False
         self.reattach = []
@@ -282,6 +334,14 @@ class Instrument(object):
         self.rigol_quirk = False
         self.rigol_quirk_ieee_block = False
 
+        self.tracer = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.transfers = 0
+
+        self._batch = None
+        self._read_buffers = []
+
         resource = None
 
         # process arguments
@@ -312,6 +372,12 @@ class Instrument(object):
                 self.term_char = val
             elif op == 'resource':
                 resource = val
+            elif op == 'tune':
+                self.tune_message = val
+            elif op == 'read_ahead':
+                self.read_ahead = val
+            elif op == 'tracer':
+                self.tracer = val
 
         if resource is not None:
             res = parse_visa_resource_string(resource)
@@ -398,6 +464,9 @@ class Instrument(object):
             usb.util.dispose_resources(self.device)
             self.device = None
 
+            # the device re-enumerates with its new product ID
+            invalidate_devices()
+
             for i in range(40):
                 self.device = find_device(0x0957, new_id, serial)
                 if self.device is not None:
@@ -434,24 +503,29 @@ class Instrument(object):
             # ignore exception if configuration is not set
             pass
 
-        if self.old_cfg is not None and self.old_cfg.bConfigurationValue == self.cfg.bConfigurationValue:
-            # already set to correct configuration
+        try:
+            if self.old_cfg is not None and self.old_cfg.bConfigurationValue == self.cfg.bConfigurationValue:
+                # already set to correct configuration
 
-            # release kernel driver on USBTMC interface
-            self._release_kernel_driver(self.iface.bInterfaceNumber)
-        else:
-            # wrong configuration or configuration not set
+                # release kernel driver on USBTMC interface
+                self._release_kernel_driver(self.iface.bInterfaceNumber)
+            else:
+                # wrong configuration or configuration not set
 
-            # release all kernel drivers
-            if self.old_cfg is not None:
-                for iface in self.old_cfg:
-                    self._release_kernel_driver(iface.bInterfaceNumber)
+                # release all kernel drivers
+                if self.old_cfg is not None:
+                    for iface in self.old_cfg:
+                        self._release_kernel_driver(iface.bInterfaceNumber)
 
-            # set proper configuration
-            self.device.set_configuration(self.cfg)
+                # set proper configuration
+                self.device.set_configuration(self.cfg)
 
-        # claim interface
-        usb.util.claim_interface(self.device, self.iface)
+            # claim interface
+            usb.util.claim_interface(self.device, self.iface)
+        except usb.core.USBError:
+            # a device unplugged since the last scan leaves a stale entry in the index
+            invalidate_devices()
+            raise
 
         # don't need to set altsetting - USBTMC devices have 1 altsetting as per the spec
 
@@ -491,6 +565,15 @@ class Instrument(object):
 
         self.get_capabilities()
 
+        # transfer size tuned earlier for this device, or tune it now if asked to
+        if not self.advantest_quirk:
+            with _transfer_sizes_lock:
+                size = _transfer_sizes.get(self._device_key())
+            if size is not None:
+                self.max_transfer_size = size
+            elif self.tune_message is not None:
+                self.tune(self.tune_message)
+
     def close(self):
         if not self.connected:
             return
@@ -609,6 +692,7 @@ class Instrument(object):
         data = data[USBTMC_HEADER_SIZE:transfer_size+USBTMC_HEADER_SIZE]
         return (msgid, btag, btaginverse, transfer_size, transfer_attributes, data)
 
+    @traced('write')
     def write_raw(self, data):
         "Write binary data to instrument"
 
@@ -631,6 +715,8 @@ class Instrument(object):
 
                 req = self.pack_dev_dep_msg_out_header(size, eom) + block + b'\0'*((4 - (size % 4)) % 4)
                 self.bulk_out_ep.write(req, timeout=self._timeout_ms)
+                self.bytes_sent += size
+                self.transfers += 1
 
                 offset += size
                 num -= size
@@ -641,12 +727,95 @@ class Instrument(object):
                 self._abort_bulk_out()
             raise
 
-    def read_raw(self, num=-1):
-        "Read binary data from instrument"
+    def _read_chunks(self, num=-1):
+        "Read one response, yielding a memoryview of the payload of each transfer"
 
         if not self.connected:
             self.open()
 
+        # the receive buffers are reused for every transfer, the payload is
+        # handed out as a memoryview past the header instead of being copied
+        size = self.max_transfer_size+USBTMC_HEADER_SIZE+3
+        size += -size % self.bulk_in_ep.wMaxPacketSize
+        count = self.read_ahead+1
+        if len(self._read_buffers) != count or len(self._read_buffers[0]) != size:
+            self._read_buffers = [array.array('B', bytes(size)) for i in range(count)]
+
+        if count == 1:
+            buff = self._read_buffers[0]
+            transfers = self._transfers(num, lambda: buff)
+            more = True
+            try:
+                for data, more in transfers:
+                    yield data
+            finally:
+                # drain the rest of the response if the caller stopped early
+                if more:
+                    for data, more in transfers:
+                        pass
+            return
+
+        free = queue.SimpleQueue()
+        for buff in self._read_buffers:
+            free.put(buff)
+
+        # the first transfer is read here, so short responses never start a thread
+        transfers = self._transfers(num, free.get)
+        data, more = next(transfers)
+        try:
+            yield data
+        except GeneratorExit:
+            # drain the rest of the response if the caller stopped early
+            free.put(data.obj)
+            for data, more in transfers:
+                free.put(data.obj)
+            raise
+        if not more:
+            return
+        free.put(data.obj)
+
+        # a reader thread requests and receives the following transfers into
+        # the free buffers while the caller consumes the filled ones
+        filled = queue.SimpleQueue()
+
+        def reader():
+            try:
+                for item in transfers:
+                    filled.put(item)
+            except BaseException as exc:
+                filled.put(exc)
+            filled.put(None)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+
+        done = False
+        try:
+            while True:
+                item = filled.get()
+                if item is None:
+                    done = True
+                    break
+                if isinstance(item, BaseException):
+                    done = True
+                    thread.join()
+                    raise item
+                data, more = item
+                yield data
+                free.put(data.obj)
+        finally:
+            # drain the rest of the response if the caller stopped early
+            while not done:
+                item = filled.get()
+                if item is None or isinstance(item, BaseException):
+                    done = True
+                else:
+                    free.put(item[0].obj)
+            thread.join()
+
+    def _transfers(self, num, next_buffer):
+        "Request and receive the transfers of one response, yielding (payload, more) for each"
+
         read_len = self.max_transfer_size
         if 0 < num < read_len:
             read_len = num
@@ -658,65 +827,66 @@ class Instrument(object):
         if self.term_char is not None:
             term_char = self.term_char
 
-        read_data = b''
+        received = 0
+        transfer_size = 0
 
         try:
             while not eom:
-                if not self.rigol_quirk or read_data == b'':
+                if not self.rigol_quirk or received == 0:
 
                     # if the rigol sees this again, it will restart the transfer
                     # so only send it the first time
 
                     req = self.pack_dev_dep_msg_in_header(read_len, term_char)
                     self.bulk_out_ep.write(req, timeout=self._timeout_ms)
+                    self.transfers += 1
 
-                resp = self.bulk_in_ep.read(read_len+USBTMC_HEADER_SIZE+3, timeout=self._timeout_ms)
-
-                if sys.version_info >= (3, 2):
-                    resp = resp.tobytes()
-                else:
-                    resp = resp.tostring()
+                buff = next_buffer()
+                view = memoryview(buff)
+                n = self.bulk_in_ep.read(buff, timeout=self._timeout_ms)
 
-                if self.rigol_quirk and read_data:
-                    pass # do nothing, the packet has no header if it isn't the first
+                if self.rigol_quirk and received:
+                    data = view[:n] # the packet has no header if it isn't the first
                 else:
-                    msgid, btag, btaginverse, transfer_size, transfer_attributes, data = self.unpack_dev_dep_resp_header(resp) 
-
+                    transfer_size, transfer_attributes = struct.unpack_from('<LBxxx', buff, 4)
+                    data = view[USBTMC_HEADER_SIZE:min(n, transfer_size+USBTMC_HEADER_SIZE)]
 
                 if self.rigol_quirk:
                     # rigol devices only send the header in the first packet, and they lie about whether the transaction is complete
-                    if read_data:
-                        read_data += resp
-                    else:
-                        if self.rigol_quirk_ieee_block and data.startswith(b"#"):
+                    if received == 0 and self.rigol_quirk_ieee_block and data[:1] == b"#":
 
-                            # ieee block incoming, the transfer_size usbtmc header is lying about the transaction size
-                            l = int(chr(data[1]))
-                            n = int(data[2:l+2])
+                        # ieee block incoming, the transfer_size usbtmc header is lying about the transaction size
+                        l = int(chr(data[1]))
+                        n = int(bytes(data[2:l+2]))
 
-                            transfer_size = n + (l+2)  # account for ieee header
+                        transfer_size = n + (l+2)  # account for ieee header
 
-                        read_data += data
-
-                    if len(read_data) >= transfer_size:
-                        read_data = read_data[:transfer_size]  # as per usbtmc spec section 3.2 note 2
+                    if received + len(data) >= transfer_size:
+                        data = data[:transfer_size-received]  # as per usbtmc spec section 3.2 note 2
                         eom = True
                     else:
                         eom = False
                 else:
                     eom = transfer_attributes & 1
-                    read_data += data
+
+                received += len(data)
+                self.bytes_received += len(data)
+                self.transfers += 1
 
                 # Advantest devices never signal EOI and may only send one read packet
-                if self.advantest_quirk:
-                    break
+                more = not eom and not self.advantest_quirk
 
                 if num > 0:
                     num = num - len(data)
                     if num <= 0:
-                        break
-                    if num < read_len:
+                        more = False
+                    elif num < read_len:
                         read_len = num
+
+                yield data, more
+
+                if not more:
+                    break
         except usb.core.USBError:
             exc = sys.exc_info()[1]
             if exc.errno == 110:
@@ -724,8 +894,131 @@ class Instrument(object):
                 self._abort_bulk_in()
             raise
 
+    @traced('read')
+    def read_raw(self, num=-1):
+        "Read binary data from instrument, returned as a bytearray"
+
+        read_data = bytearray()
+
+        # each transfer is copied once, straight from the receive buffer
+        for data in self._read_chunks(num):
+            read_data += data
+
         return read_data
 
+    @traced('read')
+    def read_into(self, buffer, num=-1):
+        "Read one response into a writable buffer, returning the number of bytes read"
+
+        view = memoryview(buffer).cast('B')
+        received = 0
+        overflow = False
+
+        for data in self._read_chunks(num):
+            n = min(len(data), len(view)-received)
+            view[received:received+n] = data[:n]
+            received += n
+            overflow = overflow or n < len(data)
+
+        if overflow:
+            raise ValueError(f'Buffer of {len(view)} bytes is too small for the response')
+
+        return received
+
+    @traced('read')
+    def read_block(self, buffer=None):
+        "Read an IEEE 488.2 definite-length block (#<n><length><data>) into a buffer, returning a memoryview of the data"
+
+        header = bytearray()
+        view = None
+        length = 0
+        received = 0
+        error = None
+
+        # the whole response is always read, so an error leaves no data behind
+        for data in self._read_chunks():
+            if error is not None:
+                continue
+
+            if view is None:
+                header += data
+                try:
+                    parsed = parse_header(header)
+                    if parsed is None:
+                        continue
+                    start, length = parsed
+                    view = data_view(buffer, length)
+                except ValueError as e:
+                    error = e
+                    continue
+                data = memoryview(header)[start:]
+
+            n = min(len(data), length-received)
+            view[received:received+n] = data[:n]
+            received += n
+
+        if error is not None:
+            raise error
+
+        if received < length or view is None:
+            raise UsbtmcException("Incomplete block", 'read_block')
+
+        return view
+
+    def tune(self, message, sizes=None, repeat=3):
+        """
+        Measure the read throughput of a query for several transfer sizes and keep the fastest.
+        The size is remembered per device for this process only, instruments opened
+        later on the same device start with it. To reuse it in another process, save
+        the returned size and set max_transfer_size to it after open().
+        """
+
+        if not self.connected:
+            self.open()
+
+        if self.advantest_quirk:
+            return self.max_transfer_size
+
+        if sizes is None:
+            sizes = TUNE_TRANSFER_SIZES
+
+        if type(message) is str:
+            message = message.encode('utf-8')
+
+        # a full transfer, header included, fills whole packets
+        packet = self.bulk_in_ep.wMaxPacketSize
+        candidates = sorted(set(max(1, -(-(size+USBTMC_HEADER_SIZE) // packet)) * packet - USBTMC_HEADER_SIZE for size in sizes))
+
+        rates = {}
+        for size in candidates:
+            self.max_transfer_size = size
+            self.write_raw(message)
+            self.read_raw()
+
+            received = 0
+            start = time.perf_counter()
+            for i in range(repeat):
+                self.write_raw(message)
+                received += len(self.read_raw())
+            rates[size] = received / (time.perf_counter() - start)
+
+        self.max_transfer_size = max(rates, key=rates.get)
+        with _transfer_sizes_lock:
+            _transfer_sizes[self._device_key()] = self.max_transfer_size
+        self.transfer_rates = rates
+
+        return self.max_transfer_size
+
+    def _device_key(self):
+        serial = self.iSerial
+        if serial is None:
+            try:
+                serial = self.device.serial_number
+            except (ValueError, usb.core.USBError):
+                serial = None
+        return (self.device.idVendor, self.device.idProduct, serial)
+
+    @traced('query')
     def ask_raw(self, data, num=-1):
         "Write then read binary data"
         # Advantest/ADCMT hardware won't respond to a command unless it's in Local Lockout mode
@@ -739,6 +1032,7 @@ class Instrument(object):
             if self.advantest_quirk and not was_locked:
                 self.unlock()
 
+    @traced('write')
     def write(self, message, encoding='utf-8'):
         "Write string to instrument"
         if type(message) is tuple or type(message) is list:
@@ -747,12 +1041,24 @@ class Instrument(object):
                 self.write(message_i, encoding)
             return
 
+        if self._batch is not None:
+            self._batch.write(str(message))
+            return
+
         self.write_raw(str(message).encode(encoding))
 
+    def batch(self, opc=False, max_size=1024):
+        "Coalesce writes into compound messages, joining an active batch if there is one"
+        if self._batch is not None:
+            return self._batch
+        return Batch(self, opc, max_size)
+
+    @traced('read')
     def read(self, num=-1, encoding='utf-8'):
         "Read string from instrument"
         return self.read_raw(num).decode(encoding).rstrip('\r\n')
 
+    @traced('query')
     def ask(self, message, num=-1, encoding='utf-8'):
         "Write then read string"
         if type(message) is tuple or type(message) is list:
@@ -762,6 +1068,9 @@ class Instrument(object):
                 val.append(self.ask(message_i, num, encoding))
             return val
 
+        if self._batch is not None:
+            return self._batch.query(message)
+
         # Advantest/ADCMT hardware won't respond to a command unless it's in Local Lockout mode
         was_locked = self.advantest_locked
         try:
@@ -773,6 +1082,7 @@ class Instrument(object):
             if self.advantest_quirk and not was_locked:
                 self.unlock()
 
+    @traced('query')
     def query(self, message):
         "Write then read string"
         return self.ask(message)
@@ -807,6 +1117,10 @@ class Instrument(object):
                 else:
                     # read response from interrupt channel
                     resp = self.interrupt_in_ep.read(2, timeout=self._timeout_ms)
+                    while resp[0] == USB488_SRQ_NOTIFICATION:
+                        # a service request arrived first, keep it for wait_srq
+                        self.srq_status = resp[1]
+                        resp = self.interrupt_in_ep.read(2, timeout=self._timeout_ms)
                     if resp[0] != rstb_btag + 128:
                         raise UsbtmcException("Read status byte btag mismatch", 'read_stb')
                     else:
@@ -816,6 +1130,50 @@ class Instrument(object):
         else:
             return int(self.ask("*STB?"))
 
+    def wait_srq(self, timeout=None):
+        "Wait for a service request, returning the status byte, or None if none arrived within timeout seconds"
+
+        if not self.connected:
+            self.open()
+
+        if self.srq_status is not None:
+            stb = self.srq_status
+            self.srq_status = None
+            return stb
+
+        deadline = None if timeout is None else time.perf_counter() + timeout
+
+        if self.interrupt_in_ep is None:
+            # no interrupt channel, poll the status byte with backoff
+            delay = 0.001
+            while True:
+                stb = self.read_stb()
+                if stb & 0x40:
+                    return stb
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return None
+                time.sleep(delay if deadline is None else max(0, min(delay, deadline - time.perf_counter())))
+                delay = min(delay*2, 0.1)
+
+        while True:
+            if deadline is None:
+                wait_ms = self._timeout_ms
+            else:
+                wait_ms = int((deadline - time.perf_counter()) * 1000)
+                if wait_ms <= 0:
+                    return None
+            try:
+                resp = self.interrupt_in_ep.read(2, timeout=wait_ms)
+            except usb.core.USBError:
+                exc = sys.exc_info()[1]
+                if exc.errno == 110:
+                    # timeout, nothing arrived yet
+                    continue
+                raise
+            if resp[0] == USB488_SRQ_NOTIFICATION:
+                return resp[1]
+            # late response to a status byte read, ignore
+
     def trigger(self):
         "Send trigger command"
 
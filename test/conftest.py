@@ -0,0 +1,48 @@
+import socket
+import threading
+
+import pytest
+
+from pyscpi import scpi
+
+
+def block(data: bytes) -> bytes:
+    """Frames data as a definite-length block response."""
+    length = str(len(data)).encode()
+    return b'#' + str(len(length)).encode() + length + data + b'\n'
+
+
+@pytest.fixture
+def serve():
+    """Starts a server that sends the given responses and returns a connected Instrument."""
+    listener = socket.create_server(('127.0.0.1', 0))
+    instruments = []
+    threads = []
+
+    def start(*responses, chunk=None):
+        def send():
+            conn, _ = listener.accept()
+            with conn:
+                data = b''.join(responses)
+                step = chunk or len(data)
+                for i in range(0, len(data), step):
+                    conn.sendall(data[i:i + step])
+                # hold the connection until the client writes or goes away
+                try:
+                    conn.recv(1)
+                except ConnectionError:
+                    pass
+
+        thread = threading.Thread(target=send, daemon=True)
+        thread.start()
+        threads.append(thread)
+        inst = scpi.Instrument(*listener.getsockname())
+        instruments.append(inst)
+        return inst
+
+    yield start
+    for inst in instruments:
+        inst.close()
+    for thread in threads:
+        thread.join(5)
+    listener.close()
@@ -0,0 +1,146 @@
+"""Acquisition throughput benchmark for pyscpi.keysight.osc.
+
+Measures osc.readSingleChannel and osc.readChannels across backends, record
+lengths and channel counts, and writes the results as JSON so runs from
+different releases can be compared:
+
+    python3 osc_bench.py --points 1000 62500 --channels 1 4 --output bench.json
+
+Backends:
+    socket  scpi.Instrument against the simulator served over TCP
+    usbtmc  usbtmc.Instrument against a fake pyusb device backed by the simulator
+    local   the simulator called in-process, without any transport
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from importlib import metadata
+
+import numpy as np
+
+from pyscpi import scpi
+from pyscpi.keysight import osc, sim
+
+
+def open_backend(name: str, points: int, latency: float, bandwidth: float):
+    oscilloscope = sim.Oscilloscope(points, seed=0)
+
+    if name == 'socket':
+        server = sim.Server(sim=oscilloscope, latency=latency, bandwidth=bandwidth).start()
+        inst = scpi.Instrument(*server.address)
+        return inst, server.stop
+
+    if name == 'usbtmc':
+        from pyscpi import fakeusb, usbtmc
+        inst = usbtmc.Instrument(device=fakeusb.device(oscilloscope))
+        return inst, lambda: None
+
+    if name == 'local':
+        return sim.Instrument(oscilloscope), lambda: None
+
+    raise ValueError(f'Unknown backend {name}')
+
+
+def acquire(inst, channels: list[int], points: int):
+    if len(channels) == 1:
+        return osc.readSingleChannel(inst, channels[0], points, runAfter=False)
+    return osc.readChannels(inst, channels, points, runAfter=False)
+
+
+def run_case(backend: str, points: int, channels: int, repeat: int, warmup: int,
+             latency: float, bandwidth: float) -> dict:
+    chans = list(range(1, channels + 1))
+    inst, stop = open_backend(backend, points, latency, bandwidth)
+
+    try:
+        inst.write(f':WAVeform:POINts {points}')
+        for _ in range(warmup):
+            acquire(inst, chans, points)
+
+        times = np.empty(repeat)
+        for i in range(repeat):
+            start = time.perf_counter()
+            acquire(inst, chans, points)
+            times[i] = time.perf_counter() - start
+
+        tracemalloc.start()
+        acquire(inst, chans, points)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        inst.close()
+        stop()
+
+    total = times.sum()
+    nbytes = points * channels
+
+    return {
+        'backend': backend,
+        'points': points,
+        'channels': channels,
+        'repeat': repeat,
+        'waveforms_per_s': repeat * channels / total,
+        'mb_per_s': repeat * nbytes / total / 1e6,
+        'latency_ms': {
+            'min': float(times.min() * 1e3),
+            'p50': float(np.percentile(times, 50) * 1e3),
+            'p90': float(np.percentile(times, 90) * 1e3),
+            'p99': float(np.percentile(times, 99) * 1e3),
+            'max': float(times.max() * 1e3),
+        },
+        'peak_memory_bytes': int(peak),
+    }
+
+
+def environment() -> dict:
+    try:
+        version = metadata.version('pyscpi')
+    except metadata.PackageNotFoundError:
+        version = None
+
+    return {
+        'pyscpi': version,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', default=['socket', 'usbtmc', 'local'])
+    parser.add_argument('--points', nargs='+', type=int, default=[1000, 10000, 62500])
+    parser.add_argument('--channels', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated response delay in seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='simulated socket bytes per second')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in args.backends:
+        for points in args.points:
+            for channels in args.channels:
+                r = run_case(backend, points, channels, args.repeat, args.warmup,
+                             args.latency, args.bandwidth)
+                results.append(r)
+                print(f"{backend:8s} {points:>8d} pts {channels} ch  "
+                      f"{r['waveforms_per_s']:9.1f} wfm/s  {r['mb_per_s']:8.2f} MB/s  "
+                      f"p50 {r['latency_ms']['p50']:8.2f} ms  p99 {r['latency_ms']['p99']:8.2f} ms  "
+                      f"peak {r['peak_memory_bytes'] / 1e6:7.2f} MB")
+
+    report = {'environment': environment(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
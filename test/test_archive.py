@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from pyscpi.keysight import archive, osc, sim
+
+
+POINTS = 1000
+
+
+def _preamble(points=POINTS, yinc=0.01):
+    return osc.Preamble('+0', '+0', points, 1e-6, -5e-4, 0.0, yinc, 0.5, 128.0)
+
+
+@pytest.mark.parametrize('codes', [np.uint8, '<u2', '>u2'])
+def test_round_trip(tmp_path, codes):
+    path = tmp_path / 'run.wfm'
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, POINTS).astype(codes) for _ in range(3)]
+
+    with archive.Writer(path, POINTS, codes, 'WORD') as w:
+        for i, frame in enumerate(frames):
+            w.append(frame, _preamble(yinc=0.01 * (i + 1)), channel=i + 1, timestamp=100.0 + i)
+        assert w.count == 3
+
+    with archive.Reader(path) as r:
+        assert len(r) == 3
+        assert r.format == 'WORD'
+        assert r.codes.dtype == np.dtype(codes)
+        np.testing.assert_array_equal(r.codes, frames)
+        assert r.channels.tolist() == [1, 2, 3]
+        assert r.timestamps.tolist() == [100.0, 101.0, 102.0]
+        assert r.preamble(1) == osc.Preamble('WORD', '0', POINTS, 1e-6, -5e-4, 0.0, 0.02, 0.5, 128.0)
+        np.testing.assert_allclose(r.volts(2), (frames[2] - 128.0) * 0.03 + 0.5)
+        assert r.volts(slice(0, 2), dtype=np.float32).shape == (2, POINTS)
+        np.testing.assert_allclose(np.asarray(r.time(0)), np.arange(POINTS) * 1e-6 - 5e-4)
+
+
+def test_append_to_existing(tmp_path):
+    path = tmp_path / 'run.wfm'
+    with archive.Writer(path, POINTS) as w:
+        w.append(np.full(POINTS, 1, np.uint8), _preamble())
+    with archive.Writer(path, POINTS) as w:
+        w.append(np.full(POINTS, 2, np.uint8), _preamble())
+    with archive.Reader(path) as r:
+        assert r.codes[:, 0].tolist() == [1, 2]
+
+    with pytest.raises(ValueError):
+        archive.Writer(path, POINTS * 2)
+    with pytest.raises(ValueError):
+        archive.Writer(path, POINTS, '<u2', 'WORD')
+
+
+def test_frame_too_long(tmp_path):
+    with archive.Writer(tmp_path / 'run.wfm', POINTS) as w:
+        with pytest.raises(ValueError):
+            w.append(np.zeros(POINTS + 1, np.uint8), _preamble())
+        w.append(np.zeros(POINTS // 2, np.uint8), _preamble(POINTS // 2))
+    with archive.Reader(tmp_path / 'run.wfm') as r:
+        assert r.preamble(0).points == POINTS // 2
+
+
+def test_reader_ignores_partial_frame(tmp_path):
+    path = tmp_path / 'run.wfm'
+    with archive.Writer(path, POINTS) as w:
+        w.append(np.zeros(POINTS, np.uint8), _preamble())
+    with open(path, 'ab') as f:
+        f.write(b'\0' * 100)
+    with archive.Reader(path) as r:
+        assert len(r) == 1
+
+    empty = tmp_path / 'empty.wfm'
+    archive.Writer(empty, POINTS).close()
+    with archive.Reader(empty) as r:
+        assert len(r) == 0 and r.codes.shape == (0, POINTS)
+
+
+def test_append_after_partial_frame(tmp_path):
+    path = tmp_path / 'run.wfm'
+    with archive.Writer(path, POINTS) as w:
+        w.append(np.full(POINTS, 1, np.uint8), _preamble())
+        itemsize = w.dtype.itemsize
+    whole = path.stat().st_size
+    with open(path, 'ab') as f:
+        f.write(b'\xff' * (itemsize // 2))
+
+    # the torn frame is cut off, so the next one starts on a record boundary
+    with archive.Writer(path, POINTS) as w:
+        assert path.stat().st_size == whole
+        w.append(np.full(POINTS, 2, np.uint8), _preamble(), channel=2)
+    assert path.stat().st_size == whole + itemsize
+    with archive.Reader(path) as r:
+        assert r.codes[:, 0].tolist() == [1, 2]
+        assert r.channels.tolist() == [0, 2]
+
+
+@pytest.mark.parametrize('format', ['BYTE', 'WORD'])
+def test_capture(tmp_path, format):
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = sim.Instrument(scope)
+    osc.setWGenSin(inst, 2, 0, 1e3)
+    path = tmp_path / 'run.wfm'
+    assert archive.capture(inst, path, [1, 2], count=3, format=format) == 6
+
+    with archive.Reader(path) as r:
+        assert r.channels.tolist() == [1, 2] * 3
+        atol = 8 / (256 if format == 'BYTE' else 65536)
+        np.testing.assert_allclose(r.volts(0), scope._samples(1), atol=atol)
+        np.testing.assert_allclose(r.volts(5), scope._samples(2), atol=atol)
+
+    with pytest.raises(ValueError):
+        archive.capture(inst, tmp_path / 'ascii.wfm', 1, 1, format='ASCii')
+
+
+class _Resizing(sim.Instrument):
+    """Changes the record length before the second acquisition and counts the downloads."""
+
+    def __init__(self, resize: int, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resize = resize
+        self.digitized = 0
+        self.downloads = 0
+
+    def write(self, cmd: str) -> None:
+        if cmd.startswith(':DIGitize'):
+            self.digitized += 1
+            if self.digitized == 2:
+                super().write(f':WAVeform:POINts {self.resize}')
+        if cmd == ':WAVeform:DATA?':
+            self.downloads += 1
+        super().write(cmd)
+
+
+def test_capture_stops_when_the_record_grows(tmp_path):
+    inst = _Resizing(POINTS, points=POINTS)
+    path = tmp_path / 'run.wfm'
+    with pytest.raises(ValueError, match=f'now records {POINTS} points'):
+        archive.capture(inst, path, 1, count=3, points=POINTS // 2)
+    # the grown block is drained, not downloaded again
+    assert inst.downloads == 2
+    assert inst.query('*OPC?') == '1'
+    with archive.Reader(path) as r:
+        assert len(r) == 1
+        assert r.preamble(0).points == POINTS // 2
+
+
+def test_capture_keeps_shorter_records(tmp_path):
+    inst = _Resizing(POINTS // 4, points=POINTS)
+    path = tmp_path / 'run.wfm'
+    assert archive.capture(inst, path, 1, count=2) == 2
+    with archive.Reader(path) as r:
+        assert [r.preamble(i).points for i in range(2)] == [POINTS, POINTS // 4]
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from pyscpi import scpi
+from pyscpi.block import BlockSizeError
+
+from conftest import block
+
+
+async def _serve(replies: dict, delays: dict = {}):
+    """Starts a server answering each query line from replies, after an optional delay."""
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            cmd = line.rstrip(b'\n').decode()
+            await asyncio.sleep(delays.get(cmd, 0))
+            if cmd in replies:
+                writer.write(replies[cmd])
+                await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[:2]
+
+
+def _run(test, replies, delays={}, **kwargs):
+    async def main():
+        server, address = await _serve(replies, delays)
+        async with server:
+            inst = await scpi.AsyncInstrument.connect(*address, **kwargs)
+            try:
+                return await test(inst)
+            finally:
+                await inst.close()
+
+    return asyncio.run(main())
+
+
+REPLIES = {
+    '*IDN?': b'KEYSIGHT,DSOX1204G\n',
+    '*OPC?': b'1\n',
+    ':WAVeform:DATA?': block(bytes(range(256)) * 40),
+    'ERR?': b'-113,"Undefined header"\n',
+}
+
+
+def test_pipelined_queries_in_any_order():
+    async def test(inst):
+        idn = inst.query('*IDN?')
+        data = inst.query_block(':WAVeform:DATA?')
+        opc = inst.query('*OPC?')
+        assert await opc == '1'
+        assert await data == bytes(range(256)) * 40
+        assert await idn == 'KEYSIGHT,DSOX1204G'
+
+    # a slow first response must not reorder the others
+    _run(test, REPLIES, {'*IDN?': 0.05}, chunk_size=100)
+
+
+def test_unawaited_query_is_still_read():
+    async def test(inst):
+        inst.query('*IDN?')
+        assert await inst.query('*OPC?') == '1'
+
+    _run(test, REPLIES)
+
+
+def test_cancelled_wait_keeps_stream_aligned():
+    async def test(inst):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(inst.query_block(':WAVeform:DATA?'), 0.01)
+        assert await inst.query('*IDN?') == 'KEYSIGHT,DSOX1204G'
+
+    _run(test, REPLIES, {':WAVeform:DATA?': 0.1})
+
+
+def test_block_errors_skip_the_response():
+    async def test(inst):
+        with pytest.raises(ValueError, match='Invalid block header'):
+            await inst.query_block('ERR?')
+        with pytest.raises(BlockSizeError):
+            await inst.query_block(':WAVeform:DATA?', bytearray(16))
+        assert await inst.query('*OPC?') == '1'
+
+    _run(test, REPLIES)
+
+
+def test_line_over_limit_is_skipped():
+    replies = dict(REPLIES, LONG=b'x' * 1000 + b'\n')
+
+    async def test(inst):
+        with pytest.raises(asyncio.LimitOverrunError):
+            await inst.query('LONG')
+        assert await inst.query('*OPC?') == '1'
+
+    _run(test, replies, limit=100)
@@ -0,0 +1,105 @@
+import socket
+import threading
+
+import pytest
+
+from pyscpi import scpi
+from pyscpi.keysight import osc
+
+
+@pytest.fixture
+def inst():
+    """An Instrument connected to a server that records every message and answers queries with '1'."""
+    listener = socket.create_server(('127.0.0.1', 0))
+    messages = []
+
+    def serve():
+        conn, _ = listener.accept()
+        with conn, conn.makefile('rb') as lines:
+            for line in lines:
+                messages.append(line.rstrip(b'\n').decode())
+                if line.rstrip().endswith(b'?'):
+                    conn.sendall(b'1\n')
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    inst = scpi.Instrument(*listener.getsockname())
+    inst.messages = messages
+    yield inst
+    inst.close()
+    thread.join(5)
+    listener.close()
+
+
+def test_writes_are_joined(inst):
+    with inst.batch():
+        inst.write(':WGEN:FUNCtion SINusoid')
+        inst.write('WGEN:FREQuency 1000')
+        assert inst.messages == []
+    assert inst.query('*OPC?') == '1'
+    assert inst.messages == [':WGEN:FUNCtion SINusoid;:WGEN:FREQuency 1000', '*OPC?']
+
+
+def test_opc_closes_the_message(inst):
+    with inst.batch(opc=True):
+        inst.write(':TIMebase:SCALe 0.001')
+    assert inst.messages == [':TIMebase:SCALe 0.001;*OPC?']
+    assert inst._batch is None
+
+
+def test_query_flushes_with_the_query(inst):
+    with inst.batch():
+        inst.write(':WAVeform:SOURce CHANnel1')
+        assert inst.query(':WAVeform:POINts?') == '1'
+        inst.write(':RUN')
+    inst.query('*OPC?')
+    assert inst.messages == [':WAVeform:SOURce CHANnel1;:WAVeform:POINts?', ':RUN', '*OPC?']
+
+
+def test_split_at_max_size(inst):
+    commands = [f':CHANnel{i}:SCALe 0.5' for i in range(1, 5)]
+    with inst.batch(opc=True, max_size=50):
+        for cmd in commands:
+            inst.write(cmd)
+    assert inst.messages == [';'.join(commands[:2]), ';'.join(commands[2:]) + ';*OPC?']
+    assert all(len(message) <= 50 for message in inst.messages)
+
+
+def test_nested_batch_joins_outer(inst):
+    with inst.batch(opc=True) as outer:
+        assert inst.batch() is outer
+        osc.setTimeAxis(inst, 0.001, 0)
+        osc.setChannelAxis(inst, 1, 0.5, 0)
+        assert inst.messages == []
+    assert inst.messages == [
+        ':TIMebase:SCALe 0.001;:TIMebase:POSition 0;:CHANnel1:SCALe 0.5;:CHANnel1:OFFSet 0;*OPC?']
+
+
+def test_exception_discards_pending(inst):
+    with pytest.raises(RuntimeError):
+        with inst.batch(opc=True):
+            inst.write(':RUN')
+            raise RuntimeError
+    assert inst._batch is None
+    inst.query('*OPC?')
+    assert inst.messages == ['*OPC?']
+
+
+class _Plain:
+    """An instrument without batch(), like pyvisa."""
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, cmd):
+        self.messages.append(cmd)
+
+    def query(self, cmd):
+        self.messages.append(cmd)
+        return '1'
+
+
+def test_helpers_without_batch():
+    inst = _Plain()
+    osc.setTimeAxis(inst, 0.001, 0)
+    assert inst.messages == [':TIMebase:SCALe 0.001', ':TIMebase:POSition 0', '*OPC?']
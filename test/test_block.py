@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from pyscpi.block import BlockSizeError, data_view, header_size, parse_header
+from pyscpi.keysight import osc
+
+from conftest import block
+
+
+def test_header_size():
+    assert header_size(b'#8') == 10
+    assert header_size(memoryview(b'#1')) == 3
+    with pytest.raises(ValueError, match='Invalid block header'):
+        header_size(b'+1')
+    with pytest.raises(ValueError, match='Indefinite-length'):
+        header_size(b'#0')
+
+
+def test_parse_header():
+    assert parse_header(b'') is None
+    assert parse_header(b'#') is None
+    assert parse_header(b'#3') is None
+    assert parse_header(b'#312') is None
+    assert parse_header(b'#3123abc') == (5, 123)
+    with pytest.raises(ValueError):
+        parse_header(b'ab')
+
+
+def test_data_view():
+    view = data_view(None, 4)
+    assert len(view) == 4 and not view.readonly
+
+    buffer = np.zeros(3, dtype=np.int16)
+    view = data_view(buffer, 5)
+    view[:] = b'\x01' * 5
+    assert buffer[0] == 0x0101
+
+    with pytest.raises(BlockSizeError) as e:
+        data_view(bytearray(3), 4)
+    assert (e.value.length, e.value.size) == (4, 3)
+    assert isinstance(e.value, ValueError)
+
+
+@pytest.mark.parametrize('chunk', [None, 1, 7])
+def test_read_block(serve, chunk):
+    data = bytes(range(256)) * 4
+    inst = serve(block(data), block(b'xyz'), chunk=chunk)
+    assert inst.read_block() == data
+
+    buffer = bytearray(8)
+    view = inst.read_block(buffer)
+    assert view == b'xyz'
+    assert view.obj is buffer
+
+
+def test_read_block_too_small(serve):
+    inst = serve(block(b'0123456789'), block(b'ok'))
+    with pytest.raises(BlockSizeError):
+        inst.read_block(bytearray(4))
+    # the rejected block is drained, the next one is intact
+    assert inst.read_block() == b'ok'
+
+
+def test_read_block_invalid_header(serve):
+    inst = serve(b'-113,"Undefined header"\n', block(b'ok'))
+    with pytest.raises(ValueError, match='Invalid block header'):
+        inst.read_block()
+    assert inst.read_block() == b'ok'
+
+
+class _RawOnly:
+    """An instrument with only read_raw, like pyvisa."""
+
+    def __init__(self, data: bytes, chunk: int):
+        self.data = data
+        self.chunk = chunk
+
+    def read_raw(self, size=None):
+        data, self.data = self.data[:self.chunk], self.data[self.chunk:]
+        return data
+
+
+@pytest.mark.parametrize('chunk', [1, 3, 1024])
+def test_read_raw_fallback(chunk):
+    data = bytes(range(200)) * 10
+    out = osc._read_large_data_bytes_np(_RawOnly(block(data), chunk), False)
+    assert out.dtype == np.uint8
+    assert out.tobytes() == data
+
+
+def test_read_raw_fallback_into_buffer():
+    out = np.zeros(300, dtype=np.uint8)
+    data = bytes(range(200))
+    inst = _RawOnly(block(data) + block(b'next'), 16)
+    view = osc._read_large_data_bytes_np(inst, False, out[50:])
+    assert np.shares_memory(view, out)
+    assert out[50:250].tobytes() == data
+
+    with pytest.raises(BlockSizeError):
+        osc._read_large_data_bytes_np(_RawOnly(block(data) + block(b'next'), 16), False, out[:100])
@@ -0,0 +1,281 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+usb = pytest.importorskip('usb')
+
+from pyscpi import fakeusb, usbtmc
+from pyscpi.block import BlockSizeError, parse_header
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 5000
+
+
+def _expected(scope: sim.Oscilloscope) -> bytes:
+    # the waveform does not change until the next :DIGitize, so the simulator
+    # itself tells what the device must deliver
+    inst = sim.Instrument(scope)
+    inst.write(':WAVeform:DATA?')
+    return bytes(inst.read_block())
+
+
+def _open(scope, read_ahead=0, **kwargs):
+    return usbtmc.Instrument(device=fakeusb.device(scope, **kwargs), read_ahead=read_ahead)
+
+
+def _openSplit(scope, read_ahead=0, **kwargs):
+    inst = _open(scope, read_ahead, **kwargs)
+    inst.open()
+    # several transfers per block
+    inst.max_transfer_size = 4096 - usbtmc.USBTMC_HEADER_SIZE
+    return inst
+
+
+def test_query():
+    inst = _open(sim.Oscilloscope(POINTS))
+    assert inst.ask('*IDN?').startswith('KEYSIGHT TECHNOLOGIES')
+    inst.write(':TIMebase:SCALe 2E-3;:TIMebase:POSition 1E-4')
+    assert inst.ask(':TIMebase:SCALe?;POSition?') == '+2.000000E-03;+1.000000E-04'
+
+
+@pytest.mark.parametrize('max_packet_size', [64, 512])
+def test_read_single_channel(max_packet_size):
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = _open(scope, max_packet_size=max_packet_size)
+    osc.setWGenDC(inst, 0.75)
+    t, v = osc.readSingleChannel(inst, 1, runAfter=False)
+    assert len(t) == len(v) == POINTS
+    np.testing.assert_allclose(v, 0.75, atol=8 / 256)
+
+
+@pytest.mark.parametrize('max_packet_size', [64, 512])
+def test_read_block(max_packet_size):
+    scope = sim.Oscilloscope(POINTS, seed=0)
+    inst = _openSplit(scope, max_packet_size=max_packet_size)
+    expected = _expected(scope)
+
+    inst.write(':WAVeform:DATA?')
+    assert bytes(inst.read_block()) == expected
+
+    inst.write(':WAVeform:DATA?')
+    raw = inst.read_raw()
+    # the transfers are joined in place, not copied again into bytes
+    assert isinstance(raw, bytearray)
+    start, length = parse_header(raw)
+    assert raw[start:start + length] == expected
+
+    buffer = bytearray(len(raw) + 10)
+    inst.write(':WAVeform:DATA?')
+    assert inst.read_into(buffer) == len(raw)
+    assert buffer[:len(raw)] == raw
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'short_packet': 1000},
+    {'short_packet': 1, 'max_packet_size': 64},
+    {'idVendor': fakeusb.RIGOL_VID, 'idProduct': 0x04ce},
+    {'idVendor': fakeusb.RIGOL_VID, 'idProduct': 0x0588},
+    {'idVendor': fakeusb.RIGOL_VID, 'idProduct': 0x04ce, 'short_packet': 3000},
+], ids=['short', 'single-byte', 'rigol-04ce', 'rigol-0588', 'rigol-short'])
+def test_read_block_quirks(kwargs):
+    scope = sim.Oscilloscope(POINTS, seed=0)
+    inst = _openSplit(scope, **kwargs)
+    assert inst.rigol_quirk == (kwargs.get('idVendor') == fakeusb.RIGOL_VID)
+    assert inst.query('*IDN?').startswith('KEYSIGHT')
+
+    inst.write(':WAVeform:DATA?')
+    assert bytes(inst.read_block()) == _expected(scope)
+
+    inst.write(':WAVeform:DATA?')
+    raw = inst.read_raw()
+    start, length = parse_header(raw)
+    assert length == POINTS
+    # the 0x04ce workaround cuts the response at the end of the block
+    assert raw[start:start + length] == _expected(scope)
+
+    t, v = osc.readChannels(inst, [1, 2])
+    assert v.shape == (POINTS, 2)
+    inst.close()
+
+
+def test_advantest():
+    responder = fakeusb.Responder({'*IDN?': 'ADVANTEST,R6441,0,1.0',
+                                   re.compile(r':MEAS:VOLT\?'): lambda cmd: '1.25'})
+    inst = usbtmc.Instrument(device=fakeusb.device(responder, idVendor=fakeusb.ADVANTEST_VID, idProduct=0x0001))
+    assert inst.query('*IDN?') == 'ADVANTEST,R6441,0,1.0'
+    assert inst.advantest_quirk
+    assert float(inst.query(':MEAS:VOLT?')) == 1.25
+    assert responder.log == ['*IDN?', ':MEAS:VOLT?']
+    # the device never sets EOM, so every response is read in one transfer
+    assert inst.max_transfer_size == 63
+    assert inst.tune('*IDN?') == 63
+    assert inst.advantest_read_myid() == 1
+    assert not inst.advantest_locked
+    inst.close()
+
+
+@pytest.mark.parametrize('direction', ['in', 'out'])
+def test_inject_timeout(direction):
+    dev = fakeusb.device(fakeusb.Responder({'*IDN?': 'ACME,X1,0,1.0'}))
+    inst = usbtmc.Instrument(device=dev)
+    assert inst.query('*IDN?') == 'ACME,X1,0,1.0'
+    dev.fake.inject_timeout(direction=direction)
+    with pytest.raises(usb.core.USBError) as e:
+        inst.query('*IDN?')
+    assert e.value.errno == 110
+    # the aborted transfer leaves nothing behind
+    assert inst.query('*IDN?') == 'ACME,X1,0,1.0'
+    inst.close()
+
+
+@pytest.mark.parametrize('interrupt', [True, False])
+def test_read_stb(interrupt):
+    dev = fakeusb.device(fakeusb.Responder({'*IDN?': 'ACME,X1,0,1.0'}), interrupt=interrupt)
+    inst = usbtmc.Instrument(device=dev)
+    inst.open()
+    assert (inst.interrupt_in_ep is not None) == interrupt
+    dev.fake.status_byte = 0x10
+    assert inst.read_stb() == 0x10
+    inst.close()
+
+
+@pytest.mark.parametrize('read_ahead', [0, 2])
+def test_read_block_errors(read_ahead):
+    scope = sim.Oscilloscope(POINTS, seed=0)
+    inst = _openSplit(scope, read_ahead)
+
+    inst.write(':WAVeform:DATA?')
+    with pytest.raises(BlockSizeError) as e:
+        inst.read_block(np.empty(100, dtype=np.uint8))
+    assert e.value.length == POINTS
+    assert inst.ask('*IDN?').startswith('KEYSIGHT')
+
+    inst.write('*IDN?')
+    with pytest.raises(ValueError, match='Invalid block header'):
+        inst.read_block()
+    assert inst.ask('*OPC?') == '1'
+
+    buffer = np.zeros(POINTS + 10, dtype=np.uint8)
+    inst.write(':WAVeform:DATA?')
+    assert len(inst.read_block(buffer)) == POINTS
+    assert bytes(buffer[:POINTS]) == _expected(scope)
+
+
+@pytest.mark.parametrize('max_packet_size', [64, 512])
+def test_tune(monkeypatch, max_packet_size):
+    monkeypatch.setattr(usbtmc, '_transfer_sizes', {})
+    scope = sim.Oscilloscope(POINTS, seed=0)
+    inst = _open(scope, max_packet_size=max_packet_size, serial='TUNE0001')
+    size = inst.tune(':WAVeform:DATA?', sizes=[1000, 4096, 20000], repeat=1)
+    assert len(inst.transfer_rates) == 3
+    # full transfers fill whole packets
+    assert all((s + usbtmc.USBTMC_HEADER_SIZE) % max_packet_size == 0 for s in inst.transfer_rates)
+    assert size in inst.transfer_rates and inst.max_transfer_size == size
+    # the size still reads whole blocks
+    inst.write(':WAVeform:DATA?')
+    assert bytes(inst.read_block()) == _expected(scope)
+
+    # another instrument on the same device starts with the tuned size
+    other = _open(scope, max_packet_size=max_packet_size, serial='TUNE0001')
+    other.open()
+    assert other.max_transfer_size == size
+    fresh = _open(scope, max_packet_size=max_packet_size, serial='TUNE0002')
+    fresh.open()
+    assert fresh.max_transfer_size == 1024 * 1024
+
+
+def test_tune_on_open(monkeypatch):
+    monkeypatch.setattr(usbtmc, '_transfer_sizes', {})
+    inst = usbtmc.Instrument(device=fakeusb.device(sim.Oscilloscope(POINTS)), tune='*IDN?')
+    inst.open()
+    assert inst.transfer_rates
+    assert usbtmc._transfer_sizes[inst._device_key()] == inst.max_transfer_size
+
+
+def test_tune_in_threads(monkeypatch):
+    monkeypatch.setattr(usbtmc, '_transfer_sizes', {})
+    insts = [_open(sim.Oscilloscope(POINTS), serial=f'T{i}') for i in range(4)]
+    with ThreadPoolExecutor(len(insts)) as pool:
+        sizes = list(pool.map(lambda inst: inst.tune(':WAVeform:DATA?', sizes=[1000, 8000], repeat=1), insts))
+    assert usbtmc._transfer_sizes == {inst._device_key(): size for inst, size in zip(insts, sizes)}
+
+
+@pytest.mark.parametrize('read_ahead', [1, 3])
+def test_read_ahead(read_ahead):
+    scope = sim.Oscilloscope(POINTS, seed=0)
+    inst = _openSplit(scope, read_ahead, max_packet_size=64)
+    expected = _expected(scope)
+    for _ in range(3):
+        inst.write(':WAVeform:DATA?')
+        assert bytes(inst.read_block()) == expected
+    # short replies are read inline
+    assert inst.ask('*IDN?').startswith('KEYSIGHT')
+
+    # a response abandoned halfway is drained before the next one
+    inst.write(':WAVeform:DATA?')
+    chunks = inst._read_chunks()
+    next(chunks)
+    next(chunks)
+    chunks.close()
+    assert inst.ask('*IDN?').startswith('KEYSIGHT')
+    inst.close()
+
+
+class _CountingBackend(fakeusb.Backend):
+    """A fake bus that counts the scans."""
+
+    scans = 0
+
+    def enumerate_devices(self):
+        self.scans += 1
+        return super().enumerate_devices()
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    monkeypatch.setattr(usbtmc, '_device_index', None)
+    monkeypatch.setattr(usbtmc, '_device_backend', None)
+    scope = sim.Oscilloscope(POINTS)
+    backend = _CountingBackend(fakeusb.FakeDevice(scope, serial='A1'),
+                               fakeusb.FakeDevice(scope, serial='B2'))
+    usbtmc.refresh_devices(backend)
+    return backend
+
+
+def test_device_index(bus):
+    assert bus.scans == 1
+    assert sorted(usbtmc.list_resources()) == ['USB::10893::918::A1::INSTR', 'USB::10893::918::B2::INSTR']
+
+    a = usbtmc.Instrument(0x2a8d, 0x0396, 'A1')
+    b = usbtmc.Instrument('USB::0x2a8d::0x0396::B2::INSTR')
+    assert a.device.serial_number == 'A1' and b.device.serial_number == 'B2'
+    assert a.ask('*IDN?').startswith('KEYSIGHT')
+    assert bus.scans == 1
+
+    # a device plugged in since the last scan is found by a rescan
+    bus.devices.append(fakeusb.FakeDevice(sim.Oscilloscope(POINTS), serial='C3'))
+    assert usbtmc.find_device(0x2a8d, 0x0396, 'C3').serial_number == 'C3'
+    assert bus.scans == 2
+
+    usbtmc.invalidate_devices()
+    usbtmc.list_resources()
+    assert bus.scans == 3
+    usbtmc.list_resources(refresh=True)
+    assert bus.scans == 4
+    a.close()
+
+
+def test_missing_device_scans_once(bus):
+    # a warm index is rescanned once on a miss
+    assert usbtmc.find_device(0x2a8d, 0x0396, 'Z9') is None
+    assert bus.scans == 2
+
+    # an index just built is not scanned again
+    usbtmc.invalidate_devices()
+    assert usbtmc.find_device(0x2a8d, 0x0396, 'Z9') is None
+    assert bus.scans == 3
+    assert usbtmc.find_device(0x2a8d, 0x0396, 'Z9', refresh=True) is None
+    assert bus.scans == 4
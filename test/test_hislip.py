@@ -0,0 +1,169 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pyscpi import hislip, status
+from pyscpi.block import BlockSizeError
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 5000
+
+
+@pytest.fixture
+def server():
+    with sim.HislipServer(sim=sim.Oscilloscope(POINTS, seed=0)) as srv:
+        yield srv
+
+
+@pytest.fixture
+def inst(server):
+    inst = hislip.Instrument(*server.address, timeout=5)
+    yield inst
+    inst.close()
+
+
+def _wait_mav(inst, timeout=5):
+    deadline = time.perf_counter() + timeout
+    while not inst.read_stb() & status.MAV:
+        assert time.perf_counter() < deadline, 'no message available'
+        time.sleep(0.005)
+
+
+def test_handshake(server):
+    inst = hislip.Instrument(*server.address, timeout=5, max_message_size=4096)
+    try:
+        assert inst.session_id >= 1
+        assert not inst.overlapped
+        assert inst.server_version == hislip.PROTOCOL_VERSION
+        assert inst.server_vendor == 'KS'
+        assert inst.max_message_size == 2**20
+        assert inst.message_id == hislip.FIRST_MESSAGE_ID
+    finally:
+        inst.close()
+
+
+def test_query(inst):
+    first = inst.message_id
+    assert inst.query('*IDN?').startswith('KEYSIGHT TECHNOLOGIES')
+    assert inst.response_id == first
+    assert inst.message_id == first + 2
+    assert float(inst.query(':TIMebase:SCALe?')) > 0
+
+
+def test_read_block_in_small_messages(server):
+    # the server splits the block into Data messages of at most 100 bytes
+    inst = hislip.Instrument(*server.address, timeout=5, max_message_size=100)
+    try:
+        inst.write(':WAVeform:FORMat BYTE')
+        inst.write(':WAVeform:POINts MAXimum')
+        inst.write(':WAVeform:DATA?')
+        block = inst.read_block()
+        assert len(block) == POINTS
+
+        inst.write(':WAVeform:DATA?')
+        buffer = np.empty(POINTS, dtype=np.uint8)
+        assert np.array_equal(np.asarray(inst.read_block(buffer)), np.frombuffer(block, np.uint8))
+
+        inst.write(':WAVeform:DATA?')
+        with pytest.raises(BlockSizeError):
+            inst.read_block(bytearray(10))
+        assert inst.query('*IDN?').startswith('KEYSIGHT')
+
+        t, v = osc.readSingleChannel(inst, 1)
+        assert v.shape == (POINTS,)
+    finally:
+        inst.close()
+
+
+def test_overlapped_pipelining():
+    with sim.HislipServer(points=POINTS, overlapped=True) as srv:
+        inst = hislip.Instrument(*srv.address, timeout=5)
+        try:
+            assert inst.overlapped
+            inst.write(':TIMebase:SCALe 0.002')
+            inst.write('*IDN?')
+            inst.write(':TIMebase:SCALe?')
+            inst.write(':WAVeform:DATA?')
+            assert inst.read().startswith('KEYSIGHT')
+            assert float(inst.read()) == 0.002
+            assert len(inst.read_block()) == POINTS
+        finally:
+            inst.close()
+
+
+def test_clear(inst):
+    inst.write('*IDN?')
+    _wait_mav(inst)
+    inst.clear()
+    assert inst.message_id == hislip.FIRST_MESSAGE_ID
+    # the response discarded by the clear does not turn up here
+    assert float(inst.query(':TIMebase:SCALe?')) > 0
+
+
+def test_read_stb(inst):
+    assert not inst.read_stb() & status.MAV
+    inst.write('*IDN?')
+    _wait_mav(inst)
+    assert inst.read().startswith('KEYSIGHT')
+    assert not inst.read_stb() & status.MAV
+
+
+def test_wait_srq():
+    with sim.HislipServer(sim=sim.Oscilloscope(POINTS, digitize_time=0.1)) as srv:
+        inst = hislip.Instrument(*srv.address, timeout=5)
+        try:
+            assert inst.wait_srq(0.05) is None
+
+            status.enable(inst)
+            op = status.start(inst, ':DIGitize CHANnel1')
+            # the connection stays usable while the oscilloscope digitizes
+            assert inst.query('*IDN?').startswith('KEYSIGHT')
+            stb = inst.wait_srq(5)
+            assert stb is not None and stb & status.RQS
+            op.wait(5)
+            assert op.complete
+        finally:
+            inst.close()
+
+
+def test_read_block_invalid_header(inst):
+    inst.write('*IDN?')
+    with pytest.raises(ValueError, match='Invalid block header'):
+        inst.read_block()
+    # the rest of the response was dropped
+    assert inst.query('*OPC?') == '1'
+
+
+def _fake_async_channel(inst):
+    # swaps the asynchronous channel for a socket the test writes to
+    inst.a.close()
+    inst.a, peer = socket.socketpair()
+    inst.a.settimeout(inst.timeout)
+    return peer
+
+
+def test_wait_srq_reads_the_whole_message(inst):
+    peer = _fake_async_channel(inst)
+    message = hislip.HEADER.pack(b'HS', hislip.ASYNC_SERVICE_REQUEST, 0x60, 0, 0)
+    peer.sendall(message[:5])
+    timer = threading.Timer(0.1, peer.sendall, [message[5:]])
+    timer.start()
+    # the message started within the timeout, so it is read to its end
+    assert inst.wait_srq(0.01) == 0x60
+    timer.join()
+    assert inst.wait_srq(0.01) is None
+    peer.close()
+
+
+def test_wait_srq_closes_a_stalled_channel(inst):
+    peer = _fake_async_channel(inst)
+    inst.a.settimeout(0.05)
+    peer.sendall(hislip.HEADER.pack(b'HS', hislip.ASYNC_SERVICE_REQUEST, 0x60, 0, 0)[:5])
+    with pytest.raises(socket.timeout):
+        inst.wait_srq(1)
+    assert inst.a.fileno() == -1
+    peer.close()
@@ -0,0 +1,326 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from pyscpi import scpi
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 2000
+
+
+@pytest.fixture
+def server():
+    with sim.Server(sim=sim.Oscilloscope(POINTS, noise=0, seed=0)) as srv:
+        yield srv
+
+
+@pytest.fixture
+def servers():
+    servers = [sim.Server(sim=sim.Oscilloscope(POINTS, noise=0, seed=n)).start() for n in range(3)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def test_read_instruments(servers):
+    insts = [scpi.Instrument(*server.address) for server in servers]
+    try:
+        for inst, level in zip(insts, (-1, 0, 1)):
+            osc.setWGenDC(inst, level)
+        results = osc.readInstruments(insts, [[1], [1, 2], [3]], runAfter=False)
+    finally:
+        for inst in insts:
+            inst.close()
+
+    assert [r.inst for r in results] == insts
+    assert [r.channels for r in results] == [[1], [1, 2], [3]]
+    assert results[1].volt.shape == (POINTS, 2)
+    for r, level in zip(results, (-1, 0, 1)):
+        np.testing.assert_allclose(r.volt, level, atol=8 / 256)
+        assert r.armed >= 0 and r.elapsed > 0
+    assert min(r.armed for r in results) == 0
+
+
+def test_read_instruments_shared_channels():
+    insts = [sim.Instrument(points=POINTS) for _ in range(2)]
+    results = osc.readInstruments(insts, [2, 4], runAfter=False)
+    assert all(r.channels == [2, 4] and r.volt.shape == (POINTS, 2) for r in results)
+
+
+def test_read_instruments_empty():
+    assert osc.readInstruments([], []) == []
+    with pytest.raises(ValueError):
+        osc.readInstruments([sim.Instrument(points=POINTS)], [[1], [2]])
+
+
+class _Recorder(sim.Instrument):
+    """An in-process instrument that records the commands written."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+
+    def write(self, cmd: str) -> None:
+        self.commands.append(cmd)
+        super().write(cmd)
+
+
+def test_stream():
+    inst = _Recorder(sim.Oscilloscope(POINTS, noise=0, seed=0))
+    osc.setWGenDC(inst, 0.5)
+    frames = [(t, v.copy()) for t, v in osc.stream(inst, 1, count=3)]
+    assert len(frames) == 3
+    for t, v in frames:
+        assert t.shape == v.shape == (POINTS,)
+        np.testing.assert_allclose(v, 0.5, atol=8 / 256)
+
+    # one preamble, one arm per frame, and the scope left running
+    assert inst.commands.count(':WAVeform:PREamble?') == 1
+    assert inst.commands.count(':DIGitize CHANnel1') == 3
+    assert inst.commands[-1] == ':RUN'
+
+
+def test_stream_reuses_two_buffers():
+    inst = sim.Instrument(points=POINTS)
+    frames = [v for _, v in osc.stream(inst, [1, 2], count=4, runAfter=False)]
+    assert frames[0].shape == (POINTS, 2)
+    assert np.shares_memory(frames[0], frames[2])
+    assert not np.shares_memory(frames[0], frames[1])
+
+
+def test_stream_arms_after_every_channel():
+    inst = _Recorder(points=POINTS)
+    frames = osc.stream(inst, [1, 3], count=2, runAfter=False)
+    next(frames)
+    commands = inst.commands[inst.commands.index(':WAVeform:DATA?'):]
+    assert commands == [':WAVeform:DATA?', ':WAVeform:SOURce CHANnel3', ':WAVeform:DATA?',
+                        ':DIGitize CHANnel1, CHANnel3']
+    frames.close()
+
+
+def test_stream_close_runs():
+    inst = _Recorder(points=POINTS)
+    frames = osc.stream(inst, [1, 3])
+    next(frames)
+    frames.close()
+    assert inst.commands[-1] == ':RUN'
+
+
+def test_decode():
+    block = np.array([1, 256, 65535], dtype='<u2').tobytes()
+    assert osc._decode(block, 'WORD', 'LSBFirst').tolist() == [1, 256, 65535]
+    assert osc._decode(block, 'WORD', 'MSBFirst').tolist() == [256, 1, 65535]
+    assert osc._decode(b'\x00\x80\xff', 'BYTE', 'LSBFirst').tolist() == [0, 128, 255]
+    assert osc._decode(b'+1.0E-01,-2.5E+00', 'ASCii', 'LSBFirst').tolist() == [0.1, -2.5]
+    assert osc._formatName('asc') == 'ASCii'
+    with pytest.raises(ValueError):
+        osc._formatName('REAL')
+
+
+@pytest.mark.parametrize('format, byteOrder, atol', [
+    ('BYTE', 'LSBFirst', 8 / 256),
+    ('WORD', 'LSBFirst', 8 / 65536),
+    ('WORD', 'MSBFirst', 8 / 65536),
+    ('ASCii', 'LSBFirst', 1e-6),
+])
+def test_formats(format, byteOrder, atol):
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = sim.Instrument(scope)
+    osc.setWGenSin(inst, 2, 0.1, 1e3)
+    _, v = osc.readSingleChannel(inst, 1, runAfter=False, format=format, byteOrder=byteOrder)
+    expected = scope._samples(1)
+    np.testing.assert_allclose(v, expected, atol=atol)
+
+    _, v = osc.readChannels(inst, [1, 2], runAfter=False, format=format, byteOrder=byteOrder)
+    np.testing.assert_allclose(v[:, 1], scope._samples(2), atol=atol)
+
+    _, v = next(osc.stream(inst, 1, count=1, runAfter=False, format=format, byteOrder=byteOrder))
+    np.testing.assert_allclose(v, scope._samples(1), atol=atol)
+
+
+def test_read_channels_per_channel_preamble():
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = _Recorder(scope)
+    osc.setChannelAxis(inst, 1, 0.1, 0)
+    osc.setChannelAxis(inst, 2, 2.0, 0.5)
+    osc.setWGenSin(inst, 0.6, 0, 1e3)
+    inst.commands = []
+    _, v = osc.readChannels(inst, [1, 2], runAfter=False, dtype=np.float32)
+    assert v.dtype == np.float32
+    # each channel is scaled with its own yinc, so the fine channel resolves better
+    np.testing.assert_allclose(v[:, 0], scope._samples(1), atol=0.8 / 256)
+    np.testing.assert_allclose(v[:, 1], scope._samples(2), atol=16 / 256)
+    assert inst.commands.count('*OPC?') == 1
+    assert inst.commands.count(':WAVeform:PREamble?') == 2
+
+
+def test_to_volts_length_mismatch():
+    pream = osc.Preamble('+0', '+0', 4, 1.0, 0.0, 0.0, 1.0, 0.0, 128.0)
+    out = np.empty(4)
+    osc._toVoltsInto(np.full(4, 130, dtype=np.uint8), pream, 'BYTE', out)
+    assert out.tolist() == [2.0] * 4
+    with pytest.raises(ValueError):
+        osc._toVoltsInto(np.zeros(3, dtype=np.uint8), pream, 'BYTE', out)
+
+
+def test_time_base_indexing():
+    tb = osc.TimeBase(100, 1e-3, -0.05, 0)
+    t = np.asarray(tb)
+    assert len(tb) == 100 and tb.shape == (100,)
+    np.testing.assert_allclose(t, np.arange(100) * 1e-3 - 0.05)
+    assert tb[0] == pytest.approx(-0.05)
+    assert tb[-1] == pytest.approx(t[-1])
+    np.testing.assert_allclose(tb[10:20:3], t[10:20:3])
+    np.testing.assert_allclose(tb[::-1], t[::-1])
+    np.testing.assert_allclose(tb[[1, 5, 7]], t[[1, 5, 7]])
+    assert np.asarray(tb, dtype=np.float32).dtype == np.float32
+    with pytest.raises(IndexError):
+        tb[100]
+
+
+def test_time_base_conversions():
+    tb = osc.TimeBase(1000, 2e-6, 1e-3, 10)
+    assert tb.timeToIndex(tb.indexToTime(123)) == 123
+    np.testing.assert_array_equal(tb.timeToIndex(tb[[0, 999]]), [0, 999])
+    assert tb.timeToIndex(tb.indexToTime(-5)) == -5
+
+
+def test_lazy_time_matches_array():
+    inst = sim.Instrument(points=POINTS)
+    t, _ = osc.readSingleChannel(inst, 1, runAfter=False)
+    tb, _ = osc.readChannels(inst, [1, 2], runAfter=False, lazyTime=True)
+    assert isinstance(tb, osc.TimeBase)
+    np.testing.assert_allclose(np.asarray(tb), t)
+    tb, _ = next(osc.stream(inst, 1, count=1, runAfter=False, lazyTime=True))
+    np.testing.assert_allclose(np.asarray(tb), t)
+
+
+def _preambleQueries(inst) -> int:
+    count = inst.commands.count(':WAVeform:PREamble?')
+    inst.commands = []
+    return count
+
+
+def test_preamble_cache_key():
+    inst = _Recorder(points=POINTS)
+    osc.readSingleChannel(inst, 1, runAfter=False)
+    assert _preambleQueries(inst) == 1
+    osc.readSingleChannel(inst, 1, runAfter=False)
+    assert _preambleQueries(inst) == 0
+    # channel, format and points are all part of the key
+    osc.readSingleChannel(inst, 2, runAfter=False)
+    osc.readSingleChannel(inst, 1, runAfter=False, format='WORD')
+    _, v = osc.readSingleChannel(inst, 1, points=500, runAfter=False)
+    assert _preambleQueries(inst) == 3
+    assert len(v) == 500
+    osc.readChannels(inst, [1, 2], runAfter=False)
+    assert _preambleQueries(inst) == 0
+    osc.readSingleChannel(inst, 1, runAfter=False, refreshPreamble=True)
+    assert _preambleQueries(inst) == 1
+
+
+def test_preamble_cache_invalidation():
+    inst = _Recorder(points=POINTS)
+    osc.readChannels(inst, [1, 2], runAfter=False)
+    _preambleQueries(inst)
+
+    osc.setChannelAxis(inst, 2, 0.5, 0)
+    osc.readChannels(inst, [1, 2], runAfter=False)
+    assert _preambleQueries(inst) == 1
+
+    osc.setTimeAxis(inst, 2e-3, 0)
+    t, _ = osc.readChannels(inst, [1, 2], runAfter=False)
+    assert _preambleQueries(inst) == 2
+    assert t[1] - t[0] == pytest.approx(2e-2 / POINTS)
+
+    inst.write(':TIMebase:SCALe 1E-3')
+    osc.clearPreambleCache(inst, 1)
+    osc.readChannels(inst, [1, 2], runAfter=False)
+    assert _preambleQueries(inst) == 1
+    osc.clearPreambleCache(inst)
+    osc.readChannels(inst, [1, 2], runAfter=False)
+    assert _preambleQueries(inst) == 2
+
+
+def test_stale_preamble_is_read_again():
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = _Recorder(scope)
+    osc.readSingleChannel(inst, 1, runAfter=False)
+    # the record length changes behind the cache
+    scope.max_points = POINTS // 2
+    t, v = osc.readSingleChannel(inst, 1, runAfter=False)
+    assert len(t) == len(v) == POINTS // 2
+
+    scope.max_points = POINTS
+    frames = osc.stream(inst, [1, 2], count=3, runAfter=False)
+    _, v = next(frames)
+    assert v.shape == (POINTS, 2)
+    inst.write(':WAVeform:POINts 500')
+    _, v = next(frames)
+    assert v.shape == (500, 2)
+    # a record longer than the buffers is downloaded again and the buffers follow it
+    inst.write(':WAVeform:POINts MAXimum')
+    _, v = next(frames)
+    assert v.shape == (POINTS, 2)
+
+
+def test_async_preamble_cache(server):
+    async def main():
+        async with scpi.AsyncInstrument(*server.address) as inst:
+            _, a = await osc.readChannelsAsync(inst, [1, 2], runAfter=False)
+            server.sim.max_points = POINTS // 4
+            _, b = await osc.readChannelsAsync(inst, [1, 2], runAfter=False)
+            _, c = await osc.readSingleChannelAsync(inst, 1, runAfter=False)
+        return a, b, c
+
+    a, b, c = asyncio.run(main())
+    assert a.shape == (POINTS, 2)
+    assert b.shape == (POINTS // 4, 2)
+    assert len(c) == POINTS // 4
+
+
+@pytest.mark.parametrize('format', ['BYTE', 'WORD'])
+def test_raw_frames(format):
+    scope = sim.Oscilloscope(POINTS, noise=0, seed=0)
+    inst = sim.Instrument(scope)
+    osc.setWGenSin(inst, 2, 0, 1e3)
+    t, v = osc.readSingleChannel(inst, 1, runAfter=False, format=format)
+
+    frame = osc.readSingleChannel(inst, 1, runAfter=False, format=format, raw=True)
+    assert isinstance(frame, osc.WaveformFrame)
+    assert frame.channel == 1 and len(frame) == POINTS
+    assert frame.codes.dtype == (np.uint8 if format == 'BYTE' else np.dtype('<u2'))
+    np.testing.assert_allclose(frame.volts(), v)
+    np.testing.assert_allclose(frame.time(), t)
+    assert isinstance(frame.time(lazyTime=True), osc.TimeBase)
+    out = np.empty([POINTS, 2], dtype=np.float32)
+    frame.volts(out[:, 1])
+    np.testing.assert_allclose(out[:, 1], v, rtol=1e-6)
+
+    frames = osc.readChannels(inst, [1, 2], runAfter=False, format=format, raw=True)
+    assert [f.channel for f in frames] == [1, 2]
+    np.testing.assert_allclose(frames[0].volts(), v)
+
+    frames = [f for f in osc.stream(inst, [1, 2], count=2, runAfter=False, format=format, raw=True)]
+    assert all(len(f) == 2 and f[1].channel == 2 for f in frames)
+    np.testing.assert_allclose(frames[1][0].volts(), v)
+
+
+def test_raw_needs_binary_format():
+    inst = sim.Instrument(points=POINTS)
+    with pytest.raises(ValueError):
+        osc.readSingleChannel(inst, 1, format='ASCii', raw=True)
+
+
+def test_async_raw(server):
+    async def main():
+        async with scpi.AsyncInstrument(*server.address) as inst:
+            frame = await osc.readSingleChannelAsync(inst, 1, runAfter=False, raw=True)
+            frames = await osc.readChannelsAsync(inst, [1, 2], runAfter=False, raw=True, format='WORD')
+        return frame, frames
+
+    frame, frames = asyncio.run(main())
+    assert len(frame) == POINTS and frame.codes.dtype == np.uint8
+    assert [f.codes.dtype for f in frames] == [np.dtype('<u2')] * 2
@@ -0,0 +1,95 @@
+import pytest
+
+from pyscpi import ResourceManager, scpi
+from pyscpi.keysight import sim
+
+
+@pytest.mark.parametrize('a, b', [
+    ('TCPIP::Scope.local::5025::SOCKET', 'tcpip0::scope.LOCAL::05025::socket'),
+    ('USB::0x2A8D::0x0396::CN60000000::INSTR', 'USB0::10893::918::CN60000000::INSTR'),
+    ('USB::0x2A8D::0x0396::INSTR', 'usb::0x2a8d::0x396::instr'),
+    ('TCPIP::scope::hislip0::INSTR', 'TCPIP0::SCOPE::HiSLIP0,4880::INSTR'),
+])
+def test_same_key(a, b):
+    rm = ResourceManager()
+    assert rm._key(a) == rm._key(b)
+
+
+@pytest.mark.parametrize('a, b', [
+    ('TCPIP::scope::5025::SOCKET', 'TCPIP::scope::5024::SOCKET'),
+    ('USB::0x2A8D::0x0396::A1::INSTR', 'USB::0x2A8D::0x0396::A2::INSTR'),
+    ('USB::0x2A8D::0x0396::INSTR', 'USB::0x2A8D::0x0396::A1::INSTR'),
+    ('TCPIP::scope::hislip0::INSTR', 'TCPIP::scope::hislip1::INSTR'),
+    ('TCPIP::scope::hislip0::INSTR', 'TCPIP::scope::hislip0,4881::INSTR'),
+])
+def test_different_key(a, b):
+    rm = ResourceManager()
+    assert rm._key(a) != rm._key(b)
+
+
+def test_pooled_socket():
+    with sim.Server(points=100) as server, ResourceManager() as rm:
+        host, port = server.address
+        inst = rm.open_resource(f'TCPIP::{host}::{port}::SOCKET')
+        assert isinstance(inst, scpi.Instrument)
+        assert rm.open_resource(f'TCPIP0::{host}::{port}::SOCKET') is inst
+        assert inst.query('*OPC?') == '1'
+        assert f'TCPIP::{host}::{port}::SOCKET' in rm.list_resources()
+
+        # a closed connection is reopened on the next request
+        inst.close()
+        again = rm.open_resource(f'TCPIP::{host}::{port}::SOCKET')
+        assert again is not inst
+        assert again.query('*OPC?') == '1'
+
+        rm.close(f'TCPIP::{host}::{port}::SOCKET')
+        assert rm.pool == {}
+
+
+def test_pooled_usb(monkeypatch):
+    pytest.importorskip('usb')
+    from pyscpi import fakeusb, usbtmc
+
+    monkeypatch.setattr(usbtmc, '_device_index', None)
+    monkeypatch.setattr(usbtmc, '_device_backend', None)
+    usbtmc.refresh_devices(fakeusb.Backend(fakeusb.FakeDevice(sim.Oscilloscope(100), serial='A1')))
+
+    with ResourceManager() as rm:
+        inst = rm.open_resource('USB::0x2A8D::0x0396::A1::INSTR')
+        assert isinstance(inst, usbtmc.Instrument)
+        assert rm.open_resource('USB0::10893::918::A1::INSTR') is inst
+        assert inst.query('*IDN?').startswith('KEYSIGHT')
+        assert 'USB::10893::918::A1::INSTR' in rm.list_resources()
+
+        # a closed connection is opened again, not handed out
+        inst.close()
+        again = rm.open_resource('USB::0x2A8D::0x0396::A1::INSTR')
+        assert again is not inst and again.connected
+
+
+def test_options_must_match():
+    with sim.Server(points=100) as server, ResourceManager() as rm:
+        host, port = server.address
+        resource = f'TCPIP::{host}::{port}::SOCKET'
+        inst = rm.open_resource(resource, chunk_size=4096)
+        assert rm.open_resource(resource, chunk_size=4096) is inst
+        assert rm.open_resource(resource) is inst
+        with pytest.raises(ValueError, match='already open'):
+            rm.open_resource(resource, chunk_size=1024)
+
+        rm.close(resource)
+        assert rm.open_resource(resource, chunk_size=1024).chunk_size == 1024
+
+
+def test_visa_needs_pyvisa(monkeypatch):
+    import builtins
+    real_import = builtins.__import__
+
+    def no_pyvisa(name, *args, **kwargs):
+        if name == 'pyvisa':
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, '__import__', no_pyvisa)
+    with pytest.raises(ValueError, match='needs pyvisa'):
+        ResourceManager().open_resource('GPIB0::12::INSTR')
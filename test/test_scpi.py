@@ -0,0 +1,56 @@
+import socket
+
+import pytest
+
+from conftest import block
+
+
+@pytest.mark.parametrize('chunk', [None, 1, 5])
+def test_read_one_response_at_a_time(serve, chunk):
+    inst = serve(b'KEYSIGHT,DSOX1204G\n', b'1\n', b'+2.5E-3\r\n', chunk=chunk)
+    assert inst.read() == 'KEYSIGHT,DSOX1204G'
+    assert inst.read() == '1'
+    assert inst.read() == '+2.5E-3'
+
+
+def test_read_bytes_ignores_terminators(serve):
+    inst = serve(b'a\nb\nc\n')
+    assert inst.read_bytes(3) == b'a\nb'
+    assert inst.read_line() == b''
+    assert inst.read_line() == b'c'
+
+
+def test_read_raw_honours_chunk_size(serve):
+    inst = serve(b'0123456789\n', b'next\n')
+    inst.read_bytes(1)
+    # buffered bytes are returned before receiving again
+    assert inst.read_raw(4) == b'1234'
+    assert inst.read_raw(100).startswith(b'56789\n')
+
+
+def test_read_into_drains_buffer_first(serve):
+    inst = serve(b'1\n', block(b'abcdef'))
+    inst.read_bytes(1)
+    buffer = bytearray(4)
+    assert inst.read_into(buffer) > 0
+    assert buffer.startswith(b'\n#')
+
+
+def test_block_after_line(serve):
+    inst = serve(b'1\n', block(b'data'), b'2\n', chunk=3)
+    assert inst.read() == '1'
+    assert inst.read_block() == b'data'
+    assert inst.read() == '2'
+
+
+def test_nodelay(serve):
+    inst = serve(b'\n')
+    assert inst.s.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+
+
+def test_connection_closed(serve):
+    inst = serve(b'partial')
+    # the server closes the connection once it receives something
+    inst.write('*RST')
+    with pytest.raises(ConnectionError):
+        inst.read()
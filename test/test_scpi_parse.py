@@ -0,0 +1,23 @@
+import pytest
+
+from pyscpi.scpi_parse import short_header, split_message
+
+
+@pytest.mark.parametrize('header, short', [
+    (':wgen:freq', 'WGEN:FREQ'),
+    ('Timebase:Scale?', 'TIM:SCAL?'),
+    ('TIMEBASE:SCALE?', 'TIM:SCAL?'),
+    (':WAVeform:POINts:MODE', 'WAV:POIN:MODE'),
+    (':CHANnel2:OFFSet', 'CHAN2:OFFS'),
+    ('channel1:offset', 'CHAN1:OFFS'),
+    ('*rst', '*RST'),
+    ('*opc?', '*OPC?'),
+])
+def test_short_header(header, short):
+    assert short_header(header) == short
+
+
+def test_split_message():
+    assert split_message(':A 1; B "x;y" ;;*OPC?') == [':A 1', 'B "x;y"', '*OPC?']
+    assert split_message("DISP:TEXT 'a;b'") == ["DISP:TEXT 'a;b'"]
+    assert split_message('') == []
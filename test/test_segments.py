@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from pyscpi import scpi, status
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 10000
+
+
+@pytest.fixture
+def scope():
+    return sim.Oscilloscope(POINTS, noise=0, seed=0)
+
+
+@pytest.fixture
+def inst(scope):
+    with sim.Server(sim=scope) as server:
+        inst = scpi.Instrument(*server.address)
+        yield inst
+        inst.close()
+
+
+def test_single_channel(inst, scope):
+    osc.setWGenDC(inst, 0.5)
+    seg = osc.readSegments(inst, 1, 8, runAfter=False)
+    assert isinstance(seg, osc.Segments)
+    assert seg.channel == 1
+    assert seg.codes.shape == (8, POINTS // 8)
+    assert seg.codes.dtype == np.uint8
+
+    v = seg.volts()
+    assert v.shape == seg.codes.shape
+    np.testing.assert_allclose(v, 0.5, atol=8 / 256)
+    assert len(seg.time()) == POINTS // 8
+
+    # the trigger times start at the first segment and increase
+    assert seg.timestamps.shape == (8,)
+    assert seg.timestamps[0] == 0
+    assert np.all(np.diff(seg.timestamps) > 0)
+
+    # the acquisition mode is restored
+    assert inst.query(':ACQuire:MODE?') == 'RTIM'
+    assert scope.acquisition['MODE'] == 'RTIM'
+
+
+def test_channels_share_timestamps(inst):
+    osc.setWGenSquare(inst, -1, 1, 1e3, 50)
+    segs = osc.readSegments(inst, [1, 2], 4, points=500, format='WORD', runAfter=False)
+    assert [s.channel for s in segs] == [1, 2]
+    assert segs[0].timestamps is segs[1].timestamps
+    for s in segs:
+        assert s.codes.shape == (4, 500)
+        assert s.codes.dtype == np.dtype('<u2')
+        assert set(np.round(s.volts()[0], 1)) == {-1.0, 1.0}
+
+
+def test_every_segment_is_read():
+    with sim.Server(sim=sim.Oscilloscope(POINTS, noise=0.01, seed=0)) as server:
+        inst = scpi.Instrument(*server.address)
+        seg = osc.readSegments(inst, 3, 3, format='WORD', byteOrder='MSBFirst', runAfter=False)
+        inst.close()
+    assert seg.codes.dtype == np.dtype('>u2')
+    # every segment is its own trigger, not a copy of the first
+    assert not np.array_equal(seg.codes[0], seg.codes[1])
+    assert not np.array_equal(seg.codes[1], seg.codes[2])
+
+
+def test_with_status(inst, scope):
+    scope.digitize_time = 0.05
+    status.enable(inst)
+    seg = osc.readSegments(inst, 1, 2, timeout=2, runAfter=False)
+    assert seg.codes.shape == (2, POINTS // 2)
+
+
+def test_ascii_is_rejected(inst):
+    with pytest.raises(ValueError, match='raw codes'):
+        osc.readSegments(inst, 1, 2, format='ASCii')
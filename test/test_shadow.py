@@ -0,0 +1,100 @@
+import pytest
+
+from pyscpi import scpi, shadow
+from pyscpi.keysight import osc, sim
+
+
+class _Recorder(scpi.Instrument):
+    """An instrument that records the messages sent."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = []
+
+    def write(self, cmd: str) -> None:
+        if self._batch is None:
+            self.commands.append(cmd)
+        super().write(cmd)
+
+
+@pytest.fixture
+def inst():
+    with sim.Server(points=1000) as server:
+        inst = _Recorder(*server.address)
+        yield shadow.Shadow(inst)
+        inst.close()
+
+
+def test_skips_repeated_settings(inst):
+    inst.write(':TIMebase:SCALe 1E-3')
+    inst.write('tim:scal 0.001')
+    inst.write(':TIMebase:SCALe 1E-3;POSition 0')
+    assert inst.inst.commands == [':TIMebase:SCALe 1E-3', ':TIMebase:SCALe 1E-3;POSition 0']
+    assert inst.skipped == 1
+
+    inst.write(':DIGitize CHANnel1')
+    inst.write(':DIGitize CHANnel1')
+    inst.write(':WAVeform:FORMat BYTE')
+    inst.write(':WAVeform:FORMat byte')
+    assert inst.inst.commands[2:] == [':DIGitize CHANnel1'] * 2 + [':WAVeform:FORMat BYTE']
+
+
+def test_osc_helpers(inst):
+    for freq in (1e3, 2e3):
+        osc.setWGenSin(inst, 1.0, 0.0, freq)
+    # the second call only sends the frequency, joined with the *OPC? of the batch
+    assert inst.inst.commands[-1] == f':WGEN:FREQuency {2e3};*OPC?'
+
+
+def test_coupled_settings(inst):
+    inst.write(':CHANnel1:SCALe 0.5')
+    inst.write(':CHANnel1:RANGe 4')
+    inst.write(':CHANnel1:SCALe 0.5')
+    inst.write(':WGEN:VOLTage:HIGH 1')
+    inst.write(':WGEN:VOLTage 2')
+    inst.write(':WGEN:VOLTage:HIGH 1')
+    assert inst.skipped == 0
+
+    inst.write(':WGEN:FREQuency 1000')
+    inst.write(':WGEN:FUNCtion SQUare')
+    inst.write(':WGEN:FREQuency 1000')
+    assert inst.skipped == 0
+
+
+def test_resets(inst):
+    inst.write(':TIMebase:SCALe 1E-3')
+    inst.write('*RST')
+    inst.write(':TIMebase:SCALe 1E-3')
+    inst.write(':AUToscale')
+    inst.write(':TIMebase:SCALe 1E-3')
+    inst.resync()
+    inst.write(':TIMebase:SCALe 1E-3')
+    assert inst.skipped == 0
+
+    inst.query(':TIMebase:POSition 1E-4;*OPC?')
+    inst.write(':TIMebase:POSition 1E-4')
+    assert inst.skipped == 1
+
+
+def test_batch_restores_state(inst):
+    inst.write(':TIMebase:SCALe 1E-3')
+    with pytest.raises(RuntimeError):
+        with inst.batch():
+            with inst.batch():
+                inst.write(':TIMebase:SCALe 2E-3')
+                inst.write(':TIMebase:POSition 1E-4')
+            raise RuntimeError
+    assert inst.state == {'TIM:SCAL': (1e-3,)}
+
+    with inst.batch(opc=True):
+        inst.write(':TIMebase:POSition 1E-4')
+    assert inst.state['TIM:POS'] == (1e-4,)
+
+
+def test_batch_missing():
+    class Plain:
+        def write(self, cmd):
+            pass
+
+    with pytest.raises(AttributeError):
+        shadow.Shadow(Plain()).batch
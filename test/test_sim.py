@@ -0,0 +1,97 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from pyscpi import scpi
+from pyscpi.block import BlockSizeError
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 1000
+
+
+@pytest.fixture
+def server():
+    with sim.Server(sim=sim.Oscilloscope(POINTS, noise=0, seed=0)) as srv:
+        yield srv
+
+
+@pytest.fixture
+def inst(server):
+    inst = scpi.Instrument(*server.address)
+    yield inst
+    inst.close()
+
+
+def test_compound_message():
+    scope = sim.Oscilloscope(POINTS)
+    response = scope.handle(':TIMebase:SCALe 2E-3;POSition 1E-4;:TIMebase:SCALe?;POSition?;*OPC?')
+    assert response == b'+2.000000E-03;+1.000000E-04;1\n'
+    assert scope.handle(':CHANnel1:SCALe 0.5') == b''
+
+
+def test_error_queue():
+    scope = sim.Oscilloscope(POINTS)
+    scope.handle(':BOGus 1')
+    assert scope.handle(':SYSTem:ERRor?') == b'-113,"Undefined header"\n'
+    assert scope.handle(':SYSTem:ERRor?') == b'+0,"No error"\n'
+
+
+def test_query(inst):
+    assert inst.query('*IDN?').startswith('KEYSIGHT TECHNOLOGIES')
+    inst.write(':TIMebase:SCALe 5E-4')
+    assert float(inst.query(':TIMebase:SCALe?')) == 5e-4
+
+
+def test_read_single_channel(inst):
+    osc.setWGenDC(inst, 0.25)
+    t, v = osc.readSingleChannel(inst, 1, runAfter=False)
+    assert len(t) == len(v) == POINTS
+    # one code of the 8 division BYTE scale
+    np.testing.assert_allclose(v, 0.25, atol=8 / 256)
+    assert t[1] - t[0] == pytest.approx(1e-2 / POINTS, rel=1e-4)
+
+
+def test_read_channels(inst):
+    osc.setWGenSquare(inst, -1, 1, 1e3, 50)
+    t, v = osc.readChannels(inst, [1, 3], runAfter=False)
+    assert v.shape == (POINTS, 2)
+    assert set(np.round(v[:, 0], 1)) == {-1.0, 1.0}
+
+
+def test_decimated_points(inst):
+    _, v = osc.readSingleChannel(inst, 2, points=100, runAfter=False)
+    assert len(v) == 100
+
+
+def test_async_helpers(server):
+    async def main():
+        async with scpi.AsyncInstrument(*server.address) as inst:
+            await osc.setTimeAxisAsync(inst, 2e-3, 0)
+            pream = await osc.getPreambleAsync(inst)
+            t, v = await osc.readChannelsAsync(inst, [1, 2], runAfter=False)
+        return pream, t, v
+
+    pream, t, v = asyncio.run(main())
+    assert pream.points == POINTS
+    assert pream.xinc == pytest.approx(2e-2 / POINTS)
+    assert v.shape == (POINTS, 2)
+
+
+def test_in_process_instrument():
+    inst = sim.Instrument(sim.Oscilloscope(POINTS, noise=0, seed=0))
+    osc.setWGenDC(inst, -0.5)
+    t, v = osc.readSingleChannel(inst, 4, runAfter=False)
+    assert len(v) == POINTS
+    np.testing.assert_allclose(v, -0.5, atol=8 / 256)
+    assert inst.read_raw() == b''
+
+
+def test_in_process_read_block_too_small():
+    inst = sim.Instrument(points=POINTS)
+    inst.write(':WAVeform:DATA?')
+    with pytest.raises(BlockSizeError):
+        inst.read_block(bytearray(10))
+    # the rejected block is dropped with its terminator
+    assert inst.query('*OPC?') == '1'
@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from pyscpi import scpi, status, trace
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 1000
+
+
+@pytest.fixture
+def scope():
+    return sim.Oscilloscope(POINTS, seed=0, digitize_time=0.2)
+
+
+@pytest.fixture
+def inst(scope):
+    with sim.Server(sim=scope) as server:
+        inst = scpi.Instrument(*server.address)
+        yield inst
+        inst.close()
+
+
+def test_enable(inst):
+    status.enable(inst)
+    assert status.enabled(inst)
+    assert inst.query('*ESE?;*SRE?') == '1;32'
+    status.disable(inst)
+    assert not status.enabled(inst)
+    assert inst.query('*ESE?;*SRE?') == '0;0'
+
+
+def test_operation_does_not_hold_the_connection(inst):
+    status.enable(inst)
+    start = time.perf_counter()
+    op = status.start(inst, ':DIGitize CHANnel1')
+    assert not op.done()
+    # other commands are answered while the oscilloscope digitizes
+    assert inst.query(':TIMebase:SCALe?')
+    assert time.perf_counter() - start < 0.15
+
+    op.wait(timeout=2)
+    assert op.complete
+    assert time.perf_counter() - start >= 0.15
+    # *ESR? cleared the request
+    assert int(inst.query('*STB?')) & status.RQS == 0
+
+
+def test_wait_timeout(inst):
+    status.enable(inst)
+    op = status.start(inst, ':DIGitize CHANnel1')
+    with pytest.raises(TimeoutError):
+        op.wait(timeout=0.02)
+    op.wait(timeout=2)
+
+
+def test_complete_falls_back_to_opc_query(inst, scope):
+    inst.write(':DIGitize CHANnel1')
+    start = time.perf_counter()
+    status.complete(inst)
+    assert time.perf_counter() - start >= 0.15
+
+
+def test_osc_helpers_use_status(inst):
+    messages = []
+    inst.tracer = trace.Tracer(pre=[lambda e: messages.append(e.header)])
+
+    osc.setTimeAxis(inst, 1e-3, 0)
+    assert messages[-1] == 'TIM:SCAL;TIM:POS;*OPC?'
+
+    status.enable(inst)
+    messages.clear()
+    osc.setTimeAxis(inst, 1e-3, 0)
+    assert messages[0] == 'TIM:SCAL;TIM:POS'
+    assert '*OPC' in messages and '*ESR?' in messages
+    assert '*OPC?' not in ';'.join(messages).split(';')
+
+
+@pytest.mark.parametrize('interrupt', [True, False])
+def test_usbtmc_service_request(scope, interrupt):
+    pytest.importorskip('usb')
+    from pyscpi import fakeusb, usbtmc
+
+    inst = usbtmc.Instrument(device=fakeusb.device(scope, interrupt=interrupt))
+    status.enable(inst)
+    assert inst.wait_srq(0.01) is None
+
+    start = time.perf_counter()
+    op = status.start(inst, ':DIGitize CHANnel1')
+    assert inst.query('*IDN?').startswith('KEYSIGHT')
+    op.wait(timeout=2)
+    assert time.perf_counter() - start >= 0.15
+    assert inst.read_stb() & status.RQS == 0
+    inst.close()
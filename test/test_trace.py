@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from pyscpi import scpi, trace
+from pyscpi.keysight import osc, sim
+
+
+POINTS = 1000
+
+
+@pytest.fixture
+def traced():
+    stats = trace.Aggregator()
+    events = []
+    with sim.Server(sim=sim.Oscilloscope(POINTS, seed=0)) as server:
+        inst = scpi.Instrument(*server.address, tracer=trace.Tracer(stats, pre=[events.append]))
+        yield inst, stats, events
+        inst.close()
+
+
+@pytest.mark.parametrize('message, headers', [
+    (':WAVeform:POINts:MODE RAW', 'WAV:POIN:MODE'),
+    (':TIMebase:SCALe 1E-3;POSition 0;*OPC?', 'TIM:SCAL;POS;*OPC?'),
+    (b':WAVeform:DATA?\n', 'WAV:DATA?'),
+    ([':RUN', '*OPC?'], 'RUN;*OPC?'),
+])
+def test_header(message, headers):
+    assert trace.header(message) == headers
+
+
+def test_query_is_one_event(traced):
+    inst, stats, events = traced
+    assert inst.query('*OPC?') == '1'
+    assert [(e.op, e.header) for e in events] == [('query', '*OPC?')]
+
+    s = stats.commands[('query', '*OPC?')]
+    assert s.count == 1 and s.errors == 0
+    assert s.sent == len('*OPC?\n') and s.received == len('1\n')
+    assert s.transfers >= 2 and s.total > 0
+
+
+def test_read_reported_under_last_write(traced):
+    inst, stats, events = traced
+    inst.write(':WAVeform:FORMat BYTE')
+    inst.write(':WAVeform:DATA?')
+    data = inst.read_block()
+    s = stats.commands[('read', 'WAV:DATA?')]
+    assert s.count == 1
+    assert s.received > len(data) == POINTS
+
+
+def test_batch_reports_compound_messages(traced):
+    inst, stats, events = traced
+    osc.setTimeAxis(inst, 1e-3, 0)
+    assert [(e.op, e.header) for e in events] == [('query', 'TIM:SCAL;TIM:POS;*OPC?')]
+
+
+def test_errors_are_counted(traced):
+    inst, stats, events = traced
+    inst.write('*IDN?')
+    with pytest.raises(ValueError, match='Invalid block header'):
+        inst.read_block()
+    assert stats.commands[('read', '*IDN?')].errors == 1
+    assert inst.query('*OPC?') == '1'
+    assert stats.commands[('query', '*OPC?')].errors == 0
+
+
+def test_percentiles():
+    s = trace.CommandStats('query', '*OPC?')
+    for elapsed in [1e-3] * 98 + [1e-1] * 2:
+        s.add(trace.Event('query', '*OPC?', 0.0, elapsed))
+    assert s.percentile(50) == pytest.approx(1e-3, rel=0.3)
+    assert s.percentile(99) == pytest.approx(1e-1, rel=0.3)
+    assert s.percentile(100) == 1e-1
+    assert s.summary()['histogram']['counts'] == [98, 2]
+
+
+def test_report_and_dump(traced, tmp_path):
+    inst, stats, events = traced
+    for _ in range(3):
+        inst.query('*IDN?')
+    assert 'IDN?' in stats.report().splitlines()[1]
+
+    stats.dump(tmp_path / 'trace.json')
+    with open(tmp_path / 'trace.json') as f:
+        data = json.load(f)
+    assert data['commands'][0]['count'] == 3
+    stats.clear()
+    assert stats.summary() == []
+
+
+def test_usbtmc_transfers():
+    pytest.importorskip('usb')
+    from pyscpi import fakeusb, usbtmc
+
+    stats = trace.Aggregator()
+    inst = usbtmc.Instrument(device=fakeusb.device(sim.Oscilloscope(POINTS)), tracer=trace.Tracer(stats))
+    inst.open()
+    inst.max_transfer_size = 512 - usbtmc.USBTMC_HEADER_SIZE
+    inst.write(':WAVeform:DATA?')
+    inst.read_block()
+    s = stats.commands[('read', 'WAV:DATA?')]
+    assert s.received > POINTS
+    assert s.transfers >= POINTS // 500
+    inst.close()